@@ -0,0 +1,77 @@
+"""
+build_index.py
+=====================================================
+Offline build ของ RAG index (manual_index/) โดยไม่ต้องรัน backend
+- incremental: encode ใหม่เฉพาะ manual ที่เพิ่ม/เปลี่ยน (เหมือนตอน backend startup)
+- checkpoint ทุก batch และทุก manual ใน <index-dir>.build/ -> ถ้า build ตาย รันคำสั่งเดิมซ้ำจะทำต่อจากจุดเดิม
+- log progress + throughput ต่อ manual
+- ผลลัพธ์คือ directory index ที่ backend เปิดได้ทันที (copy ไปเครื่อง serve แล้วรัน backend ด้วย RAG_AUTO_BUILD=0)
+
+Run with:
+    python build_index.py
+    python build_index.py --manuals /data/manuals --index-dir /data/manual_index
+    python build_index.py --full          # build ใหม่ทั้งหมด (ยัง resume จาก checkpoint ได้)
+    python build_index.py --no-resume     # ทิ้ง checkpoint เดิม
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the maintenance-agent manual index offline")
+    parser.add_argument("--manuals", type=Path, help="directory ของ PDF manuals (default: RAG_MANUAL_DIR หรือ ./manuals)")
+    parser.add_argument("--index-dir", type=Path, help="directory ของ index ที่จะสร้าง (default: RAG_INDEX_DIR หรือ ./manual_index)")
+    parser.add_argument("--full", action="store_true", help="build ใหม่ทั้งหมดแทน incremental update")
+    parser.add_argument("--no-resume", action="store_true", help="ไม่ใช้ checkpoint จาก build ที่ค้างไว้")
+    parser.add_argument("--no-warm", action="store_true", help="ไม่ precompute ผลของ defect vocabulary")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # path ของ backend ถูกกำหนดตอน import -> ตั้ง env ก่อน import
+    if args.manuals:
+        os.environ["RAG_MANUAL_DIR"] = str(args.manuals.resolve())
+    if args.index_dir:
+        os.environ["RAG_INDEX_DIR"] = str(args.index_dir.resolve())
+    import maintenance_agent_backend as backend
+
+    pdf_dir = backend.MANUAL_DIR
+    if not pdf_dir.is_dir():
+        print(f"[Build] ERROR: manual directory not found: {pdf_dir}")
+        return 2
+
+    print(f"[Build] manuals={pdf_dir} index={backend.INDEX_DIR}")
+    t0 = time.time()
+    index = backend.ManualIndex()
+    index._ensure_model()
+    # lock เดียวกับ server: ถ้า worker กำลัง build อยู่ รอให้เสร็จก่อน (ไม่ลบ/resume staging dir ของมันกลางทาง)
+    with backend.index_lock:
+        if args.no_resume:
+            shutil.rmtree(backend.INDEX_DIR.with_name(backend.INDEX_DIR.name + ".build"), ignore_errors=True)
+        if args.full or not index.open_existing():
+            index.build_from_pdfs(pdf_dir)
+        else:
+            index.update_from_pdfs(pdf_dir)
+    if not len(index):
+        print("[Build] ERROR: no text extracted from manuals; index not written")
+        return 1
+    if not args.no_warm:
+        backend.warm_defect_queries(index)
+
+    elapsed = time.time() - t0
+    size_mb = sum(f.stat().st_size for f in index.index_path.iterdir()) / 1e6
+    print(
+        f"[Build] Done in {elapsed:.1f}s: index {index.index_id}, {len(index.manuals)} manuals, "
+        f"{len(index)} chunks, {size_mb:.1f} MB in {index.index_path}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+export_onnx_model.py
+=====================================================
+Export embedding model (EMBED_MODEL_NAME) เป็น ONNX + dynamic int8 quantization
+สำหรับ RAG_EMBED_BACKEND=onnx แล้วเทียบกับ PyTorch (reference) ด้วย cosine score
+บน chunk จริงจาก index ที่มีอยู่
+
+- เครื่องที่ export: torch + sentence-transformers + onnx + onnxruntime
+- เครื่องที่ serve (RAG_EMBED_BACKEND=onnx): แค่ onnxruntime + tokenizers (ไม่ต้องมี torch) -> pip install -r requirements-onnx.txt
+
+Run with:
+    python export_onnx_model.py                          # -> ./onnx_model
+    python export_onnx_model.py --out /data/onnx_model --sample 2000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export the embedding model to int8 ONNX and check it against PyTorch")
+    parser.add_argument("--out", type=Path, help="directory ปลายทาง (default: RAG_ONNX_DIR หรือ ./onnx_model)")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--sample", type=int, default=500, help="จำนวน chunk จาก index ที่ใช้เทียบ")
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="cosine ต่ำสุดที่ยอมรับ (ต่อข้อความ)")
+    parser.add_argument("--keep-fp32", action="store_true", help="เก็บ model_fp32.onnx ไว้ด้วย")
+    return parser.parse_args(argv)
+
+
+def export_fp32(reference, path: Path, opset: int):
+    """export transformer ของ sentence-transformers (ไม่รวม pooling) -> last_hidden_state"""
+    import torch
+
+    st = reference.model
+    transformer = st[0].auto_model.eval()
+
+    class _Encoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(
+                input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+            )[0]
+
+    inputs = ["input_ids", "attention_mask", "token_type_ids"]
+    dummy = st.tokenizer(["pump bearing inspection"], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder(transformer),
+            tuple(dummy[name] for name in inputs),
+            str(path),
+            input_names=inputs,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in inputs + ["last_hidden_state"]},
+            opset_version=opset,
+        )
+
+
+def query_latency_ms(embedder, query: str, runs: int = 20) -> float:
+    embedder.encode([query])   # warm-up
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        embedder.encode([query])
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.out:
+        os.environ["RAG_ONNX_DIR"] = str(args.out.resolve())
+    import maintenance_agent_backend as backend
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    out_dir = backend.ONNX_MODEL_DIR
+    out_dir.mkdir(parents=True, exist_ok=True)
+    print(f"[Export] {backend.EMBED_MODEL_NAME} -> {out_dir}")
+
+    reference = backend.TorchEmbedder()
+    st = reference.model
+    fp32_path = out_dir / "model_fp32.onnx"
+    int8_path = out_dir / "model_int8.onnx"
+    export_fp32(reference, fp32_path, args.opset)
+    quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8)
+    if not args.keep_fp32:
+        fp32_path.unlink()
+    st.tokenizer.backend_tokenizer.save(str(out_dir / "tokenizer.json"))
+
+    meta = {
+        "model_name": backend.EMBED_MODEL_NAME,
+        "model_file": int8_path.name,
+        "quantization": "dynamic int8 (QInt8 weights)",
+        "opset": args.opset,
+        "max_seq_length": st.max_seq_length,
+        "pad_id": st.tokenizer.pad_token_id,
+        "pad_token": st.tokenizer.pad_token,
+        "dim": st.get_sentence_embedding_dimension(),
+        "exported_at": datetime.now().isoformat(),
+    }
+    meta_path = out_dir / "export.json"
+    meta_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    print(f"[Export] {int8_path.name}: {int8_path.stat().st_size / 1e6:.1f} MB")
+
+    # equivalence check บน chunk จริงจาก index (ถ้ามี) + defect queries
+    candidate = backend.OnnxEmbedder(model_dir=out_dir)
+    queries = sorted({backend.rag_query_for(d) for d in backend.DEFECT_TYPES})
+    index = backend.ManualIndex()
+    if index.open_existing():
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(len(index), size=min(args.sample, len(index)), replace=False))
+        texts = [index.text(int(r)) for r in rows]
+    else:
+        print("[Export] WARNING: no index found; checking on the defect queries only")
+        texts = list(queries)
+    report = backend.check_embedder_equivalence(reference, candidate, texts, queries)
+    report["torch_query_ms"] = query_latency_ms(reference, queries[0])
+    report["onnx_query_ms"] = query_latency_ms(candidate, queries[0])
+    meta["equivalence"] = report
+    meta_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+    for key, value in report.items():
+        print(f"[Export]   {key}: {value:.4f}" if isinstance(value, float) else f"[Export]   {key}: {value}")
+    if report["min_cosine"] < args.min_cosine:
+        print(f"[Export] FAILED: min cosine {report['min_cosine']:.4f} < {args.min_cosine}")
+        return 1
+    print("[Export] OK -> run the backend with RAG_EMBED_BACKEND=onnx")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
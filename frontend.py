@@ -374,7 +374,7 @@ def render_dashboard(db_path: Path):
         df_view = df_view.set_index("id", drop=False)
 
     cols_show = []
-    for c in ["id", "ts", "client_id", "defect_type", "status", "confidence", "latency_ms", "resolved"]:
+    for c in ["id", "ts", "client_id", "defect_type", "status", "confidence", "latency_ms", "cache_hit", "resolved"]:
         if c in df_view.columns:
             cols_show.append(c)
 
@@ -395,6 +395,23 @@ def render_dashboard(db_path: Path):
     else:
         st.write("ไม่พบคอลัมน์ที่ต้องการในตาราง logs")
 
+    # --------------------- Thumbnails (NG ล่าสุด) ---------------------
+    if "thumb_path" in df_filtered.columns:
+        with st.expander("🖼 Latest NG images"):
+            df_ng = df_filtered[(df_filtered["status"] == "NG") & df_filtered["thumb_path"].notna()].head(12)
+            thumbs = []
+            for _, row in df_ng.iterrows():
+                # path ใน DB เป็น path บนเครื่อง server -> ถ้าเปิดผ่าน network share ใช้ไฟล์ข้าง ๆ DB แทน
+                path = Path(row["thumb_path"])
+                if not path.exists():
+                    path = db_path.parent / path.name
+                if path.exists():
+                    thumbs.append((str(path), f"{row['client_id']} · {row['defect_type']} · {row['ts']}"))
+            if thumbs:
+                st.image([p for p, _ in thumbs], caption=[c for _, c in thumbs], width=160)
+            else:
+                st.write("ยังไม่มีรูป NG")
+
 # =====================================================================
 # MODE 2: MAINTENANCE AGENT (เหมือนเวอร์ชันเดิม)
 # =====================================================================
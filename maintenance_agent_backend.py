@@ -9,36 +9,185 @@ Backend สำหรับ Maintenance Agent (Multi-client, Central DB)
 """
 
 import base64
+import fnmatch
+import hashlib
 import io
+import itertools
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
 import time
 import json
+import uuid
+import zlib
 import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from functools import cached_property
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any, Tuple
+from typing import BinaryIO, Callable, Container, List, Optional, Dict, Any, Tuple, Deque, Iterable, Iterator
 
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
-from pypdf import PdfReader
-from PIL import Image
+from PIL import ExifTags, Image
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# sentence_transformers (torch), onnxruntime และ pypdf import แบบ lazy ตอนใช้งานจริง
+# -> worker เปิดรับ connection ได้ทันที ไม่ต้องรอ import/โหลด model
 
 # ------------------------------------------------------------
 # ========== Config Paths ====================================
 # ------------------------------------------------------------
 
 ROOT_DIR = Path(__file__).parent
-MANUAL_DIR = ROOT_DIR / "manuals"          # PDF manuals
-INDEX_PATH = ROOT_DIR / "manual_index.npz" # RAG index
+MANUAL_DIR = Path(os.getenv("RAG_MANUAL_DIR", ROOT_DIR / "manuals"))       # PDF manuals
+INDEX_DIR = Path(os.getenv("RAG_INDEX_DIR", ROOT_DIR / "manual_index"))    # RAG index (memmap, pickle-free)
+MANIFEST_NAME = "manifest.json"            # per-manual fingerprints ของ index (ใน version dir)
+WARM_RESULTS_NAME = "warm_results.json"    # ผล RAG ต่อ defect ที่ precompute ไว้ (ใน version dir)
+LEGACY_INDEX_PATH = ROOT_DIR / "manual_index.npz"  # format เก่า (unified_app.py ยังใช้) -> แปลงเป็น INDEX_DIR ตอนโหลด
 LOG_DIR = ROOT_DIR / "logs"                # images + db
 DB_PATH = LOG_DIR / "maintenance_logs.db"  # SQLite DB
+EMBED_CACHE_PATH = ROOT_DIR / "embedding_cache.db"  # embedding cache ข้ามการ rebuild
+PAGE_CACHE_PATH = ROOT_DIR / "page_text_cache.db"   # text ที่ extract จาก PDF แล้ว ต่อหน้า
 
 CHUNK_SIZE = 800
 CHUNK_OVERLAP = 200
 
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# PDF text extraction แบบขนาน: แบ่งงานเป็น shard ละ (ไฟล์, ช่วงหน้า)
+EXTRACT_WORKERS = int(os.getenv("RAG_EXTRACT_WORKERS", "0")) or (os.cpu_count() or 1)
+EXTRACT_PAGES_PER_SHARD = 16
+EMBED_BATCH_SIZE = 256    # จำนวน chunk ต่อ batch ที่ encode แล้ว append ลง disk ระหว่าง build (= 1 checkpoint)
+BUILD_PROGRESS_INTERVAL = 10.0   # วินาที ระหว่าง progress log ตอน build manual ขนาดใหญ่
+# 0 = backend ไม่ build/sync index เอง (serve เฉพาะ index artifact ที่ build_index.py สร้างแล้ว copy มา)
+INDEX_AUTO_BUILD = os.getenv("RAG_AUTO_BUILD", "1") != "0"
+EMBED_CACHE_MAX_BYTES = int(os.getenv("RAG_EMBED_CACHE_MB", "512")) * 1024 * 1024
+
+# Encode แบบหลาย process ตอน build: แต่ละ worker โหลด model ของตัวเอง และจำกัด thread ต่อ worker
+# (workers x threads ไม่ควรเกินจำนวน core) ; RAG_EMBED_WORKERS=1 -> encode ใน process หลัก
+EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "1"))
+EMBED_THREADS_PER_WORKER = int(os.getenv("RAG_EMBED_THREADS", "1"))
+EMBED_ENCODE_BATCH = int(os.getenv("RAG_EMBED_ENCODE_BATCH", "64"))  # batch_size ที่ส่งให้ model.encode
+
+# Embedding backend: "torch" = sentence-transformers (reference), "onnx" = MiniLM ที่ export เป็น ONNX
+# + dynamic int8 quantization รันด้วย onnxruntime (ไม่ import torch) ; สร้างด้วย export_onnx_model.py
+EMBED_BACKEND = os.getenv("RAG_EMBED_BACKEND", "torch")
+ONNX_MODEL_DIR = Path(os.getenv("RAG_ONNX_DIR", ROOT_DIR / "onnx_model"))
+
+# defect labels ที่ vision ส่งออกมาได้ -> ใช้ pre-warm RAG cache ตอน startup
+DEFECT_TYPES = ["normal", "rust_on_pipe", "oil_leak", "loose_bolt"]
+SEARCH_CACHE_SIZE = 256   # จำนวน query อิสระ (free-form) ที่ cache ไว้แบบ LRU
+SEARCH_MANY_MAX_QUERIES = 2000
+
+# Approximate search (IVF) สำหรับ library ขนาดใหญ่
+# "auto" = สร้างเมื่อมี chunk >= ANN_MIN_ROWS, "ivf" = สร้างเสมอ, "off" = exact search อย่างเดียว
+ANN_MODE = os.getenv("RAG_ANN", "auto")
+ANN_MIN_ROWS = 50_000
+ANN_NPROBE = int(os.getenv("RAG_ANN_NPROBE", "8"))  # จำนวนกลุ่มที่ scan ต่อ query (recall ↑ latency ↑)
+
+# Quantized scan: "none" = float32, "float16", "int8" (per-vector scale)
+# ตอน search scan matrix ที่ quantize แล้ว; RESCORE_FACTOR > 0 -> คำนวณ float32 ใหม่เฉพาะ shortlist
+# (top_k x RESCORE_FACTOR row) จาก embeddings.bin ที่ memmap ไว้ (page อื่นไม่ถูกโหลด)
+QUANT_MODE = os.getenv("RAG_QUANT", "none")
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))
+SCAN_BLOCK_ROWS = 16384
+
+# Hybrid retrieval: BM25 (lexical) + dense
+# score = (1 - w) * cosine + w * (bm25 / max bm25 ของ candidate); candidate = top_k x HYBRID_CANDIDATES ของแต่ละฝั่ง
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("RAG_LEXICAL_WEIGHT", "0.3"))
+HYBRID_CANDIDATES = 4
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Dedup ตอน build (ภายใน manual เดียวกัน): chunk ที่ข้อความตรงกัน (hash) หรือเกือบตรงกัน
+# (MinHash ของ word shingle, Jaccard โดยประมาณ >= DEDUP_NEAR_THRESHOLD) เก็บ row เดียว + รายการหน้าอื่นที่ซ้ำ
+# DEDUP_NEAR_THRESHOLD >= 1 -> ใช้ exact hash อย่างเดียว
+DEDUP_NEAR_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.85"))
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16        # LSH: 16 band x 4 ค่า -> candidate ถ้า band ใด band หนึ่งตรงกัน
+SHINGLE_WORDS = 3
+# บรรทัดที่ (หลังแทนตัวเลขด้วย #) ซ้ำกันใน >= BOILERPLATE_PAGE_FRACTION ของหน้าใน manual
+# และอย่างน้อย BOILERPLATE_MIN_PAGES หน้า = header/footer/เลขหน้า -> ตัดทิ้งก่อน chunk
+BOILERPLATE_PAGE_FRACTION = float(os.getenv("RAG_BOILERPLATE_FRACTION", "0.5"))
+BOILERPLATE_MIN_PAGES = 3
+DEDUP_OVERFETCH = 2       # ตอน search ดึง top_k x 2 แล้วตัด chunk ที่ข้อความซ้ำกัน (ข้าม manual) ออก
+
+# Machine/model tag -> manual: {"clients": {client_id: tag}, "machines": {tag: [glob ของชื่อ manual]}}
+# request จาก client ที่ map ไว้ค้นเฉพาะ shard (manual) ของเครื่องนั้น; แก้ไฟล์ได้ขณะ server รัน
+MACHINE_TAGS_PATH = ROOT_DIR / "machine_tags.json"
+
+# Hot reload: poll MANUAL_DIR ทุก INDEX_WATCH_INTERVAL วินาที แล้ว build index ใหม่ใน background
+# เมื่อ PDF ถูกเพิ่ม/แก้/ลบ (0 = ปิด watcher, ยัง reload ผ่าน POST /admin/reload_index ได้)
+INDEX_WATCH_INTERVAL = float(os.getenv("RAG_WATCH_INTERVAL", "10"))
+
+# POST /analyze/upload: รับรูปเป็น binary (multipart หรือ raw body) แทน base64 ใน JSON
+# body ถูก stream ลง temp file (อยู่ใน RAM ไม่เกิน UPLOAD_SPOOL_BYTES ส่วนที่เกินเขียนลง disk)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+
+# ตรวจรูปจาก header อย่างเดียว (format, ขนาด) ก่อนเข้า pipeline; pixel ถูก decode เฉพาะตอน vision ต้องใช้
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP", "BMP"}
+MAX_IMAGE_PIXELS = int(float(os.getenv("MAX_IMAGE_MPIX", "40")) * 1_000_000)
+MAX_IMAGE_SIDE = 16384
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))  # JPEG ใหญ่กว่านี้ decode ด้วย draft mode (1/2, 1/4, 1/8)
+
+# Preprocessing ก่อนเข้า vision: หมุนตาม EXIF -> ย่อให้ด้านยาว = VISION_INPUT_SIZE (ขนาด input ของ model)
+# รูปที่ด้านยาว >= VISION_TILE_MIN_SIDE ถูกตัดเป็น tile (VISION_TILE_SIZE px, ซ้อนกัน VISION_TILE_OVERLAP)
+# เพื่อหา defect เล็ก ๆ; VISION_TILE_MIN_SIDE=0 -> ไม่ทำ tile
+VISION_INPUT_SIZE = int(os.getenv("VISION_INPUT_SIZE", "448"))
+VISION_TILE_MIN_SIDE = int(os.getenv("VISION_TILE_MIN_SIDE", "0"))
+VISION_TILE_SIZE = 1024
+VISION_TILE_OVERLAP = 0.2
+VISION_TILE_MAX_SIDE = 4096    # รูปที่ใหญ่กว่านี้ decode แบบ draft ก่อนตัด tile
+# รูปที่เก็บใน log: ไฟล์ที่ upload มาตามเดิม (ไม่ decode/encode ใน request)
+# + thumbnail LOG_THUMB_SIZE สำหรับ dashboard ที่สร้างใน background thread
+LOG_THUMB_SIZE = 256
+LOG_JPEG_QUALITY = 85
+
+# Micro-batching ของ vision: request ที่เข้ามาพร้อมกันถูกรวมเป็น batch เดียว (สูงสุด VISION_BATCH_MAX รูป
+# หรือรอไม่เกิน VISION_BATCH_WAIT_MS นับจาก request แรกของ batch) แล้วกระจายผลกลับ
+VISION_BATCH_MAX = int(os.getenv("VISION_BATCH_MAX", "8"))
+VISION_BATCH_WAIT_MS = float(os.getenv("VISION_BATCH_WAIT_MS", "10"))
+# เวลาจำลองของ stub ต่อ batch + ต่อรูป (ms) ไว้ทดสอบ batching บนเครื่อง local; 0 = ตอบทันที
+VISION_STUB_BATCH_MS = float(os.getenv("VISION_STUB_BATCH_MS", "0"))
+VISION_STUB_ITEM_MS = float(os.getenv("VISION_STUB_ITEM_MS", "0"))
+
+# Vision backend: "stub" = call_vlm_stub_batch ใน process, "http" = VLM server ภายนอก (POST {VISION_URL}/v1/analyze)
+# ทดสอบบนเครื่อง local ด้วย vision_standin_server.py (protocol เดียวกัน, ผลแบบ deterministic)
+VISION_BACKEND = os.getenv("VISION_BACKEND", "stub")
+VISION_URL = os.getenv("VISION_URL", "http://127.0.0.1:8100")
+VISION_MAX_CONCURRENCY = int(os.getenv("VISION_MAX_CONCURRENCY", "4"))   # batch ที่ส่งไป server พร้อมกันได้
+VISION_CONNECT_TIMEOUT = float(os.getenv("VISION_CONNECT_TIMEOUT", "2"))
+VISION_TIMEOUT = float(os.getenv("VISION_TIMEOUT", "30"))                # read timeout ต่อ batch (วินาที)
+VISION_RETRIES = int(os.getenv("VISION_RETRIES", "2"))                  # retry สูงสุดต่อ batch
+# retry budget: แต่ละ request ได้เครดิต VISION_RETRY_BUDGET, retry 1 ครั้งใช้ 1 เครดิต (สะสมได้ไม่เกิน
+# VISION_RETRY_BURST) -> ตอน server ล่ม retry ไม่เกิน ~10% ของ traffic แทนที่จะคูณ load เป็น 3 เท่า
+VISION_RETRY_BUDGET = float(os.getenv("VISION_RETRY_BUDGET", "0.1"))
+VISION_RETRY_BURST = 10.0
+VISION_RETRY_BACKOFF = 0.05    # วินาที, เพิ่มเป็น 2 เท่าทุกครั้ง (+ jitter)
+
+# Cache ผล vision ตาม perceptual hash (dHash 64 bit) + คำถาม: รูปที่ Hamming distance <= VISION_CACHE_MAX_DISTANCE
+# จาก entry ที่ยังไม่หมดอายุ (VISION_CACHE_TTL วินาที) ใช้ผลเดิมโดยไม่เรียก vision (เช่นกล้องติดตั้งถาวร)
+# เก็บได้ VISION_CACHE_SIZE entry (เต็ม -> ทิ้ง entry ที่ใช้ล่าสุดนานที่สุด); 0 = ปิด cache
+VISION_CACHE_SIZE = int(os.getenv("VISION_CACHE_SIZE", "1024"))
+VISION_CACHE_TTL = float(os.getenv("VISION_CACHE_TTL", "300"))
+VISION_CACHE_MAX_DISTANCE = int(os.getenv("VISION_CACHE_MAX_DISTANCE", "5"))
+DHASH_DECODE_SIDE = 256  # ขอ draft ที่เล็กสุดที่ยัง >= ค่านี้ (libjpeg ย่อได้ถึง 1/8; เล็กกว่านี้ hash ของรูป contrast ต่ำไม่นิ่ง)
+
 
 # ------------------------------------------------------------
 # ========== API Schemas =====================================
@@ -53,8 +202,33 @@ class AnalyzeRequest(BaseModel):
 class RAGSource(BaseModel):
     manual_name: str
     page: int
-    score: float
+    score: float   # hybrid: (1 - w) * cosine + w * BM25 ที่ normalize; query part number/error code: BM25 / ขอบบน (ดู ManualIndex._rank)
     snippet: str
+    other_pages: List[int] = []   # หน้าอื่นใน manual เดียวกันที่มีข้อความเดียวกัน (ถูก dedup ตอน build)
+
+
+class ManualPage(BaseModel):
+    manual_name: str
+    page: int
+    text: str
+
+
+class RAGSearchManyRequest(BaseModel):
+    queries: List[str]
+    top_k: int = 3
+    manuals: Optional[List[str]] = None   # ค้นเฉพาะ manual เหล่านี้
+    machine: Optional[str] = None         # หรือเฉพาะ manual ของ machine tag (ดู MACHINE_TAGS_PATH)
+
+
+class RAGQueryResult(BaseModel):
+    query: str
+    sources: List[RAGSource]
+
+
+class RAGSearchManyResponse(BaseModel):
+    results: List[RAGQueryResult]
+    latency_ms: float
+    index_version: Optional[str] = None
 
 
 class AnalyzeResponse(BaseModel):
@@ -64,73 +238,1765 @@ class AnalyzeResponse(BaseModel):
     action_recommended: str
     rag_sources: List[RAGSource]
     latency_ms: float
+    index_version: Optional[str] = None   # id ของ index ที่ใช้ตอบ request นี้
+    cache_hit: bool = False               # ผล vision มาจาก VisionResultCache (รูปเกือบเหมือนเดิม + คำถามเดิม)
+
+
+# ------------------------------------------------------------
+# ========== Embedding Backends ==============================
+# ------------------------------------------------------------
+
+class EmbeddingBackend(ABC):
+    """
+    Interface ของ embedding model: encode(texts) -> (n, dim) float32
+    เพิ่ม backend ใหม่ = subclass + ลงทะเบียนใน _EMBEDDING_BACKENDS (เลือกด้วย RAG_EMBED_BACKEND)
+    """
+
+    name = ""
+
+    @abstractmethod
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        ...
+
+
+class TorchEmbedder(EmbeddingBackend):
+    """Reference: sentence-transformers (PyTorch) บน CPU"""
+
+    name = "torch"
+
+    def __init__(self, threads: Optional[int] = None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(EMBED_MODEL_NAME, device="cpu")
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, batch_size=batch_size), dtype=np.float32)
+
+
+class OnnxEmbedder(EmbeddingBackend):
+    """
+    MiniLM แบบ ONNX int8 (export_onnx_model.py) บน onnxruntime + tokenizers
+    mean pooling + L2 normalize เหมือน pipeline ของ sentence-transformers
+    """
+
+    name = "onnx"
+
+    def __init__(self, threads: Optional[int] = None, model_dir: Path = ONNX_MODEL_DIR):
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError(
+                f"RAG_EMBED_BACKEND=onnx needs onnxruntime + tokenizers (pip install -r requirements-onnx.txt): {e}"
+            ) from e
+
+        meta_path = model_dir / "export.json"
+        if not meta_path.exists():
+            raise RuntimeError(f"ONNX model not found in {model_dir}; run export_onnx_model.py first")
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if meta["model_name"] != EMBED_MODEL_NAME:
+            raise RuntimeError(
+                f"ONNX model in {model_dir} was exported from {meta['model_name']}, expected {EMBED_MODEL_NAME}"
+            )
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+            opts.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(model_dir / meta["model_file"]), opts, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=meta["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=meta["pad_id"], pad_token=meta["pad_token"])
+        self.dim = meta["dim"]
+        check = meta.get("equivalence")
+        if check:
+            print(
+                f"[RAG] ONNX int8 embedder vs torch: min cosine={check['min_cosine']:.4f}, "
+                f"max score diff={check['max_score_diff']:.4f}"
+            )
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        # เรียงตามความยาวก่อนแบ่ง batch -> padding น้อย (แบบเดียวกับ sentence-transformers)
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        for lo in range(0, len(texts), batch_size):
+            idx = order[lo:lo + batch_size]
+            encoded = self.tokenizer.encode_batch([texts[i] for i in idx])
+            ids = np.asarray([e.ids for e in encoded], dtype=np.int64)
+            mask = np.asarray([e.attention_mask for e in encoded], dtype=np.int64)
+            feeds = {"input_ids": ids, "attention_mask": mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.zeros_like(ids)
+            hidden = self.session.run(None, feeds)[0]
+            weights = mask[:, :, None].astype(np.float32)
+            out[idx] = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        return _l2_normalize(out)
+
+
+_EMBEDDING_BACKENDS = {"torch": TorchEmbedder, "onnx": OnnxEmbedder}
+
+
+def load_embedder(backend: str = EMBED_BACKEND, threads: Optional[int] = None) -> EmbeddingBackend:
+    if backend not in _EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}' (expected one of {sorted(_EMBEDDING_BACKENDS)})")
+    return _EMBEDDING_BACKENDS[backend](threads=threads)
+
+
+def embedding_cache_key(backend: str = EMBED_BACKEND) -> str:
+    """key ของ embedding_cache (รู้ได้โดยไม่ต้องโหลด model -> build ที่ hit cache ทั้งหมดไม่โหลด model เลย)"""
+    return EMBED_MODEL_NAME if backend == "torch" else f"{EMBED_MODEL_NAME}@{backend}-int8"
+
+
+def check_embedder_equivalence(
+    reference: EmbeddingBackend,
+    candidate: EmbeddingBackend,
+    texts: List[str],
+    queries: List[str],
+    k: int = 10,
+) -> Dict[str, float]:
+    """
+    เทียบ candidate กับ reference บนชุดข้อความเดียวกัน
+    - cosine ระหว่าง embedding ของข้อความเดียวกัน (min/mean)
+    - cosine score query x chunk: |Δscore| สูงสุด ทั้งแบบ candidate ล้วน และแบบ query จาก candidate
+      กับ chunk จาก reference (index ที่ build ด้วย torch แต่ serve ด้วย onnx)
+    - overlap ของ top-k chunk ต่อ query
+    """
+    ref_docs, cand_docs = _l2_normalize(reference.encode(texts)), _l2_normalize(candidate.encode(texts))
+    ref_q, cand_q = _l2_normalize(reference.encode(queries)), _l2_normalize(candidate.encode(queries))
+    pair_cos = (ref_docs * cand_docs).sum(axis=1)
+    ref_scores = ref_q @ ref_docs.T
+    cand_scores = cand_q @ cand_docs.T
+    mixed_scores = cand_q @ ref_docs.T
+    k = min(k, len(texts))
+    ref_top = np.argsort(-ref_scores, axis=1)[:, :k]
+    cand_top = np.argsort(-cand_scores, axis=1)[:, :k]
+    overlap = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(ref_top, cand_top)])
+    return {
+        "texts": len(texts),
+        "queries": len(queries),
+        "min_cosine": float(pair_cos.min()),
+        "mean_cosine": float(pair_cos.mean()),
+        "max_score_diff": float(np.abs(cand_scores - ref_scores).max()),
+        "max_score_diff_mixed": float(np.abs(mixed_scores - ref_scores).max()),
+        f"top{k}_overlap": float(overlap),
+    }
+
+
+# ------------------------------------------------------------
+# ========== Embedding / Page Text Caches ====================
+# ------------------------------------------------------------
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache บน SQLite: key = (model name, sha256 ของ chunk text)
+    ใช้ข้ามการ rebuild (เปลี่ยน chunk params, upload manual เดิมซ้ำ, restore)
+    เกิน max_bytes -> ลบ entry ที่ใช้ล่าสุดนานที่สุดออกจนเหลือ ~90%
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT,
+                    text_hash BLOB,
+                    vec BLOB,
+                    last_used REAL,
+                    PRIMARY KEY (model, text_hash)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+            self._conn.commit()
+            row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()
+            self._total_bytes = row[0]
+        return self._conn
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        hashes = [self._hash(t) for t in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            conn = self._connect()
+            unique = list(set(hashes))
+            for lo in range(0, len(unique), 500):
+                part = unique[lo:lo + 500]
+                rows = conn.execute(
+                    f"SELECT text_hash, vec FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(part))})",
+                    [model, *part],
+                ).fetchall()
+                for text_hash, vec in rows:
+                    found[text_hash] = np.frombuffer(vec, dtype=np.float32)
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, h) for h in found],
+                )
+                conn.commit()
+            out = [found.get(h) for h in hashes]
+            n_hit = sum(v is not None for v in out)
+            self.hits += n_hit
+            self.misses += len(out) - n_hit
+        return out
+
+    def put_many(self, model: str, texts: List[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        now = time.time()
+        rows = list({
+            h: (model, h, v.tobytes(), now) for h, v in ((self._hash(t), v) for t, v in zip(texts, vectors))
+        }.values())
+        with self._lock:
+            conn = self._connect()
+            # INSERT OR REPLACE ทับ row เดิม (อีก process encode chunk เดียวกันไปแล้ว) -> นับเฉพาะส่วนต่างของขนาด
+            replaced = 0
+            for lo in range(0, len(rows), 500):
+                part = [r[1] for r in rows[lo:lo + 500]]
+                replaced += conn.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(part))})",
+                    [model, *part],
+                ).fetchone()[0]
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vec, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._total_bytes += sum(len(r[2]) for r in rows) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict(conn)
+                # process อื่นเขียน/ลบ DB เดียวกันได้ -> sync ยอดจริงหลัง evict
+                self._total_bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0]
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            victims = conn.execute(
+                "SELECT model, text_hash, LENGTH(vec) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not victims:
+                self._total_bytes = 0
+                break
+            freed = 0
+            batch = []
+            for model, text_hash, nbytes in victims:
+                batch.append((model, text_hash))
+                freed += nbytes
+                if self._total_bytes - freed <= target:
+                    break
+            conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", batch)
+            self._total_bytes -= freed
+            self.evictions += len(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_BYTES)
+
+
+class PageTextCache:
+    """
+    Text ที่ extract แล้วต่อ (sha256 ของ PDF, page index) บน SQLite, เก็บแบบ zlib
+    - rebuild (เปลี่ยน chunk params / crash กลางทาง) ไม่ต้อง parse PDF ซ้ำ
+    - ดึง full text ของหน้าใดก็ได้ทันทีโดยไม่ต้องเปิด PDF (ดู /manuals/{name}/pages/{page})
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pdfs (pdf_sha TEXT PRIMARY KEY, pages INTEGER)"
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    pdf_sha TEXT,
+                    page INTEGER,
+                    text BLOB,
+                    PRIMARY KEY (pdf_sha, page)
+                ) WITHOUT ROWID
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def page_count(self, pdf_sha: str) -> Optional[int]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT pages FROM pdfs WHERE pdf_sha = ?", (pdf_sha,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_page_count(self, pdf_sha: str, pages: int):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO pdfs (pdf_sha, pages) VALUES (?, ?)", (pdf_sha, pages))
+            conn.commit()
+
+    def get(self, pdf_sha: str, page_idx: int) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT text FROM pages WHERE pdf_sha = ? AND page = ?", (pdf_sha, page_idx)
+            ).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+    def get_range(self, pdf_sha: str, start: int, end: int) -> Optional[List[Tuple[int, str]]]:
+        """หน้า [start, end) ทั้งช่วง หรือ None ถ้ามีหน้าใดยังไม่อยู่ใน cache"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT page, text FROM pages WHERE pdf_sha = ? AND page >= ? AND page < ? ORDER BY page",
+                (pdf_sha, start, end),
+            ).fetchall()
+        if len(rows) != end - start:
+            return None
+        return [(page, zlib.decompress(text).decode("utf-8")) for page, text in rows]
+
+    def put_pages(self, pdf_sha: str, pages: List[Tuple[int, str]]):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO pages (pdf_sha, page, text) VALUES (?, ?, ?)",
+                [(pdf_sha, page, zlib.compress(text.encode("utf-8"))) for page, text in pages],
+            )
+            conn.commit()
+
+
+page_text_cache = PageTextCache(PAGE_CACHE_PATH)
 
 
 # ------------------------------------------------------------
 # ========== RAG Index =======================================
 # ------------------------------------------------------------
 
-class ManualIndex:
+def _index_params() -> Dict[str, Any]:
+    """parameter ที่ถ้าเปลี่ยนแล้ว embedding เดิมใช้ต่อไม่ได้ -> ต้อง rebuild ทั้งหมด"""
+    return {
+        "embed_model": EMBED_MODEL_NAME,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "dedup_near_threshold": DEDUP_NEAR_THRESHOLD,
+        "boilerplate_fraction": BOILERPLATE_PAGE_FRACTION,
+        "bm25_tokenizer": BM25_TOKENIZER_VERSION,
+    }
+
+
+def _file_fingerprint(pdf_path: Path, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    sha256 ของไฟล์ PDF (+ size/mtime)
+    ถ้า size/mtime ตรงกับ manifest เดิม ใช้ hash เดิมได้เลย ไม่ต้องอ่านไฟล์ซ้ำ
+    """
+    stat = pdf_path.stat()
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        return {"sha256": previous["sha256"], "size": stat.st_size, "mtime": stat.st_mtime}
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return {"sha256": h.hexdigest(), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """Worker ของ process pool: extract text หน้า [start, end) ของ PDF หนึ่งไฟล์"""
+    from pypdf import PdfReader
+
+    reader = PdfReader(pdf_path)
+    pages: List[Tuple[int, str]] = []
+    for page_idx in range(start, end):
+        try:
+            raw_text = reader.pages[page_idx].extract_text() or ""
+        except Exception as e:
+            # หน้าเสียหน้าเดียวไม่ควรทำให้ทั้ง manual (และทั้ง build) ล้ม
+            print(f"[RAG] WARNING: cannot extract {Path(pdf_path).name} page {page_idx + 1}: {e!r}")
+            raw_text = ""
+        pages.append((page_idx, raw_text.strip()))
+    return pages
+
+
+_worker_model = None
+
+
+def _encode_worker_init(backend: str, threads: int):
+    """initializer ของ encoder process: จำกัด thread ก่อน import runtime แล้วโหลด model ครั้งเดียว"""
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    global _worker_model
+    _worker_model = load_embedder(backend, threads=threads)
+
+
+def _encode_worker(texts: List[str], batch_size: int) -> np.ndarray:
+    return _worker_model.encode(texts, batch_size=batch_size)
+
+
+def _pdf_stats(pdf_dir: Path) -> Dict[str, Tuple[int, float]]:
+    """(size, mtime) ของทุก PDF ใน pdf_dir"""
+    stats = {}
+    for pdf_path in pdf_dir.glob("*.pdf"):
+        st = pdf_path.stat()
+        stats[pdf_path.name] = (st.st_size, st.st_mtime)
+    return stats
+
+
+def _current_index_dir() -> Path:
+    """
+    version dir ที่ INDEX_DIR/CURRENT ชี้อยู่ (ดู _IndexWriter.finalize)
+    index layout เดิมที่ไฟล์อยู่ใน INDEX_DIR ตรง ๆ (ไม่มี CURRENT) -> INDEX_DIR
+    """
+    try:
+        name = (INDEX_DIR / _IndexWriter.CURRENT).read_text(encoding="utf-8").strip()
+    except OSError:
+        return INDEX_DIR
+    return INDEX_DIR / name
+
+
+def _load_manifest() -> Optional[Dict[str, Any]]:
+    path = _current_index_dir() / MANIFEST_NAME
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        print(f"[RAG] WARNING: cannot read manifest {path}: {e}")
+        return None
+
+
+def _write_manifest(manuals: Dict[str, Dict[str, Any]], path: Optional[Path] = None):
+    manifest = {"params": _index_params(), "manuals": manuals}
+    (path or _current_index_dir() / MANIFEST_NAME).write_text(
+        json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8"
+    )
+
+
+# INDEX_DIR/CURRENT = ชื่อ version dir ที่ใช้งานอยู่ (INDEX_DIR/v-<index id>), ไฟล์ใน version dir
+# (ทุกไฟล์เป็น raw binary เปิดด้วย np.memmap, ไม่มี pickle):
+#   index.json        header: rows, dim, embedding dtype, ชื่อ manual
+#   embeddings.bin    (rows, dim) embedding matrix (L2-normalized -> cosine = dot product)
+#   manual_ids.i32    (rows,) index ไปยัง header["manuals"]
+#   pages.i32         (rows,) เลขหน้า (1-based)
+#   text_offsets.i64  (rows + 1,) offset ของแต่ละ chunk ใน texts.bin
+#   texts.bin         UTF-8 ของทุก chunk ต่อกัน
+#   text_hashes.u64   (rows,) hash ของข้อความที่ normalize แล้ว (ใช้ตัดผลซ้ำตอน search)
+#   dup_offsets.i64   (rows + 1,) + dup_pages.i32: หน้าอื่น (manual เดียวกัน) ที่ chunk ถูก dedup มาที่ row นี้
+#   manifest.json     per-manual fingerprints (ดู _write_manifest)
+#   warm_results.json ผล search ของ defect vocabulary ที่ precompute ไว้ (ดู warm_cache)
+#   embeddings.f16    (rows, dim) float16 copy สำหรับ quantized scan
+#   embeddings.i8     (rows, dim) int8 copy + scales_i8.f32 (rows,) scale ต่อ vector
+#   bm25_*            lexical inverted index (ดู _build_bm25)
+#   ivf_*             (optional) approximate search index (ดู _build_ivf)
+INDEX_FORMAT_VERSION = 3   # v2: embeddings ถูก L2-normalize ตอน build แล้ว, v3: text_hashes + dup_*
+INDEX_EMBED_DTYPE = "float32"
+_INDEX_COLUMNS = {
+    "manual_ids": ("manual_ids.i32", np.int32),
+    "pages": ("pages.i32", np.int32),
+    "text_offsets": ("text_offsets.i64", np.int64),
+    "text_hashes": ("text_hashes.u64", np.uint64),
+}
+
+
+def _l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _write_quantized(index_dir: Path, rows: int, dim: int, dtype: str):
+    """เขียน float16 และ int8 (scale ต่อ vector = max|x| / 127) จาก embeddings.bin ทีละ block"""
+    embeddings = np.memmap(index_dir / "embeddings.bin", dtype=dtype, mode="r", shape=(rows, dim))
+    with open(index_dir / "embeddings.f16", "wb") as f16, \
+            open(index_dir / "embeddings.i8", "wb") as i8, \
+            open(index_dir / "scales_i8.f32", "wb") as sc:
+        for lo in range(0, rows, SCAN_BLOCK_ROWS):
+            block = np.asarray(embeddings[lo:lo + SCAN_BLOCK_ROWS], dtype=np.float32)
+            block.astype(np.float16).tofile(f16)
+            scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127.0
+            np.clip(np.rint(block / scales[:, None]), -127, 127).astype(np.int8).tofile(i8)
+            scales.astype(np.float32).tofile(sc)
+
+
+# ---------- Boilerplate / duplicate chunks ----------
+# manual จาก vendor มี header, footer, safety notice, revision table ซ้ำทุกหน้า
+# 1) ตัดบรรทัดที่ซ้ำในหน้าส่วนใหญ่ของ manual ทิ้งก่อน chunk (_strip_boilerplate)
+# 2) chunk ที่ยังซ้ำ (exact / near-duplicate) ภายใน manual เดียวกันไม่ถูก embed ซ้ำ (_ChunkDeduper)
+#    dedup เฉพาะภายใน manual เพื่อให้ row ของแต่ละ manual ยังเป็นช่วงต่อเนื่องที่ incremental update คัดลอกได้
+# 3) ตอน search ผลที่ข้อความตรงกันข้าม manual ถูกตัดด้วย text_hashes (_to_sources)
+
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _boilerplate_key(line: str) -> str:
+    return _DIGITS_RE.sub("#", " ".join(line.split()).lower())
+
+
+def _strip_boilerplate(pages: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+    """ตัดบรรทัดที่ (หลังแทนตัวเลขด้วย #) อยู่ในหน้าส่วนใหญ่ของ manual ออก เช่น header/footer/เลขหน้า"""
+    min_pages = max(BOILERPLATE_MIN_PAGES, int(np.ceil(BOILERPLATE_PAGE_FRACTION * len(pages))))
+    if BOILERPLATE_PAGE_FRACTION <= 0 or len(pages) < min_pages:
+        return pages
+    counts: Dict[str, int] = {}
+    for _, text in pages:
+        for key in {_boilerplate_key(line) for line in text.splitlines()}:
+            counts[key] = counts.get(key, 0) + 1
+    boilerplate = {key for key, n in counts.items() if key and n >= min_pages}
+    if not boilerplate:
+        return pages
+    return [
+        (page_idx, "\n".join(line for line in text.splitlines() if _boilerplate_key(line) not in boilerplate))
+        for page_idx, text in pages
+    ]
+
+
+def _text_hash(text: str) -> int:
+    """hash 64-bit ของข้อความที่ normalize แล้ว (lowercase + whitespace เดียว)"""
+    digest = hashlib.blake2b(" ".join(text.lower().split()).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+_MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.RandomState(20240611)   # seed คงที่ -> signature เหมือนกันทุก build
+_MINHASH_A = _minhash_rng.randint(1, _MINHASH_PRIME, MINHASH_PERMUTATIONS).astype(np.uint64)
+_MINHASH_B = _minhash_rng.randint(0, _MINHASH_PRIME, MINHASH_PERMUTATIONS).astype(np.uint64)
+
+
+def _minhash(text: str) -> Optional[np.ndarray]:
+    """MinHash signature ของ word shingle; None ถ้าข้อความสั้นเกินกว่าจะประมาณ Jaccard ได้"""
+    words = text.lower().split()
+    n = len(words) - SHINGLE_WORDS + 1
+    if n < 2 * SHINGLE_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(n)}
+    x = np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    # (a * x + b) mod p: a < 2^31, x < 2^32 -> ไม่ overflow uint64
+    return ((_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+
+class _ChunkDeduper:
+    """
+    ตรวจ chunk ซ้ำภายใน manual หนึ่ง
+    exact: hash ของข้อความ normalize แล้ว, near: MinHash + LSH banding แล้วยืนยันด้วย Jaccard โดยประมาณ
+    """
+
+    def __init__(self, threshold: float = DEDUP_NEAR_THRESHOLD):
+        self.threshold = threshold
+        self.unique = 0
+        self.exact = 0
+        self.near = 0
+        self._exact: Dict[int, int] = {}
+        self._bands: Dict[Tuple[int, bytes], List[int]] = {}
+        self._signatures: Dict[int, np.ndarray] = {}
+
+    def add(self, text: str) -> Tuple[int, bool]:
+        """คืนค่า (ลำดับของ chunk ตัวแทนใน manual นี้, เป็น chunk ใหม่หรือไม่)"""
+        key = _text_hash(text)
+        if key in self._exact:
+            self.exact += 1
+            return self._exact[key], False
+
+        sig = _minhash(text) if self.threshold < 1.0 else None
+        if sig is not None:
+            bands = [(b, sig[b::MINHASH_BANDS].tobytes()) for b in range(MINHASH_BANDS)]
+            seen = set()
+            for band in bands:
+                for cand in self._bands.get(band, ()):
+                    if cand in seen:
+                        continue
+                    seen.add(cand)
+                    if float(np.mean(self._signatures[cand] == sig)) >= self.threshold:
+                        self.near += 1
+                        return cand, False
+
+        idx = self.unique
+        self.unique += 1
+        self._exact[key] = idx
+        if sig is not None:
+            self._signatures[idx] = sig
+            for band in bands:
+                self._bands.setdefault(band, []).append(idx)
+        return idx, True
+
+
+# ---------- Approximate nearest-neighbor (IVF) ----------
+# Inverted-file index: spherical k-means แบ่ง embeddings เป็น nlist กลุ่ม
+# ตอน search ให้คะแนน centroid ก่อน แล้ว scan เฉพาะ nprobe กลุ่มที่ใกล้ที่สุด
+# ไฟล์เพิ่มใน INDEX_DIR: ivf_centroids.bin (nlist, dim) float32,
+#   ivf_offsets.i64 (nlist + 1,), ivf_rows.i32 (rows,) row id เรียงตามกลุ่ม
+
+IVF_BLOCK_ROWS = 8192   # row ต่อ block ตอนคำนวณ similarity กับ centroid (block x nlist float32)
+
+
+def _assign_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """centroid ที่ใกล้ที่สุดของทุก row; คูณทีละ IVF_BLOCK_ROWS row ไม่สร้าง matrix (rows, nlist) ทั้งก้อน"""
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for lo in range(0, len(vectors), IVF_BLOCK_ROWS):
+        block = np.asarray(vectors[lo:lo + IVF_BLOCK_ROWS], dtype=np.float32)
+        assign[lo:lo + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def _build_ivf(
+    index_dir: Path, rows: int, dim: int, dtype: str,
+    nlist: Optional[int] = None, iters: int = 10, seed: int = 0,
+) -> Dict[str, Any]:
+    t0 = time.time()
+    embeddings = np.memmap(index_dir / "embeddings.bin", dtype=dtype, mode="r", shape=(rows, dim))
+    nlist = nlist or int(4 * np.sqrt(rows))
+    nlist = max(1, min(nlist, rows))
+    rng = np.random.default_rng(seed)
+
+    # train บน sample (ไม่ต้องโหลดทั้ง matrix)
+    sample_idx = np.sort(rng.choice(rows, size=min(rows, nlist * 64), replace=False))
+    sample = np.asarray(embeddings[sample_idx], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign_centroids(sample, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        for lo in range(0, len(sample), IVF_BLOCK_ROWS):
+            block_assign = assign[lo:lo + IVF_BLOCK_ROWS]
+            order = np.argsort(block_assign, kind="stable")
+            groups, starts = np.unique(block_assign[order], return_index=True)
+            sums[groups] += np.add.reduceat(sample[lo:lo + IVF_BLOCK_ROWS][order], starts, axis=0)
+        empty = counts == 0
+        if empty.any():  # กลุ่มว่าง -> สุ่มจุดใหม่
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = _l2_normalize(sums)
+
+    assign = _assign_centroids(embeddings, centroids)
+    list_rows = np.argsort(assign, kind="stable").astype(np.int32)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+    centroids.astype(np.float32).tofile(index_dir / "ivf_centroids.bin")
+    offsets.tofile(index_dir / "ivf_offsets.i64")
+    list_rows.tofile(index_dir / "ivf_rows.i32")
+    print(f"[RAG] IVF index built: nlist={nlist} over {rows} rows in {time.time() - t0:.1f}s")
+    return {"nlist": nlist}
+
+
+class _IVFIndex:
+    def __init__(self, index_dir: Path, nlist: int, dim: int):
+        self.centroids = np.fromfile(index_dir / "ivf_centroids.bin", dtype=np.float32).reshape(nlist, dim)
+        self.offsets = np.memmap(index_dir / "ivf_offsets.i64", dtype=np.int64, mode="r")
+        self.rows = np.memmap(index_dir / "ivf_rows.i32", dtype=np.int32, mode="r")
+        self.nlist = nlist
+
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        """row id ของทุก chunk ใน nprobe กลุ่มที่ centroid ใกล้ q ที่สุด (เรียงตาม row เพื่อ locality)"""
+        nprobe = min(nprobe, self.nlist)
+        centroid_scores = self.centroids @ q
+        lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.rows[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+        return np.sort(rows)
+
+
+def _ann_enabled(rows: int) -> bool:
+    if ANN_MODE == "ivf":
+        return True
+    return ANN_MODE == "auto" and rows >= ANN_MIN_ROWS
+
+
+# ---------- Lexical (BM25) inverted index ----------
+# สำหรับ part number / error code / ค่า torque ที่ dense embedding จับได้ไม่ดี
+# ไฟล์เพิ่มใน INDEX_DIR (posting list แบบ CSR):
+#   bm25_terms.txt     term เรียงตามตัวอักษร คั่นด้วย "\n" (term id = ลำดับบรรทัด)
+#   bm25_offsets.i64   (terms + 1,) ช่วงของแต่ละ term ใน postings
+#   bm25_docs.i32      row id ของ posting ทั้งหมด
+#   bm25_tfs.u16       term frequency คู่กับ bm25_docs
+#   bm25_doclen.i32    (rows,) จำนวน token ต่อ chunk
+
+# ตัวอักษรของ token = \w ทุกภาษา + combining mark (สระบน/ล่าง + วรรณยุกต์ไทย, accent) ที่ \w ไม่นับ
+# -> คำไทยไม่ถูกตัดกลางคำ; "_" แปลงเป็นช่องว่างก่อน (oil_leak -> oil, leak)
+_TOKEN_CHAR = r"[\w\u0300-\u036f\u0e31\u0e34-\u0e3a\u0e47-\u0e4e]"
+_TOKEN_RE = re.compile(rf"{_TOKEN_CHAR}+(?:[.\-]{_TOKEN_CHAR}+)*")
+BM25_TOKENIZER_VERSION = 2   # v2: Unicode (เดิม ASCII อย่างเดียว ข้อความไทยหายจาก BM25)
+BM25_BUILD_BLOCK_ROWS = 4096
+
+
+def _tokenize(text: str) -> List[str]:
+    """lowercase + เก็บ token แบบ part number ไว้ทั้งก้อน เช่น "6204-2rs", "m8x1.25", "e-04" """
+    return _TOKEN_RE.findall(text.lower().replace("_", " "))
+
+
+def _is_exact_token_query(query: str, vocabulary: Container[str]) -> bool:
+    """
+    query ที่มี token ผสมตัวเลข (part number, error code, torque) ที่มีอยู่ใน index -> ตอบด้วย lexical อย่างเดียวได้
+    code ที่ไม่มีใน index (พิมพ์ผิด, รุ่นอื่น) ไม่นับ -> fuse กับ dense ตามปกติ
+    """
+    return any(tok in vocabulary for tok in _tokenize(query) if any(ch.isdigit() for ch in tok))
+
+
+class _TermIds(dict):
+    """term -> id ตามลำดับที่เจอครั้งแรก (map(vocab.__getitem__, tokens) ทำงานใน C ทั้งหมด)"""
+
+    def __missing__(self, term: str) -> int:
+        term_id = self[term] = len(self)
+        return term_id
+
+
+def _build_bm25(index_dir: Path, rows: int) -> Dict[str, Any]:
+    """
+    สร้าง posting list แบบ CSR ด้วย numpy: tokenize ทีละ row -> term id แล้วนับ tf ด้วย np.unique
+    ทีละ BM25_BUILD_BLOCK_ROWS row; เก็บ ~10 byte ต่อ (term, row) ไม่มี list/tuple ต่อ posting
+    """
+    offsets = np.fromfile(index_dir / "text_offsets.i64", dtype=np.int64)
+    blob = np.memmap(index_dir / "texts.bin", dtype=np.uint8, mode="r")
+    vocab = _TermIds()
+    doclen = np.empty(rows, dtype=np.int32)
+    blocks: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []   # (term id, row, tf) ต่อบล็อก
+    for lo in range(0, rows, BM25_BUILD_BLOCK_ROWS):
+        hi = min(lo + BM25_BUILD_BLOCK_ROWS, rows)
+        ids: List[int] = []
+        for row in range(lo, hi):
+            tokens = _tokenize(blob[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8"))
+            doclen[row] = len(tokens)
+            ids.extend(map(vocab.__getitem__, tokens))
+        # key = row ในบล็อก << 32 | term id -> np.unique ได้ (row, term) ไม่ซ้ำพร้อม tf
+        block_rows = np.repeat(np.arange(hi - lo, dtype=np.int64), doclen[lo:hi])
+        keys, tf = np.unique((block_rows << 32) | np.asarray(ids, dtype=np.int64), return_counts=True)
+        blocks.append((
+            (keys & 0xFFFFFFFF).astype(np.int32),
+            ((keys >> 32) + lo).astype(np.int32),
+            np.minimum(tf, 65535).astype(np.uint16),
+        ))
+
+    # term id ตามลำดับที่เจอ -> ลำดับตัวอักษร (= บรรทัดใน bm25_terms.txt)
+    terms = sorted(vocab)
+    rank = np.empty(len(terms), dtype=np.int32)
+    rank[np.fromiter((vocab[t] for t in terms), dtype=np.int64, count=len(terms))] = np.arange(len(terms))
+    counts = np.zeros(len(terms), dtype=np.int64)
+    for i, (term_ids, block_docs, block_tfs) in enumerate(blocks):
+        term_ids = rank[term_ids]
+        blocks[i] = (term_ids, block_docs, block_tfs)
+        counts += np.bincount(term_ids, minlength=len(terms))
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum(counts)
+
+    # กระจายทีละบล็อกลงตำแหน่งของแต่ละ term (บล็อกเรียงตาม row -> row ใน posting เรียงจากน้อยไปมาก)
+    docs = np.empty(term_offsets[-1], dtype=np.int32)
+    tfs = np.empty(term_offsets[-1], dtype=np.uint16)
+    cursor = term_offsets[:-1].copy()
+    while blocks:
+        term_ids, block_docs, block_tfs = blocks.pop(0)
+        order = np.argsort(term_ids, kind="stable")
+        sorted_ids = term_ids[order]
+        within = np.arange(len(sorted_ids)) - np.searchsorted(sorted_ids, sorted_ids)
+        pos = cursor[sorted_ids] + within
+        docs[pos] = block_docs[order]
+        tfs[pos] = block_tfs[order]
+        cursor += np.bincount(sorted_ids, minlength=len(terms))
+
+    (index_dir / "bm25_terms.txt").write_text("\n".join(terms), encoding="utf-8")
+    term_offsets.tofile(index_dir / "bm25_offsets.i64")
+    docs.tofile(index_dir / "bm25_docs.i32")
+    tfs.tofile(index_dir / "bm25_tfs.u16")
+    doclen.tofile(index_dir / "bm25_doclen.i32")
+    return {"terms": len(terms), "avgdl": float(doclen.mean()) if rows else 0.0}
+
+
+class _BM25Index:
+    def __init__(self, index_dir: Path, avgdl: float, k1: float = BM25_K1, b: float = BM25_B):
+        terms = (index_dir / "bm25_terms.txt").read_text(encoding="utf-8").split("\n")
+        self.term_ids = {term: i for i, term in enumerate(terms) if term}
+        self.offsets = np.memmap(index_dir / "bm25_offsets.i64", dtype=np.int64, mode="r")
+        self.docs = np.memmap(index_dir / "bm25_docs.i32", dtype=np.int32, mode="r")
+        self.tfs = np.memmap(index_dir / "bm25_tfs.u16", dtype=np.uint16, mode="r")
+        self.doclen = np.memmap(index_dir / "bm25_doclen.i32", dtype=np.int32, mode="r")
+        self.avgdl = max(avgdl, 1e-9)
+        self.k1 = k1
+        self.b = b
+
+    def _idf(self, df: int) -> float:
+        return float(np.log(1.0 + (len(self.doclen) - df + 0.5) / (df + 0.5)))
+
+    def max_score(self, query: str) -> float:
+        """ขอบบนของ BM25 สำหรับ query นี้ (ทุก term ที่อยู่ใน index, tf -> อนันต์) = sum idf * (k1 + 1)"""
+        total = 0.0
+        for tok in set(_tokenize(query)):
+            term_id = self.term_ids.get(tok)
+            if term_id is not None:
+                total += self._idf(int(self.offsets[term_id + 1] - self.offsets[term_id])) * (self.k1 + 1.0)
+        return total
+
+    def scores(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 ของทุก row ที่มี query term อย่างน้อยหนึ่งตัว -> (rows, scores) แบบ sparse"""
+        doc_parts, weight_parts = [], []
+        for tok in set(_tokenize(query)):
+            term_id = self.term_ids.get(tok)
+            if term_id is None:
+                continue
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = np.asarray(self.docs[lo:hi])
+            tf = np.asarray(self.tfs[lo:hi], dtype=np.float32)
+            idf = self._idf(len(docs))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doclen[docs] / self.avgdl)
+            doc_parts.append(docs)
+            weight_parts.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+        if not doc_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        docs = np.concatenate(doc_parts)
+        weights = np.concatenate(weight_parts)
+        order = np.argsort(docs, kind="stable")
+        rows, starts = np.unique(docs[order], return_index=True)
+        return rows.astype(np.int64), np.add.reduceat(weights[order], starts).astype(np.float32)
+
+
+class _IndexWriter:
+    """
+    Append-only writer ของ index format ใน INDEX_DIR
+    เขียนลง staging dir ทีละ batch (ไม่ต้องถือทั้ง matrix ใน RAM)
+    แล้ว finalize() ย้ายเป็น version dir ใหม่ INDEX_DIR/v-<id> และสลับ INDEX_DIR/CURRENT มาชี้
+
+    ไม่มีการ rename/ลบ dir ที่ process อื่น (หรือ index ที่ยัง serve อยู่) memmap ไว้
+    -> ใช้ได้บน Windows ที่ลบ/ย้ายไฟล์ที่ถูก map อยู่ไม่ได้; version เก่าถูกลบทีหลัง (prune)
+
+    checkpoint() บันทึกขนาดไฟล์ + manual ที่เขียนเสร็จลง checkpoint.json ใน staging dir
+    ถ้า build ตาย กลางทาง writer ตัวถัดไป (resume=True) ตัดไฟล์กลับไปที่ checkpoint ล่าสุดแล้วเขียนต่อ
+    """
+
+    CHECKPOINT = "checkpoint.json"
+    DUPS = "dup_pairs.i64"   # (row, page) ที่ยังไม่ได้จัดเป็น CSR; ลบทิ้งตอน finalize
+    CURRENT = "CURRENT"      # ชื่อ version dir ที่ใช้งานอยู่ใน INDEX_DIR
+
+    def __init__(self, index_dir: Path, resume: bool = True):
+        self.index_dir = index_dir
+        self.stage_dir = index_dir.with_name(index_dir.name + ".build")
+        state = self._read_checkpoint() if resume else None
+        if state is None:
+            self._start_fresh()
+        else:
+            self._reopen(state)
+
+    def _files(self) -> Dict[str, Any]:
+        return {"embeddings.bin": self._emb_f, "texts.bin": self._text_f, self.DUPS: self._dup_f,
+                **{_INDEX_COLUMNS[col][0]: f for col, f in self._col_f.items()}}
+
+    def _open_files(self, mode: str):
+        self._emb_f = open(self.stage_dir / "embeddings.bin", mode)
+        self._text_f = open(self.stage_dir / "texts.bin", mode)
+        self._dup_f = open(self.stage_dir / self.DUPS, mode)
+        self._col_f = {
+            col: open(self.stage_dir / filename, mode)
+            for col, (filename, _) in _INDEX_COLUMNS.items()
+        }
+
+    def _start_fresh(self):
+        if self.stage_dir.exists():
+            shutil.rmtree(self.stage_dir)
+        self.stage_dir.mkdir(parents=True)
+        self._open_files("wb")
+        np.zeros(1, dtype=np.int64).tofile(self._col_f["text_offsets"])
+        self.manual_names: List[str] = []
+        self._manual_ids: Dict[str, int] = {}
+        self.rows = 0
+        self.text_bytes = 0
+        self.dim: Optional[int] = None
+        self.completed: Dict[str, Dict[str, Any]] = {}   # manifest entry ของ manual ที่เขียนเสร็จแล้ว
+        self.partial: Optional[Dict[str, Any]] = None     # manual ที่เขียนค้างไว้ (name, sha256, chunk_start)
+
+    def _read_checkpoint(self) -> Optional[Dict[str, Any]]:
+        """checkpoint ที่ใช้ต่อได้ (params ตรง และทุกไฟล์ยาวอย่างน้อยเท่าที่บันทึกไว้) หรือ None"""
+        try:
+            state = json.loads((self.stage_dir / self.CHECKPOINT).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if state.get("format") != INDEX_FORMAT_VERSION or state.get("params") != _index_params():
+            return None
+        for filename, size in state["sizes"].items():
+            path = self.stage_dir / filename
+            if not path.exists() or path.stat().st_size < size:
+                return None
+        return state
+
+    def _reopen(self, state: Dict[str, Any]):
+        for filename, size in state["sizes"].items():
+            os.truncate(self.stage_dir / filename, size)   # ตัดส่วนที่เขียนหลัง checkpoint ทิ้ง
+        self._open_files("ab")
+        self.manual_names = list(state["manual_names"])
+        self._manual_ids = {name: i for i, name in enumerate(self.manual_names)}
+        self.rows = state["rows"]
+        self.text_bytes = state["text_bytes"]
+        self.dim = state["dim"]
+        self.completed = state["completed"]
+        self.partial = state["partial"]
+        print(
+            f"[RAG] Resuming build from checkpoint: {len(self.completed)} manuals done, "
+            f"{self.rows} chunks written" + (f", {self.partial['name']} in progress" if self.partial else "")
+        )
+
+    def reset(self):
+        """ทิ้ง checkpoint แล้วเริ่มใหม่ (manual/PDF เปลี่ยนไปจากตอนที่ checkpoint)"""
+        self._close()
+        self._start_fresh()
+
+    def checkpoint(self, completed: Dict[str, Dict[str, Any]], partial: Optional[Dict[str, Any]] = None):
+        """flush ทุกไฟล์แล้วบันทึกตำแหน่งปัจจุบัน (เขียนไฟล์ใหม่แล้ว os.replace -> ไม่มี checkpoint ครึ่งๆ)"""
+        sizes = {}
+        for filename, f in self._files().items():
+            f.flush()
+            sizes[filename] = f.tell()
+        self.completed = dict(completed)
+        self.partial = partial
+        state = {
+            "format": INDEX_FORMAT_VERSION,
+            "params": _index_params(),
+            "sizes": sizes,
+            "manual_names": self.manual_names,
+            "rows": self.rows,
+            "text_bytes": self.text_bytes,
+            "dim": self.dim,
+            "completed": self.completed,
+            "partial": partial,
+        }
+        tmp = self.stage_dir / (self.CHECKPOINT + ".tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.stage_dir / self.CHECKPOINT)
+
+    def add_duplicate(self, row: int, page: int):
+        """บันทึกว่า chunk บนหน้า page (manual เดียวกับ row) ถูก dedup มาที่ row"""
+        np.asarray([row, page], dtype=np.int64).tofile(self._dup_f)
+
+    def append(self, embeddings: np.ndarray, texts: List[str], meta: List[Dict[str, Any]]):
+        embeddings = np.ascontiguousarray(_l2_normalize(embeddings), dtype=INDEX_EMBED_DTYPE)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        embeddings.tofile(self._emb_f)
+
+        encoded = [text.encode("utf-8") for text in texts]
+        self._text_f.write(b"".join(encoded))
+        offsets = self.text_bytes + np.cumsum([len(e) for e in encoded], dtype=np.int64)
+        offsets.tofile(self._col_f["text_offsets"])
+        self.text_bytes = int(offsets[-1]) if len(offsets) else self.text_bytes
+
+        manual_ids = []
+        for m in meta:
+            name = m["manual_name"]
+            if name not in self._manual_ids:
+                self._manual_ids[name] = len(self.manual_names)
+                self.manual_names.append(name)
+            manual_ids.append(self._manual_ids[name])
+        np.asarray(manual_ids, dtype=np.int32).tofile(self._col_f["manual_ids"])
+        np.asarray([m["page"] for m in meta], dtype=np.int32).tofile(self._col_f["pages"])
+        np.asarray([_text_hash(text) for text in texts], dtype=np.uint64).tofile(self._col_f["text_hashes"])
+        for i, m in enumerate(meta):
+            for page in m.get("dup_pages", ()):
+                self.add_duplicate(self.rows + i, page)
+        self.rows += len(texts)
+
+    def _write_duplicates(self) -> int:
+        """เขียน mapping row -> หน้าที่ซ้ำ แบบ CSR (dup_offsets.i64, dup_pages.i32); คืนจำนวนคู่"""
+        pairs_path = self.stage_dir / self.DUPS
+        dups = np.fromfile(pairs_path, dtype=np.int64).reshape(-1, 2)
+        dups = np.unique(dups, axis=0) if len(dups) else dups   # เรียงตาม (row, page) + ตัดคู่ที่บันทึกซ้ำตอน resume
+        counts = np.bincount(dups[:, 0], minlength=self.rows)
+        np.concatenate([[0], np.cumsum(counts)]).astype(np.int64).tofile(self.stage_dir / "dup_offsets.i64")
+        dups[:, 1].astype(np.int32).tofile(self.stage_dir / "dup_pages.i32")
+        pairs_path.unlink()
+        return len(dups)
+
+    def _close(self):
+        for f in self._files().values():
+            f.close()
+
+    def finalize(self, manuals: Dict[str, Dict[str, Any]]) -> bool:
+        """เขียน header + manifest แล้วสลับ staging dir เข้าแทน index เดิม; คืนค่า False ถ้าไม่มี row เลย"""
+        self._close()
+        if self.rows == 0:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+            return False
+        (self.stage_dir / self.CHECKPOINT).unlink(missing_ok=True)
+        header = {
+            "format": INDEX_FORMAT_VERSION,
+            "id": uuid.uuid4().hex,
+            "rows": self.rows,
+            "dim": self.dim,
+            "dtype": INDEX_EMBED_DTYPE,
+            "manuals": self.manual_names,
+            "duplicates": self._write_duplicates(),
+        }
+        _write_quantized(self.stage_dir, self.rows, self.dim, INDEX_EMBED_DTYPE)
+        header["quantized"] = ["float16", "int8"]
+        header["bm25"] = _build_bm25(self.stage_dir, self.rows)
+        if _ann_enabled(self.rows):
+            header["ivf"] = _build_ivf(self.stage_dir, self.rows, self.dim, INDEX_EMBED_DTYPE)
+        (self.stage_dir / "index.json").write_text(json.dumps(header, ensure_ascii=False), encoding="utf-8")
+        _write_manifest(manuals, path=self.stage_dir / MANIFEST_NAME)
+
+        # ย้ายเฉพาะ staging dir (ไม่มีใคร map) แล้วสลับ pointer แบบ atomic; index เดิมยัง serve จาก dir ของมันต่อได้
+        version = f"v-{header['id']}"
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        os.replace(self.stage_dir, self.index_dir / version)
+        self._set_current(self.index_dir, version)
+        self.prune(self.index_dir)
+        return True
+
+    @classmethod
+    def _set_current(cls, index_dir: Path, version: Optional[str]):
+        pointer = index_dir / cls.CURRENT
+        if version is None:
+            pointer.unlink(missing_ok=True)
+            return
+        tmp = index_dir / (cls.CURRENT + ".tmp")
+        tmp.write_text(version, encoding="utf-8")
+        os.replace(tmp, pointer)
+
+    @classmethod
+    def prune(cls, index_dir: Path):
+        """
+        ลบทุกอย่างใน index_dir ยกเว้น CURRENT + version ที่ชี้อยู่ (version เก่า, ไฟล์ของ layout เดิม)
+        ไฟล์ที่ยังถูก map อยู่ (Windows) ลบไม่ได้ -> ข้ามไป แล้วลบตอน finalize ครั้งถัดไป
+        """
+        try:
+            current = (index_dir / cls.CURRENT).read_text(encoding="utf-8").strip()
+        except OSError:
+            current = None
+        for path in index_dir.iterdir():
+            if path.name in (cls.CURRENT, current):
+                continue
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except OSError as e:
+                print(f"[RAG] Old index file still in use, removing later: {path} ({e.__class__.__name__})")
+
+    @classmethod
+    def clear(cls, index_dir: Path):
+        """ไม่มี index แล้ว (ไม่มี text เลย): ยกเลิก CURRENT + ลบทุก version ที่ลบได้"""
+        if index_dir.exists():
+            cls._set_current(index_dir, None)
+            cls.prune(index_dir)
+
+    def abort(self):
+        """build ล้มกลางทาง: ปิดไฟล์แต่เก็บ staging dir + checkpoint ไว้ให้ build ครั้งถัดไป resume"""
+        self._close()
+        if (self.stage_dir / self.CHECKPOINT).exists():
+            print(f"[RAG] Build interrupted; progress kept in {self.stage_dir} (resumes on next build)")
+
+    def discard(self):
+        self._close()
+        shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+
+class _IndexLock:
+    """
+    Lock ข้าม process ของ INDEX_DIR (ไฟล์ <INDEX_DIR>.lock): uvicorn หลาย worker และ build_index.py
+    build/finalize/prune และการเปิด version ที่ CURRENT ชี้ ทีละ process
+    -> ไม่มีใคร resume หรือ rmtree staging dir ของ build ที่ยังรันอยู่ หรือ prune version ที่อีก process กำลังเปิด
+    reentrant ภายใน process (update_from_pdfs -> build_from_pdfs -> open_existing)
+    """
+
     def __init__(self):
-        self.texts: List[str] = []
-        self.meta: List[Dict[str, Any]] = []
-        self.model: Optional[SentenceTransformer] = None
-        self.nn: Optional[NearestNeighbors] = None
-        self.embeddings: Optional[np.ndarray] = None
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = self._acquire(INDEX_DIR.with_name(INDEX_DIR.name + ".lock"))
+            except BaseException:
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._release(self._file)
+            self._file = None
+        self._rlock.release()
+
+    @staticmethod
+    def _acquire(path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(path, "a+b")
+        try:
+            if os.name == "nt":
+                waited = False
+                while True:
+                    f.seek(0)
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not waited:
+                            print(f"[RAG] Another process is building the index; waiting for {path}")
+                            waited = True
+                        time.sleep(0.5)
+            else:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f"[RAG] Another process is building the index; waiting for {path}")
+                    fcntl.flock(f, fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    @staticmethod
+    def _release(f):
+        try:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
+index_lock = _IndexLock()
+
+
+# key ของ retrieval cache: (normalized query, top_k, index version, shard filter)
+_SearchKey = Tuple[str, int, int, Optional[Tuple[str, ...]]]
 
-    def build_from_pdfs(self, pdf_dir: Path):
-        print(f"[RAG] Building index from PDFs in {pdf_dir} ...")
-        self.texts = []
-        self.meta = []
-
-        for pdf_path in pdf_dir.glob("*.pdf"):
-            reader = PdfReader(str(pdf_path))
-            for page_idx, page in enumerate(reader.pages):
-                raw_text = page.extract_text() or ""
-                raw_text = raw_text.strip()
-                if not raw_text:
-                    continue
-                chunks = self._split_into_chunks(raw_text)
-                for chunk in chunks:
-                    self.texts.append(chunk)
-                    self.meta.append({
-                        "manual_name": pdf_path.name,
-                        "page": page_idx + 1,
-                    })
-
-        if not self.texts:
-            print("[RAG] WARNING: No text extracted from manuals.")
+
+class ManualIndex:
+    def __init__(
+        self,
+        cache_size: int = SEARCH_CACHE_SIZE,
+        extract_workers: int = EXTRACT_WORKERS,
+        nprobe: int = ANN_NPROBE,
+        quant: str = QUANT_MODE,
+        rescore_factor: int = RESCORE_FACTOR,
+        embed_workers: int = EMBED_WORKERS,
+    ):
+        self.extract_workers = extract_workers
+        self.nprobe = nprobe
+        self.quant = quant
+        self.rescore_factor = rescore_factor
+        # matrix ที่ใช้ scan ตอน search (= embeddings หรือ copy ที่ quantize แล้ว)
+        self._scan: Optional[np.ndarray] = None
+        self._scan_scales: Optional[np.ndarray] = None
+        self.ivf: Optional[_IVFIndex] = None
+        self.bm25: Optional[_BM25Index] = None
+        self.model: Optional[EmbeddingBackend] = None
+        self._model_lock = threading.Lock()
+        self.embed_workers = embed_workers
+        self._encoder_pool: Optional[ProcessPoolExecutor] = None
+        self.index_id: Optional[str] = None
+        self.index_path: Optional[Path] = None          # version dir ที่ memmap อยู่ (INDEX_DIR/v-<id>)
+        self.manuals: Dict[str, Dict[str, Any]] = {}   # manifest entry ต่อ manual (sha256, pages, ...)
+        # PDF ที่เปิดไม่ได้ตอน build ล่าสุด (เสีย / copy ยังไม่เสร็จ): {name: {size, mtime, error}}
+        # ไม่ถูก index และ is_stale() ไม่นับจนกว่าไฟล์จะเปลี่ยน
+        self.skipped: Dict[str, Dict[str, Any]] = {}
+        self.embeddings: Optional[np.ndarray] = None
+        # columnar metadata (memmap จาก index_path)
+        self.manual_names: List[str] = []
+        self.manual_ids: Optional[np.ndarray] = None
+        self.pages: Optional[np.ndarray] = None
+        self.text_offsets: Optional[np.ndarray] = None
+        self.text_hashes: Optional[np.ndarray] = None
+        self.dup_offsets: Optional[np.ndarray] = None
+        self.dup_pages: Optional[np.ndarray] = None
+        self._text_blob: Optional[np.ndarray] = None
+        # shard = ช่วง row ต่อเนื่องของ manual หนึ่ง; คำนวณเมื่อมี search แบบกรองครั้งแรก
+        self._shard_ranges: Optional[Dict[str, Tuple[int, int]]] = None
+
+        # retrieval cache: key = (normalized query, top_k, index version, shard filter)
+        # - _pinned: query ที่ pre-warm ไว้ (defect vocabulary) ไม่โดน evict
+        # - _lru: query อิสระ จำกัดขนาดด้วย LRU
+        self.version = 0
+        self.cache_size = cache_size
+        self._pinned: Dict[_SearchKey, List[RAGSource]] = {}
+        self._lru: "OrderedDict[_SearchKey, List[RAGSource]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # ---------- build / incremental update ----------
+
+    def _ensure_model(self):
+        with self._model_lock:
+            if self.model is None:
+                print(f"[RAG] Loading embedding model ({EMBED_BACKEND} backend)...")
+                self.model = load_embedder()
+
+    # ---------- streaming build pipeline ----------
+    # extract page -> chunk -> embed ทีละ batch -> append ลง _IndexWriter
+    # memory สูงสุดขึ้นกับ EMBED_BATCH_SIZE และจำนวน shard ที่รันค้าง ไม่ขึ้นกับขนาด corpus
+
+    def _iter_pages(
+        self, pdf_paths: List[Path], page_counts: Dict[str, int], shas: Dict[str, str]
+    ) -> Iterator[Tuple[int, str]]:
+        """
+        Yield (page_idx, text) ของทุกหน้า ตามลำดับ (manual, page)
+        shard ที่อยู่ใน page_text_cache ครบอ่านจาก cache (ไม่ต้อง parse PDF)
+        ที่เหลือ extract แบบขนานด้วย process pool โดยมี shard ค้างอยู่ไม่เกิน 2 x workers
+        """
+        if not pdf_paths:
             return
+        shards = [
+            (str(p), shas[p.name], start, min(start + EXTRACT_PAGES_PER_SHARD, page_counts[p.name]))
+            for p in pdf_paths
+            for start in range(0, page_counts[p.name], EXTRACT_PAGES_PER_SHARD)
+        ]
+        workers = max(1, min(self.extract_workers, len(shards)))
+        # spawn เหมือน encoder pool: extract รันใน server ที่มี thread อยู่แล้ว (warm-up / hot reload)
+        # fork จาก process ที่มี thread อื่นถือ lock อยู่อาจทำให้ worker ค้าง
+        pool = (
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            if workers > 1 else None
+        )
 
-        print("[RAG] Loading embedding model (sentence-transformers)...")
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
-        print(f"[RAG] Encoding {len(self.texts)} chunks ...")
-        self.embeddings = self.model.encode(self.texts, show_progress_bar=True)
+        def start(shard):
+            pdf_path, sha, lo, hi = shard
+            cached = page_text_cache.get_range(sha, lo, hi)
+            if cached is not None:
+                return sha, True, cached
+            if pool is None:
+                return sha, False, _extract_page_range(pdf_path, lo, hi)
+            return sha, False, pool.submit(_extract_page_range, pdf_path, lo, hi)
+
+        t0 = time.time()
+        n_pages = n_cached = 0
+        try:
+            pending: Deque[Tuple[str, bool, Any]] = deque()
+            shard_iter = iter(shards)
+            for shard in itertools.islice(shard_iter, 2 * workers):
+                pending.append(start(shard))
+            while pending:
+                sha, from_cache, result = pending.popleft()
+                pages = result.result() if isinstance(result, Future) else result
+                for shard in itertools.islice(shard_iter, 1):
+                    pending.append(start(shard))
+                if from_cache:
+                    n_cached += len(pages)
+                else:
+                    page_text_cache.put_pages(sha, pages)
+                n_pages += len(pages)
+                yield from pages
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        elapsed = max(time.time() - t0, 1e-9)
+        print(
+            f"[RAG] Extracted {n_pages} pages ({n_cached} from page cache) from {len(pdf_paths)} manuals "
+            f"with {workers} workers in {elapsed:.1f}s ({n_pages / elapsed:.1f} pages/s)"
+        )
 
-        self.nn = NearestNeighbors(
-            n_neighbors=5,
-            metric="cosine"
+    @staticmethod
+    def _page_count(pdf_path: Path, pdf_sha: str) -> int:
+        pages = page_text_cache.page_count(pdf_sha)
+        if pages is None:
+            from pypdf import PdfReader
+
+            pages = len(PdfReader(str(pdf_path)).pages)
+            page_text_cache.put_page_count(pdf_sha, pages)
+        return pages
+
+    def _iter_chunks(
+        self, manual_name: str, pages: Iterable[Tuple[int, str]]
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for page_idx, raw_text in pages:
+            if not raw_text:
+                continue
+            for chunk in self._split_into_chunks(raw_text):
+                yield chunk, {"manual_name": manual_name, "page": page_idx + 1}
+
+    def _iter_unique_chunks(
+        self,
+        writer: _IndexWriter,
+        start_row: int,
+        manual_name: str,
+        pages: List[Tuple[int, str]],
+        stats: Dict[str, int],
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Yield เฉพาะ chunk ที่ไม่ซ้ำกับ chunk ก่อนหน้าใน manual เดียวกัน
+        chunk ที่ซ้ำบันทึกเป็นหน้าเพิ่มของ row ตัวแทน (row = start_row + ลำดับ chunk ที่ไม่ซ้ำ)
+        """
+        deduper = _ChunkDeduper()
+        rep_pages: List[int] = []
+        for text, meta in self._iter_chunks(manual_name, pages):
+            stats["chunks"] += 1
+            idx, is_new = deduper.add(text)
+            if is_new:
+                rep_pages.append(meta["page"])
+                yield text, meta
+            elif meta["page"] != rep_pages[idx]:
+                writer.add_duplicate(start_row + idx, meta["page"])
+        stats["unique"] += deduper.unique
+        stats["exact"] += deduper.exact
+        stats["near"] += deduper.near
+
+    @staticmethod
+    def _iter_batches(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+        it = iter(items)
+        while True:
+            batch = list(itertools.islice(it, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    @staticmethod
+    def _check_resume(
+        writer: _IndexWriter, pdf_paths: List[Path], fingerprints: Dict[str, Dict[str, Any]]
+    ) -> int:
+        """
+        ตรวจว่า checkpoint ของ writer ตรงกับ build นี้: manual ที่เสร็จแล้วต้องเป็นช่วงต้นของ pdf_paths
+        (ชื่อ + sha256 ตรง) และ manual ที่ค้างต้องเป็นตัวถัดไป; ไม่ตรง -> เริ่มใหม่
+        คืนจำนวน manual ที่ข้ามได้
+        """
+        names = [p.name for p in pdf_paths]
+        done = list(writer.completed)
+        ok = names[:len(done)] == done and all(
+            writer.completed[n]["sha256"] == fingerprints[n]["sha256"] for n in done
         )
-        self.nn.fit(self.embeddings)
+        if ok and writer.partial is not None:
+            nxt = names[len(done)] if len(done) < len(names) else None
+            ok = nxt == writer.partial["name"] and fingerprints[nxt]["sha256"] == writer.partial["sha256"]
+        if not ok:
+            print("[RAG] Checkpoint does not match current manuals -> starting build from scratch")
+            writer.reset()
+            return 0
+        return len(done)
+
+    def _write_manuals(
+        self,
+        writer: _IndexWriter,
+        pdf_paths: List[Path],
+        fingerprints: Dict[str, Dict[str, Any]],
+        reuse: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        เขียน row ของทุก manual ลง writer ตามลำดับชื่อ
+        manual ที่อยู่ใน reuse (manifest entry เดิม) คัดลอก row เดิมจาก index ที่โหลดอยู่
+        ที่เหลือผ่าน pipeline extract -> chunk -> embed
+        checkpoint หลังทุก batch และทุก manual; ถ้า writer resume มา ข้ามส่วนที่เขียนไว้แล้ว
+        """
+        reuse = reuse or {}
+        n_done = 0
+        if writer.completed or writer.partial:
+            n_done = self._check_resume(writer, pdf_paths, fingerprints)
+        manuals: Dict[str, Dict[str, Any]] = dict(writer.completed)
+        partial = writer.partial
+        todo = pdf_paths[n_done:]
+        new_paths = [p for p in todo if p.name not in reuse]
+        shas = {p.name: fingerprints[p.name]["sha256"] for p in new_paths}
+        page_counts = {p.name: self._page_count(p, shas[p.name]) for p in new_paths}
+        page_stream = self._iter_pages(new_paths, page_counts, shas)
+        n_encoded = 0
+        dedup_stats = {"chunks": 0, "unique": 0, "exact": 0, "near": 0}
+        t0 = time.time()
+        cache_before = embedding_cache.stats()
+        try:
+            for n, pdf_path in enumerate(todo, start=n_done + 1):
+                name = pdf_path.name
+                t_manual = time.time()
+                start = writer.rows
+                if partial is not None and partial["name"] == name:
+                    start = partial["chunk_start"]
+                if name in reuse:
+                    old = reuse[name]
+                    first = old["chunk_start"] + (writer.rows - start)
+                    for lo in range(first, old["chunk_end"], EMBED_BATCH_SIZE):
+                        hi = min(lo + EMBED_BATCH_SIZE, old["chunk_end"])
+                        writer.append(
+                            self.embeddings[lo:hi],
+                            [self.text(i) for i in range(lo, hi)],
+                            [self.chunk_meta(i) for i in range(lo, hi)],
+                        )
+                    pages = old["pages"]
+                    how = "reused"
+                else:
+                    pages = page_counts[name]
+                    page_texts = _strip_boilerplate(list(itertools.islice(page_stream, pages)))
+                    chunks = self._iter_unique_chunks(writer, start, name, page_texts, dedup_stats)
+                    # resume กลาง manual: dedup ต้องเห็นทุก chunk แต่ไม่ encode ส่วนที่เขียนไว้แล้ว
+                    chunks = itertools.islice(chunks, writer.rows - start, None)
+                    batches = self._iter_batches(chunks, EMBED_BATCH_SIZE)
+                    last_report = time.time()
+                    checkpoint = {"name": name, "sha256": shas[name], "chunk_start": start}
+                    for emb, batch in self._iter_embedded(batches):
+                        writer.append(emb, [text for text, _ in batch], [m for _, m in batch])
+                        writer.checkpoint(manuals, checkpoint)
+                        n_encoded += len(batch)
+                        if time.time() - last_report >= BUILD_PROGRESS_INTERVAL:
+                            last_report = time.time()
+                            print(
+                                f"[RAG]   {name}: {writer.rows - start} chunks so far "
+                                f"({n_encoded / (last_report - t0):.1f} chunks/s overall)"
+                            )
+                    how = "embedded"
+                manuals[name] = {
+                    **fingerprints[name],
+                    "pages": pages,
+                    "chunk_start": start,
+                    "chunk_end": writer.rows,
+                }
+                writer.checkpoint(manuals)
+                print(
+                    f"[RAG] [{n}/{len(pdf_paths)}] {name}: {writer.rows - start} chunks {how} "
+                    f"in {time.time() - t_manual:.1f}s"
+                )
+            next(page_stream, None)  # ให้ generator จบเอง (ปิด pool + log throughput)
+        finally:
+            page_stream.close()
+            if self._encoder_pool is not None:
+                self._encoder_pool.shutdown(cancel_futures=True)
+                self._encoder_pool = None
+        if n_encoded:
+            elapsed = max(time.time() - t0, 1e-9)
+            stats = embedding_cache.stats()
+            print(
+                f"[RAG] Embedded {n_encoded} chunks in {elapsed:.1f}s ({n_encoded / elapsed:.1f} chunks/s); "
+                f"embedding cache hits={stats['hits'] - cache_before['hits']} "
+                f"misses={stats['misses'] - cache_before['misses']} "
+                f"({stats['bytes'] / 1e6:.1f}/{stats['max_bytes'] / 1e6:.0f} MB)"
+            )
+        if dedup_stats["chunks"]:
+            print(
+                f"[RAG] Dedup: {dedup_stats['chunks']} chunks -> {dedup_stats['unique']} rows "
+                f"(exact duplicates={dedup_stats['exact']}, near duplicates={dedup_stats['near']})"
+            )
+        return manuals
+
+    def _get_encoder_pool(self) -> Optional[ProcessPoolExecutor]:
+        """สร้าง encoder pool ตอนเจอ cache miss ครั้งแรก (ไม่ต้องโหลด model ถ้า hit ทั้งหมด)"""
+        if self.embed_workers <= 1:
+            return None
+        if self._encoder_pool is None:
+            print(
+                f"[RAG] Starting {self.embed_workers} encoder processes "
+                f"({EMBED_THREADS_PER_WORKER} threads each)"
+            )
+            # spawn: ไม่ fork process ที่ torch/OpenMP เริ่ม thread ไปแล้ว
+            self._encoder_pool = ProcessPoolExecutor(
+                max_workers=self.embed_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_encode_worker_init,
+                initargs=(EMBED_BACKEND, EMBED_THREADS_PER_WORKER),
+            )
+        return self._encoder_pool
+
+    def _embed_chunks_async(self, texts: List[str]) -> Callable[[], np.ndarray]:
+        """
+        embedding ของ chunk: ดูใน embedding_cache ก่อน แล้ว encode เฉพาะ chunk ที่ไม่เคยเห็น
+        (ใน encoder pool ถ้าเปิดไว้) ; คืน callable ที่รอผลแล้วคืน matrix ตามลำดับ texts
+        """
+        cached = embedding_cache.get_many(embedding_cache_key(), texts)
+        missing = [i for i, v in enumerate(cached) if v is None]
+        miss_texts = [texts[i] for i in missing]
+        pool = self._get_encoder_pool() if missing else None
+        future = pool.submit(_encode_worker, miss_texts, EMBED_ENCODE_BATCH) if pool else None
+
+        def finish() -> np.ndarray:
+            if missing:
+                if future is not None:
+                    encoded = future.result()
+                else:
+                    self._ensure_model()
+                    encoded = self.model.encode(miss_texts, batch_size=EMBED_ENCODE_BATCH)
+                embedding_cache.put_many(embedding_cache_key(), miss_texts, encoded)
+                for i, vec in zip(missing, encoded):
+                    cached[i] = vec
+            return np.stack(cached)
+
+        return finish
+
+    def _iter_embedded(
+        self, batches: Iterable[List[Tuple[str, Dict[str, Any]]]]
+    ) -> Iterator[Tuple[np.ndarray, List[Tuple[str, Dict[str, Any]]]]]:
+        """
+        Yield (embeddings, batch) ตามลำดับ batch เดิม
+        ถ้ามี encoder pool ส่ง batch ค้างไว้ได้ไม่เกิน 2 x workers เพื่อให้ทุก process ทำงานพร้อมกัน
+        """
+        window = 2 * self.embed_workers if self.embed_workers > 1 else 1
+        pending: Deque[Tuple[Callable[[], np.ndarray], List[Tuple[str, Dict[str, Any]]]]] = deque()
+        for batch in batches:
+            pending.append((self._embed_chunks_async([text for text, _ in batch]), batch))
+            if len(pending) >= window:
+                finish, done = pending.popleft()
+                yield finish(), done
+        while pending:
+            finish, done = pending.popleft()
+            yield finish(), done
+
+    def _commit(self, writer: _IndexWriter, manuals: Dict[str, Dict[str, Any]]) -> bool:
+        """finalize index ใหม่ -> โหลดเข้ามาใช้; คืนค่า False ถ้าไม่มี text เลย"""
+        # row เดิมถูก copy ลง staging ครบแล้ว -> ปิด memmap ของ version เดิมก่อน เพื่อให้ prune ลบได้
+        self._unload()
+        if not writer.finalize(manuals):
+            print("[RAG] WARNING: No text extracted from manuals.")
+            self._invalidate_cache()
+            _IndexWriter.clear(INDEX_DIR)
+            return False
+        print(f"[RAG] Index saved to {_current_index_dir()} ({writer.rows} chunks)")
+        self._load()
+        if self.ivf is not None:
+            for row in self.ann_recall_report(nprobe_values=(self.nprobe,), n_queries=100):
+                print(f"[RAG] IVF nprobe={row['nprobe']}: recall@10={row['recall@10']:.3f}, "
+                      f"{row['ivf_ms']:.2f} ms/query (exact {row['exact_ms']:.2f} ms)")
+        return True
+
+    def _skip_unreadable(
+        self,
+        pdf_paths: List[Path],
+        fingerprints: Dict[str, Dict[str, Any]],
+        reuse: Optional[Dict[str, Dict[str, Any]]] = None,
+        previous: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> List[Path]:
+        """
+        เปิด PDF ที่ต้อง extract ใหม่ (นับหน้า) ก่อนเริ่ม build; ไฟล์ที่เปิดไม่ได้ถูกข้ามและบันทึกใน self.skipped
+        แทนที่จะทำให้ทั้ง build ล้ม ถ้า manual นั้นอยู่ใน index เดิม (previous) ใช้ row เดิมต่อไป
+        """
+        self.skipped = {}
+        readable = []
+        for pdf_path in pdf_paths:
+            name = pdf_path.name
+            if reuse is None or name not in reuse:
+                try:
+                    self._page_count(pdf_path, fingerprints[name]["sha256"])
+                except Exception as e:
+                    fp = fingerprints[name]
+                    self.skipped[name] = {"size": fp["size"], "mtime": fp["mtime"], "error": repr(e)}
+                    print(f"[RAG] WARNING: skipping unreadable manual {name}: {e!r}")
+                    old = (previous or {}).get(name)
+                    if old is None or reuse is None:
+                        continue
+                    # ไฟล์เดิมถูกเขียนทับด้วยไฟล์เสีย/ยัง copy ไม่เสร็จ -> serve เนื้อหาเดิมต่อ
+                    reuse[name] = old
+                    fingerprints[name] = {k: old[k] for k in ("sha256", "size", "mtime")}
+            readable.append(pdf_path)
+        return readable
 
-        np.savez_compressed(
-            INDEX_PATH,
-            embeddings=self.embeddings,
-            meta=np.array(self.meta, dtype=object),
-            texts=np.array(self.texts, dtype=object),
+    def build_from_pdfs(self, pdf_dir: Path):
+        with index_lock:
+            print(f"[RAG] Building index from PDFs in {pdf_dir} ...")
+            pdf_paths = sorted(pdf_dir.glob("*.pdf"))
+            fingerprints = {p.name: _file_fingerprint(p) for p in pdf_paths}
+            pdf_paths = self._skip_unreadable(pdf_paths, fingerprints)
+            writer = _IndexWriter(INDEX_DIR)
+            try:
+                manuals = self._write_manuals(writer, pdf_paths, fingerprints)
+            except BaseException:
+                writer.abort()
+                raise
+            self._commit(writer, manuals)
+
+    def update_from_pdfs(self, pdf_dir: Path) -> bool:
+        """
+        Rebuild แบบ incremental: เทียบ manifest กับ PDF ใน pdf_dir
+        แล้ว extract/encode ใหม่เฉพาะ manual ที่เพิ่ม/เปลี่ยน, ตัด row ของ manual ที่ถูกลบออก
+        ถ้า manifest ไม่มี หรือ model/chunk parameters ไม่ตรง -> build ใหม่ทั้งหมด
+        คืนค่า True ถ้า index ถูกสร้างใหม่
+        """
+        with index_lock:
+            if self.embeddings is not None and self.index_path != _current_index_dir():
+                # process อื่น (worker ข้างๆ / build_index.py) publish version ใหม่ไปแล้ว -> manifest ไม่ตรงกับ row ที่เปิดอยู่
+                print("[RAG] Index was rebuilt by another process -> reopening current version")
+                self._unload()
+                self.open_existing()
+            manifest = _load_manifest()
+            if (
+                self.embeddings is None
+                or manifest is None
+                or manifest.get("params") != _index_params()
+            ):
+                print("[RAG] Manifest missing or index parameters changed -> full rebuild")
+                self.build_from_pdfs(pdf_dir)
+                return True
+
+            old_manuals: Dict[str, Dict[str, Any]] = manifest["manuals"]
+            pdf_paths = sorted(pdf_dir.glob("*.pdf"))
+
+            reuse: Dict[str, Dict[str, Any]] = {}
+            fingerprints: Dict[str, Dict[str, Any]] = {}
+            for pdf_path in pdf_paths:
+                old = old_manuals.get(pdf_path.name)
+                fp = _file_fingerprint(pdf_path, previous=old)
+                fingerprints[pdf_path.name] = fp
+                if old is not None and old["sha256"] == fp["sha256"]:
+                    reuse[pdf_path.name] = old
+            pdf_paths = self._skip_unreadable(pdf_paths, fingerprints, reuse, previous=old_manuals)
+            names = {p.name for p in pdf_paths}
+            n_changed = len(pdf_paths) - len(reuse)
+            removed = [name for name in old_manuals if name not in names]
+
+            if not n_changed and not removed:
+                if any(old_manuals[n]["mtime"] != fingerprints[n]["mtime"] for n in names):
+                    # แค่ถูก touch/copy ทับ เนื้อหาเหมือนเดิม -> อัปเดต mtime ใน manifest อย่างเดียว
+                    for name in names:
+                        old_manuals[name].update(fingerprints[name])
+                    _write_manifest(old_manuals)
+                    self.manuals = old_manuals
+                print("[RAG] Index is up to date with manuals.")
+                return False
+
+            print(
+                f"[RAG] Incremental update: {n_changed} added/changed, "
+                f"{len(removed)} removed, {len(reuse)} unchanged"
+            )
+            t0 = time.time()
+            writer = _IndexWriter(INDEX_DIR)
+            try:
+                manuals = self._write_manuals(writer, pdf_paths, fingerprints, reuse=reuse)
+            except BaseException:
+                writer.abort()
+                raise
+            self._commit(writer, manuals)
+            print(f"[RAG] Incremental update done in {time.time() - t0:.1f}s")
+            return True
+
+    @staticmethod
+    def _read_header(path: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(((path or _current_index_dir()) / "index.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _load(self):
+        path = _current_index_dir()
+        header = self._read_header(path)
+        rows, dim = header["rows"], header["dim"]
+        self.index_path = path
+        # mode="r": ทุก worker process แชร์ physical pages ชุดเดียวกันผ่าน page cache
+        self.embeddings = np.memmap(
+            path / "embeddings.bin", dtype=header["dtype"], mode="r", shape=(rows, dim)
+        )
+        columns = {
+            col: np.memmap(path / filename, dtype=dtype, mode="r")
+            for col, (filename, dtype) in _INDEX_COLUMNS.items()
+        }
+        self.manual_ids = columns["manual_ids"]
+        self.pages = columns["pages"]
+        self.text_offsets = columns["text_offsets"]
+        self.text_hashes = columns["text_hashes"]
+        self.dup_offsets = np.memmap(path / "dup_offsets.i64", dtype=np.int64, mode="r")
+        # memmap ของไฟล์ขนาด 0 ไม่ได้ (index ที่ไม่มี chunk ซ้ำเลย)
+        dup_path = path / "dup_pages.i32"
+        self.dup_pages = (
+            np.memmap(dup_path, dtype=np.int32, mode="r") if dup_path.stat().st_size else np.empty(0, np.int32)
+        )
+        self._text_blob = np.memmap(path / "texts.bin", dtype=np.uint8, mode="r")
+        self.manual_names = list(header["manuals"])
+        self.index_id = header.get("id")
+        self.manuals = (_load_manifest() or {}).get("manuals", {})
+        self.ivf = _IVFIndex(path, header["ivf"]["nlist"], dim) if header.get("ivf") else None
+        self.bm25 = _BM25Index(path, header["bm25"]["avgdl"]) if header.get("bm25") else None
+        self._scan, self._scan_scales = self.embeddings, None
+        if self.quant != "none":
+            if self.quant not in header.get("quantized", []):
+                print(f"[RAG] WARNING: index has no {self.quant} copy -> scanning float32")
+            elif self.quant == "float16":
+                self._scan = np.memmap(path / "embeddings.f16", dtype=np.float16, mode="r", shape=(rows, dim))
+            else:
+                self._scan = np.memmap(path / "embeddings.i8", dtype=np.int8, mode="r", shape=(rows, dim))
+                self._scan_scales = np.memmap(path / "scales_i8.f32", dtype=np.float32, mode="r")
+        self._invalidate_cache()
+
+    def _unload(self):
+        self.embeddings = None
+        self.index_path = None
+        self.index_id = None
+        self.manuals = {}
+        self._scan = self._scan_scales = None
+        self.ivf = None
+        self.bm25 = None
+        self.manual_names = []
+        self.manual_ids = self.pages = self.text_offsets = self._text_blob = None
+        self.text_hashes = self.dup_offsets = self.dup_pages = None
+
+    def _migrate_legacy_npz(self):
+        """
+        แปลง manual_index.npz (format เก่า, pickle) เป็น INDEX_DIR โดยไม่ต้อง encode ใหม่ -> serve ได้ทันที
+        npz ไม่มี manifest -> update_from_pdfs จะ rebuild ทั้งหมดใน background
+        ไม่ลบ npz เพราะ unified_app.py ยังอ่าน/เขียนไฟล์นี้อยู่
+        """
+        print(f"[RAG] Migrating legacy index {LEGACY_INDEX_PATH} -> {INDEX_DIR}")
+        data = np.load(LEGACY_INDEX_PATH, allow_pickle=True)
+        embeddings, meta, texts = data["embeddings"], data["meta"], data["texts"]
+        writer = _IndexWriter(INDEX_DIR, resume=False)
+        for lo in range(0, len(texts), EMBED_BATCH_SIZE):
+            hi = lo + EMBED_BATCH_SIZE
+            writer.append(embeddings[lo:hi], list(texts[lo:hi]), list(meta[lo:hi]))
+        if writer.finalize({}):
+            (_current_index_dir() / MANIFEST_NAME).unlink(missing_ok=True)
+
+    def open_existing(self) -> bool:
+        """
+        เปิด index ที่มีอยู่บน disk (memmap) + ผล per-defect ที่ precompute ไว้ โดยไม่โหลด model
+        -> serve /analyze ได้ทันทีตอน startup; คืนค่า False ถ้ายังไม่มี index ที่ใช้ได้
+        """
+        # ถือ lock ระหว่างอ่าน CURRENT -> map ไฟล์ ไม่ให้ process อื่น finalize/prune version นี้ไปกลางทาง
+        with index_lock:
+            if self._read_header() is None and LEGACY_INDEX_PATH.exists():
+                self._migrate_legacy_npz()
+            header = self._read_header()
+            if header is None:
+                return False
+            if header.get("format") != INDEX_FORMAT_VERSION:
+                print(f"[RAG] Index format {header.get('format')} is outdated -> full rebuild")
+                return False
+            print(f"[RAG] Loading existing index from {_current_index_dir()}")
+            self._load()
+            self._load_warm_results()
+            return True
+
+    def is_stale(self, pdf_dir: Path) -> bool:
+        """เทียบชื่อ/size/mtime ของ PDF ใน pdf_dir กับ manifest ของ index นี้ (stat อย่างเดียว ไม่อ่านไฟล์)"""
+        stats = _pdf_stats(pdf_dir)
+        # ไฟล์ที่ถูกข้ามไปแล้วและยังไม่เปลี่ยน ไม่นับ (ไม่งั้น watcher จะ rebuild ทุกรอบ)
+        ignored = {
+            name for name, stat in stats.items()
+            if name in self.skipped and (self.skipped[name]["size"], self.skipped[name]["mtime"]) == stat
+        }
+        if set(stats) - ignored != set(self.manuals) - ignored:
+            return True
+        return any(
+            (self.manuals[name].get("size"), self.manuals[name].get("mtime")) != stat
+            for name, stat in stats.items()
+            if name not in ignored
         )
-        print(f"[RAG] Index saved to {INDEX_PATH}")
 
     def load_or_build(self, pdf_dir: Path):
-        if INDEX_PATH.exists():
-            print(f"[RAG] Loading existing index from {INDEX_PATH}")
-            data = np.load(INDEX_PATH, allow_pickle=True)
-            self.embeddings = data["embeddings"]
-            self.meta = list(data["meta"])
-            self.texts = list(data["texts"])
-            self.model = SentenceTransformer("all-MiniLM-L6-v2")
-            self.nn = NearestNeighbors(n_neighbors=5, metric="cosine")
-            self.nn.fit(self.embeddings)
+        if len(self) or self.open_existing():
+            self._ensure_model()
+            self.update_from_pdfs(pdf_dir)
         else:
             self.build_from_pdfs(pdf_dir)
 
@@ -145,40 +2011,724 @@ class ManualIndex:
             start += CHUNK_SIZE - CHUNK_OVERLAP
         return chunks
 
-    def search(self, query: str, top_k: int = 3) -> List[RAGSource]:
-        if not self.model or not self.nn or self.embeddings is None:
+    # ---------- row accessors ----------
+
+    def __len__(self) -> int:
+        return 0 if self.embeddings is None else self.embeddings.shape[0]
+
+    def text(self, row: int) -> str:
+        lo, hi = self.text_offsets[row], self.text_offsets[row + 1]
+        return self._text_blob[lo:hi].tobytes().decode("utf-8")
+
+    def chunk_meta(self, row: int) -> Dict[str, Any]:
+        return {
+            "manual_name": self.manual_names[self.manual_ids[row]],
+            "page": int(self.pages[row]),
+            "dup_pages": [int(p) for p in self.dup_pages[self.dup_offsets[row]:self.dup_offsets[row + 1]]],
+        }
+
+    # ---------- retrieval cache ----------
+
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _invalidate_cache(self):
+        """เรียกทุกครั้งที่ index เปลี่ยน (build/load) -> version ใหม่, ล้าง cache เก่า"""
+        with self._cache_lock:
+            self.version += 1
+            self._pinned.clear()
+            self._lru.clear()
+        self._shard_ranges = None
+
+    def warm_cache(
+        self,
+        queries: List[str],
+        top_k: int = 3,
+        filters: Optional[List[Optional[Iterable[str]]]] = None,
+    ):
+        """
+        Pre-compute ผลของ query ที่รู้ล่วงหน้า (defect vocabulary) x shard filter (None = ทุก manual)
+        และ pin ไว้ใน cache แล้วเซฟลง warm_results.json ของ index เพื่อให้ startup ครั้งหน้า serve ได้ก่อนโหลด model เสร็จ
+        """
+        self._ensure_model()
+        version = self.version
+        shards = list(dict.fromkeys(self._shard_key(f) for f in (filters or [None])))
+        entries: List[Dict[str, Any]] = []
+        for shard in shards:
+            for query in queries:
+                results = self._search_uncached(query, top_k, shard)
+                entries.append({
+                    "query": query,
+                    "manuals": list(shard) if shard else None,
+                    "results": [r.model_dump() for r in results],
+                })
+                with self._cache_lock:
+                    self._pinned[(self._normalize_query(query), top_k, version, shard)] = results
+        with index_lock:
+            # version นี้อาจถูก process อื่นแทนที่ (และ prune) ไปแล้ว -> ไม่เขียนลง dir ที่ไม่ใช่ CURRENT
+            if self.index_path is not None and self.index_path == _current_index_dir():
+                payload = {"index_id": self.index_id, "top_k": top_k, "entries": entries}
+                (self.index_path / WARM_RESULTS_NAME).write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+        print(
+            f"[RAG] Search cache warmed for {len(queries)} queries x {len(shards)} shard filters "
+            f"(index v{self.version})"
+        )
+
+    def _load_warm_results(self):
+        """โหลดผล per-defect ที่ warm_cache เซฟไว้ (เฉพาะถ้าเป็นของ index ชุดเดียวกัน)"""
+        try:
+            payload = json.loads((self.index_path / WARM_RESULTS_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError, TypeError):
+            return
+        if payload.get("index_id") != self.index_id:
+            return
+        entries = payload.get("entries", [])
+        with self._cache_lock:
+            for entry in entries:
+                key = (
+                    self._normalize_query(entry["query"]),
+                    payload["top_k"],
+                    self.version,
+                    self._shard_key(entry["manuals"]),
+                )
+                self._pinned[key] = [RAGSource(**r) for r in entry["results"]]
+        print(f"[RAG] Loaded {len(entries)} precomputed per-defect results")
+
+    def lookup_cached(
+        self, query: str, top_k: int = 3, manuals: Optional[Iterable[str]] = None
+    ) -> Optional[List[RAGSource]]:
+        """ผลจาก cache อย่างเดียว (ไม่ encode/search); None ถ้าไม่มี"""
+        return self._cache_get((self._normalize_query(query), top_k, self.version, self._shard_key(manuals)))
+
+    def cache_info(self) -> Dict[str, Any]:
+        with self._cache_lock:
+            return {
+                "version": self.version,
+                "pinned": len(self._pinned),
+                "lru": len(self._lru),
+                "lru_max": self.cache_size,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+            }
+
+    def _cache_get(self, key: _SearchKey) -> Optional[List[RAGSource]]:
+        with self._cache_lock:
+            cached = self._pinned.get(key)
+            if cached is None and key in self._lru:
+                self._lru.move_to_end(key)
+                cached = self._lru[key]
+            if cached is not None:
+                self.cache_hits += 1
+                return list(cached)
+            self.cache_misses += 1
+            return None
+
+    def _cache_put(self, key: _SearchKey, results: List[RAGSource]):
+        if not results or self.model is None:
+            # ระหว่างที่ model ยังโหลดไม่เสร็จ ผลอาจมีแค่ฝั่ง lexical -> ไม่ cache
+            return
+        with self._cache_lock:
+            # index อาจถูก rebuild ระหว่าง search -> ไม่เก็บผลของ version เก่า
+            if key[2] == self.version:
+                self._lru[key] = results
+                self._lru.move_to_end(key)
+                while len(self._lru) > self.cache_size:
+                    self._lru.popitem(last=False)
+
+    def search(self, query: str, top_k: int = 3, manuals: Optional[Iterable[str]] = None) -> List[RAGSource]:
+        """manuals = ค้นเฉพาะ shard ของ manual เหล่านี้ (None = ทุก manual)"""
+        shard = self._shard_key(manuals)
+        key = (self._normalize_query(query), top_k, self.version, shard)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        results = self._search_uncached(query, top_k, shard)
+        self._cache_put(key, results)
+        return list(results)
+
+    def search_many(
+        self, queries: List[str], top_k: int = 3, manuals: Optional[Iterable[str]] = None
+    ) -> List[List[RAGSource]]:
+        """
+        Search หลาย query พร้อมกัน: query ที่ไม่อยู่ใน cache ถูก encode ใน forward pass เดียว
+        แล้วให้คะแนนเป็น matrix product เดียว; คืนผลตามลำดับ queries
+        """
+        version = self.version
+        shard = self._shard_key(manuals)
+        keys = [(self._normalize_query(q), top_k, version, shard) for q in queries]
+        results: Dict[_SearchKey, List[RAGSource]] = {}
+        misses: Dict[_SearchKey, str] = {}
+        for key, query in zip(keys, queries):
+            if key in results or key in misses:
+                continue
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[key] = cached
+            else:
+                misses[key] = query
+
+        ranges = self._ranges_for(shard)
+        if misses and self.embeddings is not None and (ranges is None or ranges):
+            miss_keys = list(misses)
+            ranked = self._rank([misses[k] for k in miss_keys], top_k * DEDUP_OVERFETCH, ranges)
+            for key, (scores, rows) in zip(miss_keys, ranked):
+                results[key] = self._to_sources(scores, rows, top_k)
+                self._cache_put(key, results[key])
+        return [list(results.get(key, [])) for key in keys]
+
+    # ---------- shards (per-manual row ranges) ----------
+
+    @staticmethod
+    def _shard_key(manuals: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+        return tuple(sorted(set(manuals))) if manuals is not None else None
+
+    def shard_ranges(self) -> Dict[str, Tuple[int, int]]:
+        """
+        ช่วง row [start, end) ของแต่ละ manual (writer เขียนทีละ manual -> row ต่อเนื่องเสมอ)
+        ใช้ chunk_start/chunk_end จาก manifest; index ที่ไม่มี manifest คำนวณจาก manual_ids
+        """
+        if self._shard_ranges is None:
+            if self.manuals and all("chunk_start" in m for m in self.manuals.values()):
+                ranges = {name: (m["chunk_start"], m["chunk_end"]) for name, m in self.manuals.items()}
+            elif len(self):
+                ids = np.asarray(self.manual_ids)
+                bounds = np.flatnonzero(np.diff(ids)) + 1
+                starts = np.concatenate([[0], bounds])
+                ends = np.concatenate([bounds, [len(ids)]])
+                ranges = {self.manual_names[ids[lo]]: (int(lo), int(hi)) for lo, hi in zip(starts, ends)}
+            else:
+                ranges = {}
+            self._shard_ranges = ranges
+        return self._shard_ranges
+
+    def _ranges_for(self, shard: Optional[Tuple[str, ...]]) -> Optional[List[slice]]:
+        """
+        ช่วง row ของ shard filter เป็น slice เรียงตาม row (ช่วงที่ติดกันรวมเป็นช่วงเดียว)
+        None = ไม่กรอง; manual ที่ไม่อยู่ใน index ถูกข้าม
+        slice ของ memmap เป็น view -> scan shard ได้โดยไม่ copy vector ทั้ง shard ทุก query
+        """
+        if shard is None:
+            return None
+        ranges = self.shard_ranges()
+        merged: List[List[int]] = []
+        for lo, hi in sorted(ranges[name] for name in shard if name in ranges):
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            elif hi > lo:
+                merged.append([lo, hi])
+        return [slice(lo, hi) for lo, hi in merged]
+
+    @staticmethod
+    def _in_ranges(rows: np.ndarray, ranges: List[slice]) -> np.ndarray:
+        """mask ของ rows ที่อยู่ในช่วงใดช่วงหนึ่งของ ranges (ranges เรียงและไม่ทับกัน)"""
+        starts = np.array([r.start for r in ranges], dtype=np.int64)
+        stops = np.array([r.stop for r in ranges], dtype=np.int64)
+        pos = np.searchsorted(starts, rows, side="right") - 1
+        return (pos >= 0) & (rows < stops[np.maximum(pos, 0)])
+
+    # ---------- vectorized top-k search ----------
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        return _l2_normalize(self.model.encode(queries))
+
+    @staticmethod
+    def _select_top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """top-k ของแต่ละแถวใน scores (m, n) ด้วย argpartition -> (scores, columns) เรียงจากมากไปน้อย"""
+        k = min(k, scores.shape[1])
+        if k < scores.shape[1]:
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            part = np.broadcast_to(np.arange(k), scores.shape).copy()
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-part_scores, axis=1, kind="stable")
+        return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+    def _scores(self, q_emb: np.ndarray, rows: Any = None) -> np.ndarray:
+        """
+        Cosine score (m, n) ของ query กับ scan matrix (ทั้งหมด, เฉพาะ row ids หรือ slice)
+        ถ้า scan matrix เป็น float16/int8 แปลงเป็น float32 ทีละ block เพื่อใช้ BLAS
+        """
+        mat = self._scan if rows is None else self._scan[rows]
+        if mat.dtype == np.float32:
+            return q_emb @ mat.T
+        out = np.empty((len(q_emb), len(mat)), dtype=np.float32)
+        for lo in range(0, len(mat), SCAN_BLOCK_ROWS):
+            block = np.asarray(mat[lo:lo + SCAN_BLOCK_ROWS], dtype=np.float32)
+            out[:, lo:lo + len(block)] = q_emb @ block.T
+        if self._scan_scales is not None:
+            out *= self._scan_scales if rows is None else self._scan_scales[rows]
+        return out
+
+    def _range_scores(self, q_emb: np.ndarray, ranges: List[slice]) -> np.ndarray:
+        """score (m, n) ของทุก row ใน ranges ต่อกันตามลำดับ: scan ทีละช่วงจาก view ของ memmap"""
+        out = np.empty((len(q_emb), sum(r.stop - r.start for r in ranges)), dtype=np.float32)
+        lo = 0
+        for r in ranges:
+            out[:, lo:lo + r.stop - r.start] = self._scores(q_emb, r)
+            lo += r.stop - r.start
+        return out
+
+    def _finish_top_k(
+        self, q: np.ndarray, scores: np.ndarray, row_ids: Optional[np.ndarray], top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        เลือก top-k จาก scores (n,) ของ row_ids (None = ทุก row)
+        ถ้า scan แบบ quantized และเปิด rescore -> เอา shortlist มาคิด float32 ใหม่แล้วค่อยเลือก
+        """
+        rescore = self._scan is not self.embeddings and self.rescore_factor > 0
+        scores, cols = self._select_top_k(scores[None, :], top_k * self.rescore_factor if rescore else top_k)
+        rows = cols[0] if row_ids is None else row_ids[cols[0]]
+        if not rescore:
+            return scores[0], rows
+        rows = np.sort(rows)
+        exact = np.asarray(self.embeddings[rows], dtype=np.float32) @ q
+        scores, cols = self._select_top_k(exact[None, :], top_k)
+        return scores[0], rows[cols[0]]
+
+    def _exact_top_k(self, q_emb: np.ndarray, top_k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Brute-force top-k: score ทุก row ของ query matrix (m, dim) ใน matrix product เดียว"""
+        scores = self._scores(q_emb)
+        if self._scan is self.embeddings:
+            top_scores, rows = self._select_top_k(scores, top_k)
+            return list(zip(top_scores, rows))
+        return [self._finish_top_k(q, s, None, top_k) for q, s in zip(q_emb, scores)]
+
+    def _ivf_top_k(
+        self, q_emb: np.ndarray, top_k: int, nprobe: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Approximate top-k: scan เฉพาะ row ใน nprobe กลุ่มที่ใกล้ query ที่สุด"""
+        results = []
+        for q in q_emb:
+            cand = self.ivf.candidates(q, nprobe)
+            results.append(self._finish_top_k(q, self._scores(q[None, :], cand)[0], cand, top_k))
+        return results
+
+    def _shard_top_k(
+        self, q_emb: np.ndarray, top_k: int, ranges: List[slice]
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Top-k ภายใน ranges (shard ที่กรองแล้ว): scan เฉพาะช่วง row เหล่านี้ของ memmap
+        shard ที่ใหญ่พอจะใช้ IVF (และ index มี IVF) -> scan เฉพาะ candidate ของ IVF ที่อยู่ใน shard
+        """
+        if self.ivf is not None and sum(r.stop - r.start for r in ranges) >= ANN_MIN_ROWS:
+            results = []
+            for q in q_emb:
+                cand = self.ivf.candidates(q, self.nprobe)
+                cand = cand[self._in_ranges(cand, ranges)]
+                results.append(self._finish_top_k(q, self._scores(q[None, :], cand)[0], cand, top_k))
+            return results
+        scores = self._range_scores(q_emb, ranges)
+        rows = np.concatenate([np.arange(r.start, r.stop, dtype=np.int64) for r in ranges])
+        if self._scan is self.embeddings:
+            top_scores, cols = self._select_top_k(scores, top_k)
+            return list(zip(top_scores, rows[cols]))
+        return [self._finish_top_k(q, s, rows, top_k) for q, s in zip(q_emb, scores)]
+
+    def _top_k(
+        self, q_emb: np.ndarray, top_k: int, ranges: Optional[List[slice]] = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Top-k สำหรับ query matrix (m, dim) ที่ normalize แล้ว
+        คืนค่า list ของ (scores, rows) ต่อ query; ranges = จำกัดเฉพาะ shard, ใช้ IVF ถ้า index มี ไม่งั้น exact
+        """
+        if ranges is not None:
+            return self._shard_top_k(q_emb, top_k, ranges)
+        if self.ivf is not None:
+            return self._ivf_top_k(q_emb, top_k, self.nprobe)
+        return self._exact_top_k(q_emb, top_k)
+
+    def ann_recall_report(
+        self,
+        k: int = 10,
+        nprobe_values: Tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+        queries: Optional[List[str]] = None,
+        n_queries: int = 200,
+        seed: int = 0,
+    ) -> List[Dict[str, Any]]:
+        """
+        เทียบ IVF กับ exact search: recall@k และ latency เฉลี่ยต่อ query ของแต่ละ nprobe
+        ถ้าไม่ส่ง queries มา ใช้ embedding ของ chunk สุ่มที่เติม noise เล็กน้อยเป็น query
+        """
+        if self.ivf is None:
             return []
-        q_emb = self.model.encode([query])
-        distances, indices = self.nn.kneighbors(q_emb, n_neighbors=top_k)
+        if queries:
+            self._ensure_model()
+            q_emb = self._encode_queries(queries)
+        else:
+            rng = np.random.default_rng(seed)
+            rows = rng.choice(len(self), size=min(n_queries, len(self)), replace=False)
+            base = np.asarray(self.embeddings[np.sort(rows)], dtype=np.float32)
+            q_emb = _l2_normalize(base + rng.normal(scale=0.05, size=base.shape).astype(np.float32))
+
+        t0 = time.perf_counter()
+        exact = self._exact_top_k(q_emb, k)
+        exact_ms = (time.perf_counter() - t0) * 1000 / len(q_emb)
+
+        report = []
+        for nprobe in nprobe_values:
+            t0 = time.perf_counter()
+            approx = self._ivf_top_k(q_emb, k, nprobe)
+            ms = (time.perf_counter() - t0) * 1000 / len(q_emb)
+            hits = sum(len(np.intersect1d(a[1], e[1])) for a, e in zip(approx, exact))
+            report.append({
+                "nprobe": nprobe,
+                f"recall@{k}": hits / sum(len(e[1]) for e in exact),
+                "ivf_ms": ms,
+                "exact_ms": exact_ms,
+            })
+        return report
+
+    def _to_sources(self, scores: np.ndarray, rows: np.ndarray, top_k: int) -> List[RAGSource]:
+        """แปลง (scores, rows) เป็น RAGSource ไม่เกิน top_k อัน โดยข้าม row ที่ข้อความซ้ำกับอันที่เลือกไปแล้ว"""
         results: List[RAGSource] = []
-        for dist, idx in zip(distances[0], indices[0]):
-            meta = self.meta[idx]
-            snippet = self.texts[idx]
+        seen = set()
+        for score, idx in zip(scores, rows):
+            text_hash = int(self.text_hashes[idx])
+            if text_hash in seen:
+                continue
+            seen.add(text_hash)
+            meta = self.chunk_meta(idx)
+            snippet = self.text(idx)
             results.append(RAGSource(
                 manual_name=meta["manual_name"],
                 page=meta["page"],
-                score=float(1 - dist),
+                score=float(score),
                 snippet=snippet[:400],
+                other_pages=meta["dup_pages"],
             ))
+            if len(results) == top_k:
+                break
         return results
 
+    # ---------- hybrid lexical + dense ----------
+
+    def _rank(
+        self, queries: List[str], top_k: int, ranges: Optional[List[slice]] = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        จัดอันดับหลาย query -> list ของ (scores, rows); ranges = จำกัดเฉพาะ shard (None = ทุก row)
+        - query ที่มี token แบบ part number/error code ที่อยู่ใน index -> lexical อย่างเดียว (ไม่ต้องรัน model)
+          score ของกรณีนี้คือ BM25 เทียบกับขอบบนของ query (ไม่ใช่ cosine)
+        - ที่เหลือ encode ใน forward pass เดียว แล้ว fuse dense กับ BM25
+        """
+        lexical = [
+            self.bm25.scores(q) if self.bm25 is not None else (np.empty(0, np.int64), np.empty(0, np.float32))
+            for q in queries
+        ]
+        if ranges is not None:
+            for i, (lex_rows, lex_scores) in enumerate(lexical):
+                keep = self._in_ranges(lex_rows, ranges)
+                lexical[i] = (lex_rows[keep], lex_scores[keep])
+        ranked: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
+        dense_idx = []
+        for i, (query, (lex_rows, lex_scores)) in enumerate(zip(queries, lexical)):
+            if len(lex_rows) and _is_exact_token_query(query, self.bm25.term_ids):
+                scores, cols = self._select_top_k(lex_scores[None, :], top_k)
+                # ไม่มี cosine (ไม่ได้รัน model) -> score = BM25 / ขอบบนของ query นี้ ใน [0, 1)
+                # ไม่ normalize ด้วยอันดับ 1 (ไม่งั้นได้ 1.0 ทุกครั้งไม่ว่าจะ match ดีแค่ไหน)
+                ranked[i] = (scores[0] / max(self.bm25.max_score(query), 1e-9), lex_rows[cols[0]])
+            else:
+                dense_idx.append(i)
+
+        if dense_idx and self.model is not None:
+            q_emb = self._encode_queries([queries[i] for i in dense_idx])
+            n_cand = top_k * HYBRID_CANDIDATES if self.bm25 is not None else top_k
+            for i, q, dense in zip(dense_idx, q_emb, self._top_k(q_emb, n_cand, ranges)):
+                ranked[i] = self._fuse(q, dense, lexical[i], top_k)
+        return [r if r is not None else (np.empty(0, np.float32), np.empty(0, np.int64)) for r in ranked]
+
+    def _fuse(
+        self,
+        q: np.ndarray,
+        dense: Tuple[np.ndarray, np.ndarray],
+        lexical: Tuple[np.ndarray, np.ndarray],
+        top_k: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        lex_rows, lex_scores = lexical
+        if not len(lex_rows) or HYBRID_LEXICAL_WEIGHT <= 0:
+            scores, rows = dense
+            return scores[:top_k], rows[:top_k]
+        lex_top = np.argsort(-lex_scores, kind="stable")[:top_k * HYBRID_CANDIDATES]
+        cand = np.union1d(dense[1], lex_rows[lex_top])
+        # cosine จริงของทุก candidate (row ที่มาจาก BM25 อาจไม่อยู่ใน dense shortlist)
+        cos = np.asarray(self.embeddings[cand], dtype=np.float32) @ q
+        lex = np.zeros(len(cand), dtype=np.float32)
+        pos = np.searchsorted(lex_rows, cand)
+        pos = np.minimum(pos, len(lex_rows) - 1)
+        hit = lex_rows[pos] == cand
+        lex[hit] = lex_scores[pos[hit]]
+        lex /= max(float(lex.max()), 1e-9)
+        fused = (1.0 - HYBRID_LEXICAL_WEIGHT) * cos + HYBRID_LEXICAL_WEIGHT * lex
+        scores, cols = self._select_top_k(fused[None, :], top_k)
+        return scores[0], cand[cols[0]]
+
+    def _search_uncached(
+        self, query: str, top_k: int = 3, shard: Optional[Tuple[str, ...]] = None
+    ) -> List[RAGSource]:
+        ranges = self._ranges_for(shard)
+        if self.embeddings is None or (ranges is not None and not ranges):
+            return []
+        scores, rows = self._rank([query], top_k * DEDUP_OVERFETCH, ranges)[0]
+        return self._to_sources(scores, rows, top_k)
+
 
 manual_index = ManualIndex()
 
 
+# ------------------------------------------------------------
+# ========== Machine Tags (client_id -> manual shards) =======
+# ------------------------------------------------------------
+
+_machine_tags: Dict[str, Any] = {"mtime": None, "data": {}}
+_warned_machine_tags: set = set()   # tag ที่เตือนไปแล้ว (เตือนครั้งเดียวต่อ tag จนกว่าไฟล์ tag จะเปลี่ยน)
+
+
+def load_machine_tags() -> Dict[str, Any]:
+    """อ่าน MACHINE_TAGS_PATH (อ่านใหม่เมื่อ mtime เปลี่ยน); ไม่มีไฟล์ = ไม่กรอง"""
+    try:
+        mtime = MACHINE_TAGS_PATH.stat().st_mtime
+    except OSError:
+        return {}
+    if mtime != _machine_tags["mtime"]:
+        try:
+            data = json.loads(MACHINE_TAGS_PATH.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"[RAG] WARNING: cannot read machine tags {MACHINE_TAGS_PATH}: {e}")
+            data = {}
+        _machine_tags.update(mtime=mtime, data=data)
+        _warned_machine_tags.clear()
+    return _machine_tags["data"]
+
+
+def machine_for_client(client_id: Optional[str]) -> Optional[str]:
+    if not client_id:
+        return None
+    return load_machine_tags().get("clients", {}).get(client_id)
+
+
+def manuals_for_machine(index: ManualIndex, machine: Optional[str]) -> Optional[List[str]]:
+    """ชื่อ manual ใน index ที่ตรงกับ glob ของ machine tag; None = ไม่กรอง (ไม่มี tag / ไม่ตรง manual ไหนเลย)"""
+    if not machine:
+        return None
+    patterns = load_machine_tags().get("machines", {}).get(machine)
+    if not patterns:
+        _warn_machine_tag(machine, "is not defined in machine tags")
+        return None
+    names = [n for n in index.manual_names if any(fnmatch.fnmatch(n, p) for p in patterns)]
+    if not names:
+        _warn_machine_tag(machine, "matches no manual")
+        return None
+    return names
+
+
+def _warn_machine_tag(machine: str, problem: str):
+    if machine not in _warned_machine_tags:
+        _warned_machine_tags.add(machine)
+        print(f"[RAG] WARNING: machine tag '{machine}' {problem} -> searching all manuals")
+
+
 # ------------------------------------------------------------
 # ========== Vision Stub =====================================
 # ------------------------------------------------------------
 
-def decode_image(image_base64: str) -> Tuple[Image.Image, bytes]:
+def decode_image(image_base64: str) -> BinaryIO:
+    """base64 (JSON /analyze) -> file object ให้ pipeline เดียวกับ binary upload"""
     try:
-        img_bytes = base64.b64decode(image_base64)
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        return img, img_bytes
+        return io.BytesIO(base64.b64decode(image_base64))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image base64: {e}")
 
 
+class LazyImage:
+    """
+    รูปที่ผ่านการตรวจจาก header แล้ว (format, width, height, nbytes) แต่ยังไม่ decode pixel
+    load() decode ครั้งแรกที่เรียก (cache ไว้); JPEG ที่ใหญ่กว่า max_side ใช้ draft mode ของ libjpeg
+    ซึ่ง decode ที่ความละเอียด 1/2, 1/4, 1/8 โดยตรง (เร็วและใช้ RAM น้อยกว่า decode เต็มแล้วย่อ)
+    """
+
+    def __init__(
+        self, image_file: BinaryIO, fmt: str, width: int, height: int, nbytes: int,
+        orientation: Optional[int] = 1,
+    ):
+        self.file = image_file
+        self.format = fmt
+        self.width = width
+        self.height = height
+        self.nbytes = nbytes
+        # EXIF Orientation (1 = ตามที่เก็บ); None = EXIF อยู่หลัง pixel data (PNG) -> อ่านตอน load() ครั้งแรก
+        self.orientation = orientation
+        self._decoded: Dict[int, Image.Image] = {}
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    def load(self, max_side: Optional[int] = VISION_MAX_SIDE) -> Image.Image:
+        """RGB image; ถ้า format รองรับ draft ด้านยาวจะไม่เล็กกว่า max_side (None = ความละเอียดเต็ม)"""
+        key = max_side or 0
+        if key not in self._decoded:
+            try:
+                self.file.seek(0)
+                img = Image.open(self.file)
+                if max_side and max(img.size) > max_side:
+                    scale = max_side / max(img.size)
+                    img.draft("RGB", (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+                self._decoded[key] = img.convert("RGB")
+                if self.orientation is None:
+                    self.orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+            except Exception as e:
+                # ข้อความจาก PIL มี repr ของ file object (เช่น path ของ temp file) -> ไม่ส่งกลับ client
+                print(f"[API] WARNING: cannot decode image: {e!r}")
+                raise HTTPException(status_code=400, detail="Invalid image")
+        return self._decoded[key]
+
+
+def validate_image(image_file: BinaryIO) -> LazyImage:
+    """
+    ตรวจรูปจาก header (Image.open อ่านแค่ header ไม่ decode pixel):
+    format ไม่รองรับ -> 415, ขนาดไฟล์/จำนวน pixel เกิน -> 413, อ่านไม่ได้ -> 400
+    """
+    nbytes = image_file.seek(0, io.SEEK_END)
+    if nbytes > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    image_file.seek(0)
+    try:
+        with Image.open(image_file) as img:
+            fmt, (width, height) = img.format, img.size
+            # PNG ที่ eXIf chunk อยู่หลัง IDAT: getexif() จะ decode ทั้งรูป -> เลื่อนไปอ่านตอน load()
+            if fmt == "PNG" and "exif" not in img.info:
+                orientation = None
+            else:
+                orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=f"Image too large: {e}")
+    except Exception as e:
+        print(f"[API] WARNING: cannot read image header: {e!r}")
+        raise HTTPException(status_code=400, detail="Invalid image")
+    if fmt not in ALLOWED_IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported image format {fmt}; expected one of {sorted(ALLOWED_IMAGE_FORMATS)}",
+        )
+    if width * height > MAX_IMAGE_PIXELS or max(width, height) > MAX_IMAGE_SIDE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image {width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels / {MAX_IMAGE_SIDE} px per side",
+        )
+    return LazyImage(image_file, fmt, width, height, nbytes, orientation)
+
+
+# EXIF Orientation -> transpose (เหมือน ImageOps.exif_transpose แต่ใช้ค่าที่อ่านจาก header ไว้แล้ว)
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _fit(img: Image.Image, max_side: int) -> Image.Image:
+    """ย่อให้ด้านยาว <= max_side (reducing_gap: box-reduce ใน C ก่อนแล้วค่อย resample -> เร็วกับรูปใหญ่)"""
+    scale = max_side / max(img.size)
+    if scale >= 1:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def _tile_boxes(width: int, height: int, tile: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    """grid ของ tile ขนาด tile x tile ที่ครอบทั้งรูป (tile สุดท้ายชิดขอบ) ซ้อนกันอย่างน้อย overlap"""
+    def starts(length: int) -> np.ndarray:
+        if length <= tile:
+            return np.zeros(1, dtype=np.int64)
+        n = int(np.ceil((length - tile) / (tile * (1 - overlap)))) + 1
+        return np.linspace(0, length - tile, n).round().astype(np.int64)
+
+    xs, ys = starts(width), starts(height)
+    return [
+        (int(x), int(y), int(min(x + tile, width)), int(min(y + tile, height)))
+        for y in ys for x in xs
+    ]
+
+
+class PreparedImage:
+    """
+    ผล preprocessing ของรูป 1 รูปสำหรับ vision backend และ vision cache
+    ทุกอย่างคำนวณตอนถูกใช้ครั้งแรกแล้ว cache ไว้ -> ส่วนที่ไม่มีใครใช้ไม่ต้อง decode
+    - oriented: RGB หมุนตาม EXIF แล้ว (decode แบบ draft ที่ความละเอียดพอสำหรับงานที่ต้องการ)
+    - model_input: ด้านยาว = VISION_INPUT_SIZE
+    - tiles: [(box ในพิกัดของ oriented, รูปขนาด VISION_INPUT_SIZE)] เมื่อรูปใหญ่พอ
+    - dhash: perceptual hash สำหรับ vision cache
+    """
+
+    def __init__(self, source: LazyImage):
+        self.source = source
+
+    @property
+    def tiled(self) -> bool:
+        return 0 < VISION_TILE_MIN_SIDE <= max(self.source.size)
+
+    @cached_property
+    def oriented(self) -> Image.Image:
+        img = self.source.load(VISION_TILE_MAX_SIDE if self.tiled else VISION_INPUT_SIZE)
+        method = _EXIF_TRANSPOSE.get(self.source.orientation)
+        return img.transpose(method) if method is not None else img
+
+    @cached_property
+    def model_input(self) -> Image.Image:
+        return _fit(self.oriented, VISION_INPUT_SIZE)
+
+    @cached_property
+    def tiles(self) -> List[Tuple[Tuple[int, int, int, int], Image.Image]]:
+        if not self.tiled:
+            return []
+        img = _fit(self.oriented, VISION_TILE_MAX_SIDE)
+        ratio = self.oriented.width / img.width
+        tiles = []
+        for box in _tile_boxes(img.width, img.height, VISION_TILE_SIZE, VISION_TILE_OVERLAP):
+            full_box = tuple(int(round(v * ratio)) for v in box)
+            tiles.append((full_box, _fit(img.crop(box), VISION_INPUT_SIZE)))
+        return tiles
+
+    @cached_property
+    def dhash(self) -> int:
+        """
+        dHash 64 bit: grayscale 9x8 แล้วเทียบ pixel ติดกันในแนวนอน (ซ้าย > ขวา = 1)
+        ทนต่อ JPEG re-encode, ย่อ/ขยาย และแสงเปลี่ยนเล็กน้อย
+        JPEG decode แยกเองแบบ draft("L") ที่ 1/8 (cache hit ไม่ต้อง decode รูปขนาด vision/log เลย);
+        format อื่น draft ไม่ได้ -> ใช้ oriented ที่ vision ต้อง decode อยู่แล้ว
+        """
+        if self.source.format == "JPEG":
+            self.source.file.seek(0)
+            try:
+                with Image.open(self.source.file) as img:
+                    img.draft("L", (DHASH_DECODE_SIDE, DHASH_DECODE_SIDE))
+                    small = img.convert("L")
+            except Exception as e:
+                # header ผ่านแต่ข้อมูลขาด (เช่น upload ค้าง) -> 400 เหมือน LazyImage.load
+                print(f"[API] WARNING: cannot decode image: {e!r}")
+                raise HTTPException(status_code=400, detail="Invalid image")
+            method = _EXIF_TRANSPOSE.get(self.source.orientation)
+            small = small.transpose(method) if method is not None else small
+        else:
+            small = self.oriented.convert("L")
+        gray = np.asarray(small.resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+        bits = (gray[:, :-1] > gray[:, 1:]).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def preprocess_image(image: LazyImage) -> PreparedImage:
+    return PreparedImage(image)
+
+
+def rag_query_for(defect_type: str) -> str:
+    return defect_type if defect_type != "normal" else "preventive maintenance"
+
+
 def build_vision_prompt(question: Optional[str] = None) -> str:
     base = """
 You are an expert maintenance engineer in a factory.
@@ -191,10 +2741,10 @@ You receive a photo of a machine/component.
     return base
 
 
-def call_vlm_stub(image_base64: str, question: Optional[str] = None) -> Dict[str, Any]:
+def call_vlm_stub(image: PreparedImage, question: Optional[str] = None) -> Dict[str, Any]:
+    # VLM จริงใช้ image.model_input / image.tiles (decode ตอนนั้น); stub ไม่ดูรูป -> ไม่มีการ decode
     import random
-    defect_candidates = ["normal", "rust_on_pipe", "oil_leak", "loose_bolt"]
-    defect = random.choice(defect_candidates)
+    defect = random.choice(DEFECT_TYPES)
     if defect == "normal":
         status = "OK"
         conf = 0.9
@@ -210,6 +2760,407 @@ def call_vlm_stub(image_base64: str, question: Optional[str] = None) -> Dict[str
     }
 
 
+def call_vlm_stub_batch(
+    images: List[PreparedImage], questions: List[Optional[str]]
+) -> List[Dict[str, Any]]:
+    """stub แบบ batch: ผลต่อรูปเหมือน call_vlm_stub; จำลองเวลา model ด้วย VISION_STUB_*_MS"""
+    if VISION_STUB_BATCH_MS or VISION_STUB_ITEM_MS:
+        time.sleep((VISION_STUB_BATCH_MS + VISION_STUB_ITEM_MS * len(images)) / 1000)
+    return [call_vlm_stub(image, question) for image, question in zip(images, questions)]
+
+
+# ------------------------------------------------------------
+# ========== Vision Backends =================================
+# ------------------------------------------------------------
+
+class VisionBackend(ABC):
+    """
+    Interface ของ vision model: analyze_batch(images, questions) -> ผลต่อรูป
+    {"defect_type", "status" ("OK"/"NG"), "confidence", "note"}
+    เพิ่ม backend ใหม่ = subclass + ลงทะเบียนใน _VISION_BACKENDS (เลือกด้วย VISION_BACKEND)
+    max_concurrency = จำนวน batch ที่ VisionBatcher ส่งเข้ามาพร้อมกันได้
+    prepare(image) ถูกเรียกใน thread ของ request ก่อนเข้า batch: decode/preprocess ที่ backend ต้องใช้
+    ควรทำที่นี่ -> รูปที่เสียตอบ 400 เฉพาะ request ของมัน (exception ใน analyze_batch ตกกับทุกรูปใน batch)
+    """
+
+    name = ""
+    max_concurrency = 1
+
+    def prepare(self, image: PreparedImage) -> None:
+        pass
+
+    @abstractmethod
+    def analyze_batch(self, images: List[PreparedImage], questions: List[Optional[str]]) -> List[Dict[str, Any]]:
+        ...
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class StubVisionBackend(VisionBackend):
+    name = "stub"
+
+    def analyze_batch(self, images: List[PreparedImage], questions: List[Optional[str]]) -> List[Dict[str, Any]]:
+        return call_vlm_stub_batch(images, questions)
+
+
+class _RetryBudget:
+    """token bucket ของ retry: deposit() ต่อ request, try_withdraw() ต่อ retry"""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = burst
+        self._lock = threading.Lock()
+
+    def deposit(self, n: int = 1):
+        with self._lock:
+            self.balance = min(self.burst, self.balance + self.ratio * n)
+
+    def try_withdraw(self) -> bool:
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class VisionBackendError(Exception):
+    """vision server ตอบผิดพลาด / ผลไม่ตรง protocol (ไม่ retry)"""
+
+
+def _encode_jpeg(img: Image.Image) -> str:
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+class HttpVisionBackend(VisionBackend):
+    """
+    Client ของ VLM server ผ่าน HTTP (protocol ดู vision_standin_server.py):
+    POST {url}/v1/analyze {"requests": [{"prompt", "image_jpeg_base64", "tiles": [{"box", "image_jpeg_base64"}]}]}
+    -> {"results": [{"defect_type", "status", "confidence", "note"}]}
+    - requests.Session + connection pool ขนาด max_concurrency (keep-alive, ไม่ต้อง handshake ใหม่ทุก batch)
+    - timeout แยก connect / read
+    - retry เฉพาะ error ชั่วคราว (connection, timeout, 429/502/503/504) แบบ exponential backoff ภายใน retry budget
+    - semaphore จำกัดจำนวน request ที่ค้างที่ server พร้อมกัน
+    ล้มเหลวหลัง retry -> HTTPException 503
+    """
+
+    name = "http"
+    _RETRY_STATUS = {429, 502, 503, 504}
+
+    def __init__(
+        self,
+        url: str = VISION_URL,
+        max_concurrency: int = VISION_MAX_CONCURRENCY,
+        timeout: Tuple[float, float] = (VISION_CONNECT_TIMEOUT, VISION_TIMEOUT),
+        retries: int = VISION_RETRIES,
+        retry_budget: float = VISION_RETRY_BUDGET,
+    ):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url.rstrip("/") + "/v1/analyze"
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._budget = _RetryBudget(retry_budget, VISION_RETRY_BURST)
+        self._transient = (requests.ConnectionError, requests.Timeout)
+        self._lock = threading.Lock()
+        self.counters = {"batches": 0, "retries": 0, "retries_denied": 0, "failures": 0, "in_flight": 0}
+
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def prepare(self, image: PreparedImage) -> None:
+        image.model_input, image.tiles   # decode ใน thread ของ request (ขนานกัน, error ไม่กระทบ batch)
+
+    def _payload(self, images: List[PreparedImage], questions: List[Optional[str]]) -> Dict[str, Any]:
+        return {
+            "requests": [
+                {
+                    "prompt": build_vision_prompt(question),
+                    "image_jpeg_base64": _encode_jpeg(image.model_input),
+                    "tiles": [
+                        {"box": list(box), "image_jpeg_base64": _encode_jpeg(tile)}
+                        for box, tile in image.tiles
+                    ],
+                }
+                for image, question in zip(images, questions)
+            ]
+        }
+
+    def _post(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST 1 batch พร้อม retry; คืน JSON ของ response ที่สำเร็จ"""
+        self._budget.deposit(len(payload["requests"]))   # เครดิตต่อ request (รูป) ไม่ใช่ต่อ batch
+        attempt = 0
+        while True:
+            try:
+                with self._slots:
+                    self._count("in_flight")
+                    try:
+                        r = self.session.post(self.url, json=payload, timeout=self.timeout)
+                    finally:
+                        self._count("in_flight", -1)
+                if r.status_code not in self._RETRY_STATUS:
+                    if r.status_code != 200:
+                        raise VisionBackendError(f"HTTP {r.status_code}: {r.text[:200]}")
+                    return r.json()
+                error = f"HTTP {r.status_code}"
+            except self._transient as e:
+                error = f"{type(e).__name__}: {e}"
+
+            if attempt >= self.retries:
+                raise VisionBackendError(f"{error} (after {attempt} retries)")
+            if not self._budget.try_withdraw():
+                self._count("retries_denied")
+                raise VisionBackendError(f"{error} (retry budget exhausted)")
+            self._count("retries")
+            time.sleep(VISION_RETRY_BACKOFF * (2 ** attempt) * (0.5 + np.random.random()))
+            attempt += 1
+
+    def analyze_batch(self, images: List[PreparedImage], questions: List[Optional[str]]) -> List[Dict[str, Any]]:
+        self._count("batches")
+        try:
+            body = self._post(self._payload(images, questions))
+            results = body.get("results") if isinstance(body, dict) else None
+            if not isinstance(results, list) or len(results) != len(images):
+                raise VisionBackendError(f"expected {len(images)} results, got {body!r:.200}")
+            for res in results:
+                if not isinstance(res, dict) or res.get("status") not in ("OK", "NG") or "defect_type" not in res or "confidence" not in res:
+                    raise VisionBackendError(f"invalid result {res!r:.200}")
+            return results
+        except (VisionBackendError, ValueError) as e:
+            self._count("failures")
+            print(f"[Vision] {self.url} failed: {e}")
+            raise HTTPException(status_code=503, detail=f"Vision backend unavailable: {e}", headers={"Retry-After": "5"})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "url": self.url,
+                "max_concurrency": self.max_concurrency,
+                "retry_budget_balance": round(self._budget.balance, 2),
+                **self.counters,
+            }
+
+
+_VISION_BACKENDS = {"stub": StubVisionBackend, "http": HttpVisionBackend}
+
+
+def load_vision_backend(backend: str = VISION_BACKEND) -> VisionBackend:
+    if backend not in _VISION_BACKENDS:
+        raise ValueError(f"Unknown vision backend '{backend}' (expected one of {sorted(_VISION_BACKENDS)})")
+    return _VISION_BACKENDS[backend]()
+
+
+# ------------------------------------------------------------
+# ========== Vision Batching =================================
+# ------------------------------------------------------------
+
+class _Histogram:
+    """นับค่าตาม bucket (upper bound แบบ Prometheus: value <= bound) + count/sum"""
+
+    def __init__(self, bounds: Iterable[float]):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)   # ช่องสุดท้าย = +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[int(np.searchsorted(self.bounds, value))] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"le_{b:g}" for b in self.bounds] + ["le_inf"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+        }
+
+
+def _popcount64(x: np.ndarray) -> np.ndarray:
+    """จำนวน bit ที่เป็น 1 ของ uint64 แต่ละตัว"""
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class VisionResultCache:
+    """
+    Cache ผล vision ตาม (dHash, คำถาม) แบบ near-duplicate:
+    lookup scan hash ทั้งหมดใน numpy ครั้งเดียว (xor + popcount) แล้วเลือก entry ที่ใกล้สุดที่ยังไม่หมดอายุ
+    และคำถามตรงกัน; slot เต็ม -> แทนที่ slot ว่าง/หมดอายุก่อน ไม่มีก็ LRU
+    """
+
+    def __init__(
+        self,
+        size: int = VISION_CACHE_SIZE,
+        ttl: float = VISION_CACHE_TTL,
+        max_distance: int = VISION_CACHE_MAX_DISTANCE,
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._hashes = np.zeros(size, dtype=np.uint64)
+        self._qids = np.full(size, -1, dtype=np.int64)
+        self._expires = np.zeros(size, dtype=np.float64)    # 0 = slot ว่าง
+        self._last_used = np.zeros(size, dtype=np.float64)
+        self._results: List[Optional[Dict[str, Any]]] = [None] * size
+        self._question_ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _qid(self, question: Optional[str]) -> int:
+        key = " ".join((question or "").lower().split())
+        if key not in self._question_ids:
+            if len(self._question_ids) > 4 * self.size:   # คำถามที่ไม่ได้ใช้แล้วสะสม -> เริ่ม id ใหม่
+                self._question_ids.clear()
+                self._expires[:] = 0
+            self._question_ids[key] = len(self._question_ids)
+        return self._question_ids[key]
+
+    def get(self, phash: int, question: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not self.size:
+            return None
+        now = time.time()
+        with self._lock:
+            live = (self._expires > now) & (self._qids == self._qid(question))
+            if live.any():
+                dist = _popcount64(self._hashes ^ np.uint64(phash))
+                dist[~live] = 65
+                slot = int(np.argmin(dist))
+                if dist[slot] <= self.max_distance:
+                    self._last_used[slot] = now
+                    self.hits += 1
+                    return dict(self._results[slot])
+            self.misses += 1
+            return None
+
+    def put(self, phash: int, question: Optional[str], result: Dict[str, Any]):
+        if not self.size:
+            return
+        now = time.time()
+        with self._lock:
+            expired = np.flatnonzero(self._expires <= now)
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+            self._hashes[slot] = phash
+            self._qids[slot] = self._qid(question)
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._results[slot] = dict(result)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": self.size,
+                "entries": int((self._expires > time.time()).sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class VisionBatcher:
+    """
+    Dynamic micro-batching หน้า vision backend
+    - submit() (เรียกจาก thread ของ request) ใส่งานลงคิวแล้วรอผลของรูปนั้น
+    - worker thread รอจนได้ max_batch งาน หรือครบ max_wait_ms นับจากงานแรก แล้วเรียก batch_fn ครั้งเดียว
+      (workers thread -> มีได้ถึง workers batch ที่กำลังประมวลผลพร้อมกัน)
+    - exception จาก batch_fn ถูกส่งกลับไปทุก request ใน batch นั้น
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[PreparedImage], List[Optional[str]]], List[Dict[str, Any]]],
+        max_batch: int = VISION_BATCH_MAX,
+        max_wait_ms: float = VISION_BATCH_WAIT_MS,
+        workers: int = 1,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.workers = max(1, workers)
+        self._queue: Deque[Tuple[PreparedImage, Optional[str], Future, float]] = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self.batch_sizes = _Histogram(range(1, self.max_batch + 1))
+        self.queue_depth = _Histogram([0, 1, 2, 4, 8, 16, 32, 64, 128])
+        self.wait_ms = _Histogram([1, 2, 5, 10, 20, 50, 100, 250, 1000])
+
+    def submit(self, image: PreparedImage, question: Optional[str] = None) -> Dict[str, Any]:
+        future: Future = Future()
+        with self._cond:
+            if not self._threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._run, name=f"vision-batcher-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+            self.queue_depth.observe(len(self._queue))   # จำนวนงานที่รออยู่ก่อนหน้า request นี้
+            self._queue.append((image, question, future, time.perf_counter()))
+            self._cond.notify()
+        return future.result()
+
+    def _next_batch(self) -> List[Tuple[PreparedImage, Optional[str], Future, float]]:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0][3] + self.max_wait
+            while len(self._queue) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            n = min(len(self._queue), self.max_batch)
+            batch = [self._queue.popleft() for _ in range(n)]
+            now = time.perf_counter()
+            self.batch_sizes.observe(n)
+            for *_, enqueued in batch:
+                self.wait_ms.observe((now - enqueued) * 1000)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.batch_fn([b[0] for b in batch], [b[1] for b in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"vision backend returned {len(results)} results for {len(batch)} images")
+            except Exception as e:
+                for *_, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (*_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000,
+                "workers": self.workers,
+                "queued": len(self._queue),
+                "batch_size": self.batch_sizes.snapshot(),
+                "queue_depth": self.queue_depth.snapshot(),
+                "wait_ms": self.wait_ms.snapshot(),
+            }
+
+
+vision_backend = load_vision_backend()
+vision_batcher = VisionBatcher(vision_backend.analyze_batch, workers=vision_backend.max_concurrency)
+vision_cache = VisionResultCache()
+
+
 # ------------------------------------------------------------
 # ========== Logging (SQLite + images) =======================
 # ------------------------------------------------------------
@@ -230,25 +3181,57 @@ def init_db():
             confidence REAL,
             latency_ms REAL,
             image_path TEXT,
-            response_json TEXT
+            response_json TEXT,
+            thumb_path TEXT,
+            cache_hit INTEGER DEFAULT 0
         )
         """
     )
+    # DB เก่า: เพิ่มคอลัมน์ที่มาทีหลัง
+    cur.execute("PRAGMA table_info(logs)")
+    cols = [row[1] for row in cur.fetchall()]
+    if "thumb_path" not in cols:
+        cur.execute("ALTER TABLE logs ADD COLUMN thumb_path TEXT")
+    if "cache_hit" not in cols:
+        cur.execute("ALTER TABLE logs ADD COLUMN cache_hit INTEGER DEFAULT 0")
     conn.commit()
     conn.close()
     print(f"[DB] SQLite ready at {DB_PATH}")
 
 
-def save_log(req: AnalyzeRequest, resp: AnalyzeResponse, img_bytes: bytes) -> None:
+# thumbnail ของ log สร้างทีละรูปนอก request thread (request ไม่ต้องรอ decode/encode)
+_thumbnail_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-thumbnail")
+
+
+def write_log_thumbnail(img_path: Path, thumb_path: Path):
+    """thumbnail LOG_THUMB_SIZE จากไฟล์ log (JPEG decode แบบ draft ที่ 1/2-1/8) หมุนตาม EXIF"""
+    try:
+        with Image.open(img_path) as img:
+            img.draft("RGB", (LOG_THUMB_SIZE, LOG_THUMB_SIZE))
+            thumb = _fit(img.convert("RGB"), LOG_THUMB_SIZE)
+            orientation = img.getexif().get(ExifTags.Base.Orientation, 1)   # decode แล้ว -> ไม่ต้องอ่านซ้ำ
+        method = _EXIF_TRANSPOSE.get(orientation)
+        thumb = thumb.transpose(method) if method is not None else thumb
+        thumb.save(thumb_path, "JPEG", quality=LOG_JPEG_QUALITY)
+    except Exception as e:
+        print(f"[DB] WARNING: cannot write thumbnail {thumb_path}: {e!r}")
+
+
+def save_log(
+    client_id: Optional[str], question: Optional[str], resp: AnalyzeResponse, image: PreparedImage
+) -> None:
     ts = datetime.utcnow().isoformat()
     safe_ts = ts.replace(":", "-")
-    client_id = req.client_id or "unknown"
+    client_id = client_id or "unknown"
 
-    # เซฟรูป
-    filename = f"{safe_ts}_{resp.defect_type}_{resp.status}.png"
-    img_path = LOG_DIR / filename
+    # เซฟรูป: byte ที่ upload มาตามเดิม (copy อย่างเดียว) + thumbnail สำหรับ dashboard ใน background
+    stem = f"{safe_ts}_{resp.defect_type}_{resp.status}"
+    img_path = LOG_DIR / f"{stem}.{image.source.format.lower()}"
+    thumb_path = LOG_DIR / f"{stem}_thumb.jpg"
+    image.source.file.seek(0)
     with open(img_path, "wb") as f_img:
-        f_img.write(img_bytes)
+        shutil.copyfileobj(image.source.file, f_img)
+    _thumbnail_pool.submit(write_log_thumbnail, img_path, thumb_path)
 
     # เซฟ log ใน DB
     conn = sqlite3.connect(DB_PATH)
@@ -257,26 +3240,244 @@ def save_log(req: AnalyzeRequest, resp: AnalyzeResponse, img_bytes: bytes) -> No
         """
         INSERT INTO logs (
             ts, client_id, question, defect_type, status,
-            confidence, latency_ms, image_path, response_json
+            confidence, latency_ms, image_path, response_json, thumb_path, cache_hit
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
             ts,
             client_id,
-            req.question,
+            question,
             resp.defect_type,
             resp.status,
             resp.confidence,
             resp.latency_ms,
             str(img_path),
             resp.model_dump_json(ensure_ascii=False),
+            str(thumb_path),
+            int(resp.cache_hit),
         ),
     )
     conn.commit()
     conn.close()
 
 
+# ------------------------------------------------------------
+# ========== Readiness =======================================
+# ------------------------------------------------------------
+
+class ServiceState:
+    """
+    สถานะ warm-up ของ backend:
+    starting -> loading_index -> loading_model -> warming -> ready (หรือ failed)
+    ready + degraded = serve index ที่เปิดอยู่ได้ แต่ sync กับ manuals/ มีปัญหา (PDF เสีย, rebuild ล้ม)
+    """
+
+    def __init__(self):
+        self.state = "starting"
+        self.detail = ""
+        self.degraded: Optional[str] = None
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+
+    def set(self, state: str, detail: str = "", degraded: Optional[str] = None):
+        # degraded ตั้งก่อน state -> /readyz ไม่เห็น ready ที่ยังไม่มีเหตุผล degraded
+        self.degraded = degraded
+        self.detail = detail
+        self.state = state
+        if state == "ready" and self.ready_at is None:
+            self.ready_at = time.time()
+        print(f"[Startup] state={state} {detail}".rstrip())
+        if degraded:
+            print(f"[Startup] degraded: {degraded}")
+
+    def degrade(self, reason: Optional[str]):
+        """ตั้ง/ล้างสถานะ degraded (ยัง ready อยู่)"""
+        if reason and reason != self.degraded:
+            print(f"[Startup] degraded: {reason}")
+        self.degraded = reason or None
+
+    @property
+    def warming_up(self) -> bool:
+        """warm-up ตอน startup ยังไม่จบ (ยังไม่ ready และยังไม่ failed)"""
+        return self.state not in ("ready", "failed")
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "detail": self.detail,
+            "degraded": self.degraded,
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "ready_after_s": (
+                round(self.ready_at - self.started_at, 1) if self.ready_at else None
+            ),
+        }
+
+
+service_state = ServiceState()
+
+
+def warm_up():
+    """
+    โหลด model + sync index กับ manuals/ + warm cache ใน background thread
+    sync ล้มแต่มี index เดิมเปิดอยู่แล้ว -> serve ตัวเดิมต่อในสถานะ ready + degraded
+    """
+    sync_error = None
+    try:
+        with _reload_lock:
+            service_state.set("loading_model")
+            manual_index._ensure_model()
+            service_state.set("loading_index")
+            try:
+                next_index = _build_next_index()
+            except Exception as e:
+                if not len(manual_index):
+                    raise
+                print(f"[RAG] WARNING: index sync failed, serving existing index {manual_index.index_id}: {e!r}")
+                reload_status["last_error"] = repr(e)
+                sync_error = f"index sync failed: {e!r}"
+                next_index = manual_index
+            service_state.set("warming")
+            _publish_index(next_index)
+        service_state.set("ready", degraded=sync_error or _skipped_detail(manual_index))
+    except Exception as e:
+        # ไม่ raise ต่อใน daemon thread: สถานะ failed บันทึกใน service_state แล้ว (/readyz, /admin/reload_index กู้ได้)
+        print(f"[RAG] ERROR: warm-up failed: {e!r}")
+        service_state.set("failed", repr(e))
+
+
+# ------------------------------------------------------------
+# ========== Index Hot Reload ================================
+# ------------------------------------------------------------
+# index ใหม่ถูก build เป็น ManualIndex อีกตัว (ไม่แตะตัวที่ serve อยู่) แล้วสลับ global manual_index
+# ด้วย assignment เดียว; request ที่เริ่มไปแล้วถือ reference ตัวเดิมไว้ใช้จนจบ
+# (memmap ของ index เดิมยังอ่านได้แม้ directory ถูกแทนที่แล้ว)
+
+_reload_lock = threading.Lock()          # build + swap ทีละครั้ง (รวม warm_up ตอน startup)
+_reload_status_lock = threading.Lock()   # กัน watcher กับ admin endpoint เริ่ม reload ซ้อนกัน
+reload_status: Dict[str, Any] = {"running": False, "last_reload": None, "last_error": None}
+
+
+def _build_next_index() -> ManualIndex:
+    """
+    sync index บน disk กับ manuals/ ลงใน ManualIndex ตัวใหม่ที่แชร์ model กับตัวปัจจุบัน
+    INDEX_AUTO_BUILD ปิด -> เปิด index artifact ที่อยู่ใน INDEX_DIR อย่างเดียว
+    """
+    next_index = ManualIndex()
+    next_index.model = manual_index.model
+    next_index._ensure_model()
+    if INDEX_AUTO_BUILD:
+        next_index.load_or_build(MANUAL_DIR)
+    else:
+        next_index.open_existing()
+    return next_index
+
+
+def _skipped_detail(index: ManualIndex) -> Optional[str]:
+    if not index.skipped:
+        return None
+    return "skipped unreadable manuals: " + ", ".join(
+        f"{name} ({info['error']})" for name, info in sorted(index.skipped.items())
+    )
+
+
+def warm_defect_queries(index: ManualIndex):
+    """pre-warm + เซฟผลของ defect vocabulary สำหรับทุก manual และทุก machine tag"""
+    machines = load_machine_tags().get("machines", {})
+    index.warm_cache(
+        sorted({rag_query_for(d) for d in DEFECT_TYPES}),
+        filters=[None] + [manuals_for_machine(index, m) for m in machines],
+    )
+
+
+def _publish_index(next_index: ManualIndex):
+    global manual_index
+    warm_defect_queries(next_index)
+    manual_index = next_index
+    print(f"[RAG] Serving index {next_index.index_id} ({len(next_index)} chunks)")
+
+
+def reload_index() -> Dict[str, Any]:
+    """Build index จาก manuals/ ปัจจุบัน แล้วสลับเข้าแทนถ้าเนื้อหาเปลี่ยน"""
+    with _reload_lock:
+        t0 = time.time()
+        current = manual_index
+        next_index = _build_next_index()
+        changed = next_index.index_id != current.index_id
+        if changed:
+            _publish_index(next_index)
+        else:
+            current.manuals = next_index.manuals   # mtime ที่อัปเดตใน manifest (ไฟล์ถูก touch)
+            current.skipped = next_index.skipped
+        return {
+            "changed": changed,
+            "index_version": manual_index.index_id,
+            "elapsed_s": round(time.time() - t0, 2),
+        }
+
+
+def _claim_reload() -> bool:
+    with _reload_status_lock:
+        if reload_status["running"]:
+            return False
+        reload_status["running"] = True
+        return True
+
+
+def _run_reload():
+    """
+    reload_index() พร้อมบันทึกผลใน reload_status และอัปเดต service_state; ต้อง _claim_reload() ได้ก่อนเรียก
+    สำเร็จ -> ready (กู้จาก failed ได้), ล้มขณะ ready -> ยัง serve index เดิมแต่ degraded
+    """
+    try:
+        reload_status["last_reload"] = {**reload_index(), "finished_at": datetime.now().isoformat()}
+        reload_status["last_error"] = None
+        if service_state.ready:
+            service_state.degrade(_skipped_detail(manual_index))
+        else:
+            service_state.set("ready", degraded=_skipped_detail(manual_index))
+    except Exception as e:
+        reload_status["last_error"] = repr(e)
+        print(f"[RAG] WARNING: index reload failed: {e!r}")
+        if service_state.ready:
+            service_state.degrade(f"index reload failed, serving {manual_index.index_id}: {e!r}")
+        else:
+            service_state.set("failed", repr(e))
+    finally:
+        reload_status["running"] = False
+
+
+def watch_manuals():
+    """
+    Poll MANUAL_DIR ทุก INDEX_WATCH_INTERVAL วินาที
+    reload เมื่อ PDF ไม่ตรงกับ index (หรือ service อยู่ในสถานะ failed) และ stat ไม่เปลี่ยนจากรอบก่อน
+    (ไฟล์ copy เสร็จแล้ว); reload ที่ล้มไม่ลองซ้ำกับ manuals/ ชุดเดิมจนกว่าไฟล์จะเปลี่ยน
+    """
+    previous = None
+    failed_stats = None
+    while True:
+        time.sleep(INDEX_WATCH_INTERVAL)
+        if service_state.warming_up:
+            continue
+        try:
+            stats = _pdf_stats(MANUAL_DIR)
+        except OSError as e:
+            print(f"[RAG] WARNING: cannot scan {MANUAL_DIR}: {e}")
+            continue
+        stable, previous = stats == previous, stats
+        if not stable or stats == failed_stats:
+            continue
+        due = service_state.state == "failed" or manual_index.is_stale(MANUAL_DIR)
+        if due and _claim_reload():
+            print("[RAG] Change detected in manuals/ -> rebuilding index in background")
+            _run_reload()
+            failed_stats = stats if reload_status["last_error"] else None
+
+
 # ------------------------------------------------------------
 # ========== FastAPI App =====================================
 # ------------------------------------------------------------
@@ -298,28 +3499,113 @@ def startup_event():
     LOG_DIR.mkdir(parents=True, exist_ok=True)
 
     init_db()
-    manual_index.load_or_build(MANUAL_DIR)
-    print("[Startup] RAG index ready.")
+    # เปิด index เดิม (memmap) + ผล per-defect ที่ precompute ไว้ได้ทันที
+    # ส่วนที่ช้า (โหลด model, rebuild, warm cache) ทำใน background
+    manual_index.open_existing()
+    threading.Thread(target=warm_up, name="rag-warm-up", daemon=True).start()
+    if INDEX_AUTO_BUILD and INDEX_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_manuals, name="rag-manual-watcher", daemon=True).start()
+
+
+@app.get("/healthz")
+def healthz():
+    """liveness: process ยังตอบได้"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """readiness: 200 เมื่อ model + index พร้อม (รวม degraded ดู field "degraded"), ไม่งั้น 503 พร้อมสถานะ warm-up"""
+    body = service_state.as_dict()
+    if not service_state.ready:
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    return body
+
+
+@app.post("/admin/reload_index", status_code=202)
+def admin_reload_index():
+    """เริ่ม rebuild index จาก manuals/ ใน background (ใช้ลองใหม่จากสถานะ failed ได้); ดูผลที่ GET /admin/index"""
+    if service_state.warming_up:
+        raise HTTPException(
+            status_code=503,
+            detail=f"RAG index is not ready ({service_state.state})",
+            headers={"Retry-After": "5"},
+        )
+    started = _claim_reload()   # False = มี reload (จาก watcher หรือ request ก่อนหน้า) ทำอยู่แล้ว
+    if started:
+        threading.Thread(target=_run_reload, name="rag-reload", daemon=True).start()
+    return {"started": started, "index_version": manual_index.index_id}
 
 
-@app.post("/analyze", response_model=AnalyzeResponse)
-def analyze(req: AnalyzeRequest):
-    t0 = time.time()
+@app.get("/admin/index")
+def admin_index():
+    index = manual_index
+    return {
+        "index_version": index.index_id,
+        "chunks": len(index),
+        "manuals": sorted(index.manuals),
+        "stale": index.is_stale(MANUAL_DIR),
+        "reload": reload_status,
+    }
 
-    # 1) decode รูป
-    img, img_bytes = decode_image(req.image_base64)
 
-    # 2) คอล Vision (ตอนนี้ใช้ stub)
-    _ = build_vision_prompt(req.question)  # เผื่อใช้ในอนาคตกับ VLM จริง
-    vision_result = call_vlm_stub(req.image_base64, req.question)
+@app.get("/admin/vision")
+def admin_vision():
+    """สถิติ micro-batching ของ vision (histogram ของ batch size, queue depth, เวลารอในคิว) + ของ backend"""
+    return {**vision_batcher.stats(), "backend": vision_backend.stats(), "cache": vision_cache.stats()}
+
+
+def analyze_image(
+    image_file: BinaryIO, question: Optional[str] = None, client_id: Optional[str] = None
+) -> AnalyzeResponse:
+    """vision -> RAG -> คำแนะนำ -> log จากรูปใน file object (ใช้ร่วมกันทั้ง /analyze และ /analyze/upload)"""
+    t0 = time.time()
+    index = manual_index   # ใช้ index ตัวเดียวตลอด request แม้จะมี reload สลับ global ระหว่างทาง
+
+    # 1) ตรวจรูปจาก header (ยังไม่ decode pixel) -> preprocessing แบบ lazy ใช้ร่วมกันทั้ง vision และ log
+    img = preprocess_image(validate_image(image_file))
+
+    # ระหว่าง warm-up ตอบได้เฉพาะจากผล per-defect ที่ precompute ไว้ -> ถ้าไม่มีครบทุก defect
+    # ตอบ 503 ตอนนี้เลย ไม่ต้องรอ vision ก่อน
+    manuals = manuals_for_machine(index, machine_for_client(client_id))
+    ready = service_state.ready
+    if not ready and any(
+        index.lookup_cached(rag_query_for(d), top_k=3, manuals=manuals) is None for d in DEFECT_TYPES
+    ):
+        raise HTTPException(
+            status_code=503,
+            detail=f"RAG index is not ready ({service_state.state})",
+            headers={"Retry-After": "5"},
+        )
+
+    # 2) คอล Vision (VISION_BACKEND) ผ่าน micro-batcher -> request ที่มาพร้อมกันรวมเป็น batch เดียว
+    #    รูปที่เกือบเหมือนรูปก่อนหน้า (dHash) + คำถามเดิม -> ใช้ผลจาก cache
+    #    (VISION_CACHE_SIZE=0 -> ไม่คำนวณ dHash เลย)
+    vision_result = vision_cache.get(img.dhash, question) if vision_cache.size else None
+    cache_hit = vision_result is not None
+    if not cache_hit:
+        vision_backend.prepare(img)
+        vision_result = vision_batcher.submit(img, question)
+        if vision_cache.size:
+            vision_cache.put(img.dhash, question, vision_result)
 
     defect_type = vision_result["defect_type"]
     status = vision_result["status"]
     confidence = float(vision_result["confidence"])
 
     # 3) RAG
-    rag_query = defect_type if defect_type != "normal" else "preventive maintenance"
-    rag_results = manual_index.search(rag_query, top_k=3)
+    rag_query = rag_query_for(defect_type)
+    if ready:
+        rag_results = index.search(rag_query, top_k=3, manuals=manuals)
+    else:
+        # ระหว่าง warm-up: ผล per-defect ที่ precompute ไว้ (defect นอก DEFECT_TYPES จาก backend จริง -> 503)
+        rag_results = index.lookup_cached(rag_query, top_k=3, manuals=manuals)
+        if rag_results is None:
+            raise HTTPException(
+                status_code=503,
+                detail=f"RAG index is not ready ({service_state.state})",
+                headers={"Retry-After": "5"},
+            )
 
     # 4) สร้างข้อความแนะนำ
     if not rag_results:
@@ -357,14 +3643,155 @@ def analyze(req: AnalyzeRequest):
         action_recommended=action_text,
         rag_sources=rag_results,
         latency_ms=latency_ms,
+        index_version=index.index_id,
+        cache_hit=cache_hit,
     )
 
     # 5) เซฟ log บนเครื่องเซิร์ฟเวอร์
-    save_log(req, resp_obj, img_bytes)
+    save_log(client_id, question, resp_obj, img)
 
     return resp_obj
 
 
+@app.post("/analyze", response_model=AnalyzeResponse)
+def analyze(req: AnalyzeRequest):
+    return analyze_image(decode_image(req.image_base64), req.question, req.client_id)
+
+
+async def _spool_body(request: Request) -> BinaryIO:
+    """stream raw body ลง SpooledTemporaryFile (ไม่ถือทั้งรูปใน RAM); เกิน MAX_UPLOAD_BYTES -> 413"""
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+            spool.write(chunk)
+        if not size:
+            raise HTTPException(status_code=400, detail="Empty request body")
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+_BINARY_SCHEMA = {"schema": {"type": "string", "format": "binary"}}
+_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "image": {"type": "string", "format": "binary"},
+                        "question": {"type": "string"},
+                        "client_id": {"type": "string"},
+                    },
+                    "required": ["image"],
+                }
+            },
+            "image/*": _BINARY_SCHEMA,
+            "application/octet-stream": _BINARY_SCHEMA,
+        },
+    }
+}
+
+
+@app.post("/analyze/upload", response_model=AnalyzeResponse, openapi_extra=_UPLOAD_OPENAPI)
+async def analyze_upload(request: Request, question: Optional[str] = None, client_id: Optional[str] = None):
+    """
+    /analyze แบบส่งรูปเป็น binary (ไม่ต้อง base64 -> payload เล็กลง ~25%, ไม่ต้อง parse JSON ก้อนใหญ่)
+    - multipart/form-data: field "image" + (optional) "question", "client_id"
+    - raw body (image/* หรือ application/octet-stream): question, client_id เป็น query parameter
+    response เหมือน /analyze ทุกอย่าง
+    """
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # starlette spool ไฟล์ใน form ลง SpooledTemporaryFile อยู่แล้ว และลบทิ้งตอนปิด form
+        async with request.form(max_files=1) as form:
+            upload = form.get("image")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(status_code=400, detail="multipart field 'image' (file) is required")
+            if (upload.size or 0) > MAX_UPLOAD_BYTES:   # chunked upload ที่ไม่มี Content-Length
+                raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+            return await run_in_threadpool(
+                analyze_image,
+                upload.file,
+                form.get("question") or question,
+                form.get("client_id") or client_id,
+            )
+
+    spool = await _spool_body(request)
+    try:
+        return await run_in_threadpool(analyze_image, spool, question, client_id)
+    finally:
+        spool.close()
+
+
+@app.post("/rag/search_many", response_model=RAGSearchManyResponse)
+def rag_search_many(req: RAGSearchManyRequest):
+    """ค้น manual หลาย query ในครั้งเดียว (เช่น nightly job ที่ดึง guidance ให้ทุก NG log)"""
+    if len(req.queries) > SEARCH_MANY_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many queries: {len(req.queries)} (max {SEARCH_MANY_MAX_QUERIES})",
+        )
+    if not 1 <= req.top_k <= 50:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 50")
+    # query ว่าง/มีแต่ช่องว่าง -> ไม่มี token ให้ match, dense ก็คืนผลสุ่ม
+    blank = [i for i, q in enumerate(req.queries) if not q.strip()]
+    if blank:
+        raise HTTPException(status_code=400, detail=f"Blank queries at positions: {blank}")
+    if not service_state.ready:
+        raise HTTPException(
+            status_code=503,
+            detail=f"RAG index is not ready ({service_state.state})",
+            headers={"Retry-After": "5"},
+        )
+    t0 = time.time()
+    index = manual_index
+    manuals = req.manuals
+    if manuals is not None:
+        unknown = sorted(set(manuals) - set(index.manual_names))
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown manuals: {unknown}")
+    elif req.machine is not None:
+        if req.machine not in load_machine_tags().get("machines", {}):
+            raise HTTPException(status_code=400, detail=f"Unknown machine tag: {req.machine}")
+        manuals = manuals_for_machine(index, req.machine)
+    results = index.search_many(req.queries, top_k=req.top_k, manuals=manuals)
+    return RAGSearchManyResponse(
+        results=[RAGQueryResult(query=q, sources=r) for q, r in zip(req.queries, results)],
+        latency_ms=(time.time() - t0) * 1000,
+        index_version=index.index_id,
+    )
+
+
+@app.get("/manuals/{manual_name}/pages/{page}", response_model=ManualPage)
+def manual_page(manual_name: str, page: int):
+    """Full text ของหน้าใน manual (สำหรับ RAGSource) จาก page_text_cache โดยไม่ต้องเปิด PDF"""
+    entry = manual_index.manuals.get(manual_name)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Unknown manual: {manual_name}")
+    if not 1 <= page <= entry["pages"]:
+        raise HTTPException(status_code=404, detail=f"{manual_name} has no page {page}")
+    text = page_text_cache.get(entry["sha256"], page - 1)
+    if text is None:
+        # cache ถูกลบไป -> extract หน้าเดียวจาก PDF แล้วเก็บไว้
+        pdf_path = MANUAL_DIR / manual_name
+        if not pdf_path.exists():
+            raise HTTPException(status_code=404, detail=f"Manual file not found: {manual_name}")
+        pages = _extract_page_range(str(pdf_path), page - 1, page)
+        page_text_cache.put_pages(entry["sha256"], pages)
+        text = pages[0][1]
+    return ManualPage(manual_name=manual_name, page=page, text=text)
+
+
 if __name__ == "__main__":
     import uvicorn
     import os
@@ -0,0 +1,109 @@
+"""
+Fixtures ของ test backend: แยก path ทั้งหมดไปที่ tmp_path และใช้ embedder ปลอมแบบ deterministic
+(ไม่ต้องมี torch / sentence-transformers / network)
+"""
+
+import hashlib
+import os
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# ต้องตั้งก่อน import backend (default args ของ ManualIndex อ่านตอน import)
+os.environ.setdefault("RAG_EXTRACT_WORKERS", "1")
+os.environ.setdefault("RAG_EMBED_WORKERS", "1")
+os.environ.setdefault("RAG_WATCH_INTERVAL", "0")
+os.environ.setdefault("VISION_BATCH_WAIT_MS", "5")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import maintenance_agent_backend as backend  # noqa: E402
+
+FAKE_DIM = 64
+
+
+class FakeEmbedder(backend.EmbeddingBackend):
+    """bag-of-words hashing -> vector (L2-normalize); ข้อความที่มีคำร่วมกันได้ cosine สูง"""
+
+    name = "fake"
+    dim = FAKE_DIM
+
+    def encode(self, texts, batch_size=32):
+        if isinstance(texts, str):
+            texts = [texts]
+        out = np.zeros((len(texts), FAKE_DIM), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "little")
+                out[i, h % FAKE_DIM] += 1.0 if (h >> 16) & 1 else -1.0
+        return backend._l2_normalize(out)
+
+
+def _pdf_string(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(path: Path, pages):
+    """เขียน PDF ขั้นต่ำที่ pypdf extract text ได้: 1 บรรทัดต่อหน้า"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 10 Tf 36 760 Td ({_pdf_string(text)}) Tj ET".encode("latin-1")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream.decode('latin-1')}\nendstream")
+        content_id = len(objects)
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    path.write_bytes(bytes(out))
+    return path
+
+
+_PARTS = ["bearing", "gasket", "impeller", "coupling", "shaft", "housing", "filter", "motor", "belt", "nozzle"]
+_ACTIONS = ["inspect", "replace", "tighten", "lubricate", "clean", "align", "measure", "drain"]
+
+
+def manual_pages(topic: str, n: int):
+    """หน้าที่มีคำไม่ซ้ำกัน (ไม่ถูกตัดเป็น boilerplate)"""
+    return [
+        f"{topic} {_ACTIONS[i % len(_ACTIONS)]} {_PARTS[i % len(_PARTS)]} "
+        f"{_PARTS[(3 * i + 1) % len(_PARTS)]} procedure {topic}{i}"
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def rag_env(tmp_path, monkeypatch):
+    """backend ที่ทุก path อยู่ใน tmp_path + state ใหม่ (index, readiness, reload status)"""
+    monkeypatch.setattr(backend, "MANUAL_DIR", tmp_path / "manuals")
+    monkeypatch.setattr(backend, "INDEX_DIR", tmp_path / "manual_index")
+    monkeypatch.setattr(backend, "LEGACY_INDEX_PATH", tmp_path / "manual_index.npz")
+    monkeypatch.setattr(backend, "LOG_DIR", tmp_path / "logs")
+    monkeypatch.setattr(backend, "DB_PATH", tmp_path / "logs" / "maintenance_logs.db")
+    monkeypatch.setattr(backend, "MACHINE_TAGS_PATH", tmp_path / "machine_tags.json")
+    monkeypatch.setattr(backend, "embedding_cache", backend.EmbeddingCache(tmp_path / "emb.db", 64 << 20))
+    monkeypatch.setattr(backend, "page_text_cache", backend.PageTextCache(tmp_path / "pages.db"))
+    monkeypatch.setattr(backend, "load_embedder", lambda *a, **kw: FakeEmbedder())
+    monkeypatch.setattr(backend, "manual_index", backend.ManualIndex())
+    monkeypatch.setattr(backend, "service_state", backend.ServiceState())
+    monkeypatch.setitem(backend.reload_status, "running", False)
+    monkeypatch.setitem(backend.reload_status, "last_error", None)
+    monkeypatch.setitem(backend.reload_status, "last_reload", None)
+    (tmp_path / "manuals").mkdir()
+    yield tmp_path
+    backend.manual_index._unload()
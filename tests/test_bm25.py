@@ -0,0 +1,62 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import maintenance_agent_backend as backend
+from conftest import make_pdf, manual_pages
+
+
+def _built_index(rag_env, pages):
+    make_pdf(rag_env / "manuals" / "press.pdf", pages)
+    index = backend.manual_index
+    index._ensure_model()
+    index.load_or_build(rag_env / "manuals")
+    return index
+
+
+def test_tokenize_keeps_thai_and_part_numbers():
+    assert backend._tokenize("Bearing 6204-2RS, bolt M8x1.25 code E-04") == ["bearing", "6204-2rs", "bolt", "m8x1.25", "code", "e-04"]
+    assert backend._tokenize("ปั๊มน้ำรั่ว ตรวจสอบซีล") == ["ปั๊มน้ำรั่ว", "ตรวจสอบซีล"]
+
+
+def test_postings_match_naive_count(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "BM25_BUILD_BLOCK_ROWS", 3)   # หลายบล็อก
+    texts = manual_pages("press", 8) + ["error e-101 หยุดเครื่อง e-101 reset", "", "ปั๊มน้ำรั่ว press press"]
+    blobs = [t.encode("utf-8") for t in texts]
+    np.concatenate([[0], np.cumsum([len(b) for b in blobs])]).astype(np.int64).tofile(tmp_path / "text_offsets.i64")
+    (tmp_path / "texts.bin").write_bytes(b"".join(blobs))
+
+    header = backend._build_bm25(tmp_path, len(texts))
+    bm25 = backend._BM25Index(tmp_path, header["avgdl"])
+    expected = {}
+    for row, text in enumerate(texts):
+        for tok, tf in Counter(backend._tokenize(text)).items():
+            expected.setdefault(tok, []).append((row, tf))
+    assert list(bm25.term_ids) == sorted(expected)
+    for tok, postings in expected.items():
+        i = bm25.term_ids[tok]
+        lo, hi = bm25.offsets[i], bm25.offsets[i + 1]
+        assert list(zip(bm25.docs[lo:hi].tolist(), bm25.tfs[lo:hi].tolist())) == postings
+    assert bm25.doclen.tolist() == [len(backend._tokenize(t)) for t in texts]
+    assert bm25.scores("ปั๊มน้ำรั่ว")[0].tolist() == [len(texts) - 1]
+
+
+def test_exact_token_shortcut_requires_indexed_code(rag_env, monkeypatch):
+    index = _built_index(rag_env, manual_pages("press", 6) + ["paper jam at tray e-101 clear the feed roller"])
+    encoded = []
+    real_encode = index._encode_queries
+    monkeypatch.setattr(index, "_encode_queries", lambda qs: encoded.append(qs) or real_encode(qs))
+
+    scores, rows = index._rank(["e-101"], 3)[0]
+    assert not encoded and "e-101" in index.text(int(rows[0]))
+    # BM25 เทียบกับขอบบนของ query ไม่ใช่ normalize ด้วยอันดับ 1
+    lex_rows, lex_scores = index.bm25.scores("e-101")
+    assert 0.0 < scores[0] < 1.0
+    assert scores[0] == pytest.approx(lex_scores.max() / index.bm25.max_score("e-101"))
+
+    # code ที่ไม่มีใน index -> fuse กับ dense แทนการคืน BM25 ของ "paper jam" อย่างเดียว
+    scores, rows = index._rank(["zz9999 paper jam"], 3)[0]
+    assert encoded == [["zz9999 paper jam"]]
+    assert "paper jam" in index.text(int(rows[0]))
+    assert np.all(scores < 1.0)
@@ -0,0 +1,153 @@
+import subprocess
+import sys
+import textwrap
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import maintenance_agent_backend as backend
+from conftest import FakeEmbedder, make_pdf, manual_pages
+
+
+def _rows(index):
+    """{(manual, page, text): embedding} ของทุก row (ไม่ขึ้นกับลำดับ row)"""
+    out = {}
+    for i in range(len(index)):
+        meta = index.chunk_meta(i)
+        out[(meta["manual_name"], meta["page"], index.text(i))] = np.asarray(index.embeddings[i], dtype=np.float32)
+    return out
+
+
+def _assert_same_index(index, expected):
+    got, want = _rows(index), _rows(expected)
+    assert sorted(got) == sorted(want)
+    for key, emb in want.items():
+        np.testing.assert_allclose(got[key], emb, atol=1e-6)
+    assert {n: m["pages"] for n, m in index.manuals.items()} == {n: m["pages"] for n, m in expected.manuals.items()}
+    for name, (lo, hi) in index.shard_ranges().items():
+        assert {index.chunk_meta(i)["manual_name"] for i in range(lo, hi)} == {name}
+    for query in ["inspect bearing gasket", "valve replace shaft", "press drain nozzle"]:
+        a, b = index.search(query, top_k=3), expected.search(query, top_k=3)
+        assert [(s.manual_name, s.page) for s in a] == [(s.manual_name, s.page) for s in b]
+
+
+def _full_build(rag_env, monkeypatch, name):
+    """index ใหม่จาก PDF ปัจจุบันใน INDEX_DIR แยกต่างหาก"""
+    monkeypatch.setattr(backend, "INDEX_DIR", rag_env / name)
+    index = backend.ManualIndex()
+    index.model = FakeEmbedder()
+    index.build_from_pdfs(rag_env / "manuals")
+    return index
+
+
+def test_incremental_add_remove_matches_full_rebuild(rag_env, monkeypatch):
+    manuals = rag_env / "manuals"
+    make_pdf(manuals / "pump.pdf", manual_pages("pump", 5))
+    make_pdf(manuals / "valve.pdf", manual_pages("valve", 4))
+    index = backend.manual_index
+    index._ensure_model()
+    index.load_or_build(manuals)
+
+    make_pdf(manuals / "press.pdf", manual_pages("press", 6))        # เพิ่ม
+    (manuals / "pump.pdf").unlink()                                  # ลบ
+    make_pdf(manuals / "valve.pdf", manual_pages("valve", 4) + ["valve lubricate seat extra page"])  # เปลี่ยน
+    assert index.update_from_pdfs(manuals)
+    assert set(index.manuals) == {"press.pdf", "valve.pdf"}
+
+    _assert_same_index(index, _full_build(rag_env, monkeypatch, "full_index"))
+
+
+def test_crashed_build_resumes_to_same_index(rag_env, monkeypatch, capsys):
+    manuals = rag_env / "manuals"
+    for topic, n in [("pump", 7), ("valve", 6), ("press", 5)]:
+        make_pdf(manuals / f"{topic}.pdf", manual_pages(topic, n))
+    monkeypatch.setattr(backend, "EMBED_BATCH_SIZE", 2)   # หลาย checkpoint ต่อ manual
+
+    real_checkpoint = backend._IndexWriter.checkpoint
+
+    def crash_mid_manual(self, completed, partial=None):
+        real_checkpoint(self, completed, partial)
+        if len(completed) == 1 and partial is not None:   # กลาง manual ที่ 2 (pump.pdf, หลัง batch แรก)
+            raise RuntimeError("power loss")
+
+    monkeypatch.setattr(backend._IndexWriter, "checkpoint", crash_mid_manual)
+    index = backend.manual_index
+    index._ensure_model()
+    with pytest.raises(RuntimeError, match="power loss"):
+        index.build_from_pdfs(manuals)
+    assert index.embeddings is None
+
+    monkeypatch.setattr(backend._IndexWriter, "checkpoint", real_checkpoint)
+    encoded = []
+    real_encode = FakeEmbedder.encode
+    monkeypatch.setattr(FakeEmbedder, "encode", lambda self, texts, batch_size=32: encoded.extend(texts) or real_encode(self, texts))
+    monkeypatch.setattr(backend, "embedding_cache", backend.EmbeddingCache(rag_env / "emb2.db", 64 << 20))
+    capsys.readouterr()
+    index.build_from_pdfs(manuals)
+    assert "Resuming build from checkpoint: 1 manuals done" in capsys.readouterr().out
+    # ไม่ encode press.pdf (เสร็จแล้ว) และ batch แรกของ pump.pdf (เขียนไว้แล้ว) ซ้ำ
+    assert not any(t.startswith("press") or t.endswith(("pump0", "pump1")) for t in encoded)
+    assert len(encoded) == len(index) - 5 - 2
+
+    monkeypatch.setattr(FakeEmbedder, "encode", real_encode)
+    _assert_same_index(index, _full_build(rag_env, monkeypatch, "clean_index"))
+
+
+def test_build_waits_for_index_lock_held_by_another_process(rag_env, capsys):
+    make_pdf(rag_env / "manuals" / "pump.pdf", manual_pages("pump", 3))
+    lock_path = backend.INDEX_DIR.with_name(backend.INDEX_DIR.name + ".lock")
+    holder = subprocess.Popen(
+        [sys.executable, "-c", textwrap.dedent("""
+            import sys, time
+            from pathlib import Path
+            sys.path.insert(0, sys.argv[2])
+            import maintenance_agent_backend as backend
+            f = backend._IndexLock._acquire(Path(sys.argv[1]))
+            print("locked", flush=True)
+            time.sleep(1.0)
+        """), str(lock_path), str(Path(backend.__file__).parent)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        index = backend.manual_index
+        index.model = FakeEmbedder()
+        t0 = time.perf_counter()
+        index.build_from_pdfs(rag_env / "manuals")
+        assert time.perf_counter() - t0 >= 0.5   # รอจน process อื่นปล่อย lock
+    finally:
+        holder.kill()
+        holder.wait()
+    assert "Another process is building the index" in capsys.readouterr().out
+    assert len(index) and index.index_path == backend._current_index_dir()
+
+
+def test_update_reopens_index_published_by_another_process(rag_env):
+    manuals = rag_env / "manuals"
+    make_pdf(manuals / "pump.pdf", manual_pages("pump", 3))
+    index = backend.manual_index
+    index.model = FakeEmbedder()
+    index.build_from_pdfs(manuals)
+
+    make_pdf(manuals / "valve.pdf", manual_pages("valve", 4))
+    sibling = backend.ManualIndex()   # เหมือน worker อีกตัว: publish version ใหม่ + prune version เดิม
+    sibling.model = FakeEmbedder()
+    assert sibling.update_from_pdfs(manuals) is True
+
+    assert index.update_from_pdfs(manuals) is False   # manifest ของ CURRENT ตรงกับ PDF แล้ว
+    assert index.index_path == backend._current_index_dir() == sibling.index_path
+    assert set(index.manuals) == {"pump.pdf", "valve.pdf"}
+    _assert_same_index(index, sibling)
+
+
+def test_embedding_cache_counts_overwritten_rows_once(tmp_path):
+    cache = backend.EmbeddingCache(tmp_path / "emb.db", max_bytes=10 * 64 * 4)   # 10 vector
+    texts = [f"chunk {i}" for i in range(8)]
+    vecs = np.ones((8, 64), dtype=np.float32)
+    for _ in range(3):   # encode chunk ชุดเดิมซ้ำ (worker อื่น / build ซ้ำ) -> INSERT OR REPLACE ทับ
+        cache.put_many("fake", texts, vecs)
+    assert cache.stats()["bytes"] == 8 * 64 * 4
+    assert cache.stats()["evictions"] == 0
+    assert all(v is not None for v in cache.get_many("fake", texts))
@@ -0,0 +1,63 @@
+import shutil
+
+import numpy as np
+
+import maintenance_agent_backend as backend
+from conftest import FakeEmbedder, make_pdf, manual_pages
+
+
+def _open_index():
+    index = backend.ManualIndex()
+    index.model = FakeEmbedder()
+    assert index.open_existing()
+    return index
+
+
+def test_reload_swaps_version_dir_while_old_index_is_mapped(rag_env, monkeypatch):
+    manuals = rag_env / "manuals"
+    index_dir = backend.INDEX_DIR
+    make_pdf(manuals / "pump.pdf", manual_pages("pump", 3))
+    backend.manual_index._ensure_model()
+    backend.manual_index.load_or_build(manuals)
+    serving = _open_index()   # index ที่ยัง serve อยู่ระหว่าง reload
+    old_dir = serving.index_path
+    assert old_dir.parent == index_dir and (index_dir / "CURRENT").read_text() == old_dir.name
+
+    # จำลอง Windows: ลบ/ย้าย dir ที่ยังถูก map ไม่ได้
+    real_rmtree = shutil.rmtree
+
+    def rmtree(path, *args, **kwargs):
+        if path == old_dir:
+            raise PermissionError(32, "file in use", str(path))
+        return real_rmtree(path, *args, **kwargs)
+
+    monkeypatch.setattr(shutil, "rmtree", rmtree)
+    make_pdf(manuals / "valve.pdf", manual_pages("valve", 2))
+    next_index = _open_index()
+    next_index.update_from_pdfs(manuals)
+
+    assert next_index.index_path != old_dir and old_dir.exists()
+    assert (index_dir / "CURRENT").read_text() == next_index.index_path.name
+    assert set(next_index.manuals) == {"pump.pdf", "valve.pdf"}
+    assert serving.search("pump clean shaft", top_k=1)[0].manual_name == "pump.pdf"
+
+    # version เก่าถูกลบตอน finalize ครั้งถัดไปเมื่อไม่มีใคร map แล้ว
+    monkeypatch.setattr(shutil, "rmtree", real_rmtree)
+    serving._unload()
+    (manuals / "valve.pdf").unlink()
+    next_index.update_from_pdfs(manuals)
+    assert sorted(p.name for p in index_dir.iterdir()) == ["CURRENT", next_index.index_path.name]
+
+
+def test_legacy_npz_is_migrated_and_kept(rag_env):
+    texts = ["pump inspect bearing gasket", "pump replace gasket shaft"]
+    meta = np.array([{"manual_name": "pump.pdf", "page": 1}, {"manual_name": "pump.pdf", "page": 2}], dtype=object)
+    np.savez_compressed(
+        backend.LEGACY_INDEX_PATH,
+        embeddings=FakeEmbedder().encode(texts), meta=meta, texts=np.array(texts, dtype=object),
+    )
+
+    index = _open_index()
+    assert len(index) == 2 and index.text(1) == texts[1]
+    assert backend.LEGACY_INDEX_PATH.exists()
+    assert backend._load_manifest() is None   # ไม่มี manifest -> update ครั้งแรก rebuild จาก PDF
@@ -0,0 +1,28 @@
+import numpy as np
+
+import maintenance_agent_backend as backend
+
+
+def _write_embeddings(path, rows=600, dim=16, seed=3):
+    rng = np.random.default_rng(seed)
+    centers = backend._l2_normalize(rng.standard_normal((12, dim)).astype(np.float32))
+    data = centers[rng.integers(0, 12, rows)] + 0.15 * rng.standard_normal((rows, dim)).astype(np.float32)
+    backend._l2_normalize(data).astype(np.float32).tofile(path / "embeddings.bin")
+    return rows, dim
+
+
+def test_blocked_kmeans_matches_single_block(tmp_path, monkeypatch):
+    rows, dim = _write_embeddings(tmp_path)
+    results = []
+    for block_rows in (1 << 20, 37):
+        monkeypatch.setattr(backend, "IVF_BLOCK_ROWS", block_rows)
+        backend._build_ivf(tmp_path, rows, dim, "float32", nlist=12)
+        results.append((
+            np.fromfile(tmp_path / "ivf_centroids.bin", dtype=np.float32),
+            np.fromfile(tmp_path / "ivf_offsets.i64", dtype=np.int64),
+            np.fromfile(tmp_path / "ivf_rows.i32", dtype=np.int32),
+        ))
+    (c_full, off_full, rows_full), (c_blocked, off_blocked, rows_blocked) = results
+    np.testing.assert_allclose(c_blocked, c_full, atol=1e-5)
+    np.testing.assert_array_equal(off_blocked, off_full)
+    np.testing.assert_array_equal(rows_blocked, rows_full)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import maintenance_agent_backend as backend
+from conftest import FakeEmbedder
+
+ROWS, DIM, K = 3000, 64, 10
+
+
+def _write_synthetic_index(rng):
+    """index ที่ embedding เป็น cluster สุ่ม (ไม่มีคะแนนเท่ากัน -> recall วัดได้ตรงๆ)"""
+    centers = rng.standard_normal((40, DIM)).astype(np.float32)
+    emb = centers[rng.integers(0, 40, ROWS)] + 0.5 * rng.standard_normal((ROWS, DIM)).astype(np.float32)
+    writer = backend._IndexWriter(backend.INDEX_DIR, resume=False)
+    for lo in range(0, ROWS, 500):
+        hi = min(lo + 500, ROWS)
+        writer.append(
+            emb[lo:hi],
+            [f"chunk {i}" for i in range(lo, hi)],
+            [{"manual_name": "synthetic.pdf", "page": i // 4 + 1} for i in range(lo, hi)],
+        )
+    manuals = {"synthetic.pdf": {"sha256": "0", "size": 0, "mtime": 0.0, "pages": ROWS // 4,
+                                 "chunk_start": 0, "chunk_end": ROWS}}
+    assert writer.finalize(manuals)
+
+
+def _open(quant, rescore_factor):
+    index = backend.ManualIndex(quant=quant, rescore_factor=rescore_factor)
+    index.model = FakeEmbedder()
+    assert index.open_existing()
+    assert index.ivf is None   # exact scan (น้อยกว่า ANN_MIN_ROWS)
+    return index
+
+
+@pytest.mark.parametrize("quant, rescore_factor, min_recall", [
+    ("float16", 0, 0.99),
+    ("int8", 0, 0.95),
+    ("int8", 4, 0.99),
+])
+def test_quantized_scan_recall(rag_env, quant, rescore_factor, min_recall):
+    rng = np.random.default_rng(7)
+    _write_synthetic_index(rng)
+    exact_index = _open("none", 0)
+    emb = np.asarray(exact_index.embeddings, dtype=np.float32)
+    base = emb[rng.choice(ROWS, 100, replace=False)]
+    q_emb = backend._l2_normalize(base + 0.3 * rng.standard_normal(base.shape).astype(np.float32))
+
+    exact = exact_index._top_k(q_emb, K)
+    index = _open(quant, rescore_factor)
+    assert index._scan.dtype == (np.float16 if quant == "float16" else np.int8)
+    approx = index._top_k(q_emb, K)
+
+    recall = np.mean([len(np.intersect1d(a[1], e[1])) / K for a, e in zip(approx, exact)])
+    assert recall >= min_recall
+    for q, (scores, rows) in zip(q_emb, approx):
+        exact_scores = emb[rows] @ q
+        if rescore_factor:
+            np.testing.assert_allclose(scores, exact_scores, atol=1e-5)   # คะแนนหลัง rescore = cosine จริง
+        else:
+            np.testing.assert_allclose(scores, exact_scores, atol=2e-2)
+    exact_index._unload()
+    index._unload()
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import maintenance_agent_backend as backend
+from conftest import make_pdf, manual_pages
+
+
+def _wait_settled(client, timeout=30.0):
+    body = None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        body = client.get("/readyz").json()
+        if body["state"] in ("ready", "failed") and not backend.reload_status["running"]:
+            return body
+        time.sleep(0.05)
+    raise AssertionError(f"warm-up did not finish: {body}")
+
+
+def test_bad_pdf_at_startup_serves_degraded(rag_env):
+    manuals = rag_env / "manuals"
+    make_pdf(manuals / "pump.pdf", manual_pages("pump", 4))
+    good = make_pdf(manuals / "valve.pdf", manual_pages("valve", 3)).read_bytes()
+    (manuals / "valve.pdf").write_bytes(good[: len(good) // 3])   # copy ค้างครึ่งทาง
+    (manuals / "garbage.pdf").write_bytes(b"not a pdf at all")
+
+    with TestClient(backend.app) as client:
+        body = _wait_settled(client)
+        assert client.get("/readyz").status_code == 200
+        assert body["state"] == "ready"
+        assert "garbage.pdf" in body["degraded"] and "valve.pdf" in body["degraded"]
+        assert set(backend.manual_index.manuals) == {"pump.pdf"}
+        assert not backend.manual_index.is_stale(manuals)
+
+        hits = backend.manual_index.search("pump inspect bearing", top_k=3)
+        assert hits and all(h.manual_name == "pump.pdf" for h in hits)
+
+        # copy เสร็จ -> watcher / admin reload ดึงไฟล์เข้า index และล้าง degraded
+        (manuals / "valve.pdf").write_bytes(good)
+        (manuals / "garbage.pdf").unlink()
+        assert backend.manual_index.is_stale(manuals)
+        assert client.post("/admin/reload_index").status_code == 202
+        body = _wait_settled(client)
+        assert body["degraded"] is None
+        assert set(backend.manual_index.manuals) == {"pump.pdf", "valve.pdf"}
+
+
+def test_bad_pdf_with_existing_index_keeps_old_rows(rag_env):
+    manuals = rag_env / "manuals"
+    make_pdf(manuals / "pump.pdf", manual_pages("pump", 4))
+    make_pdf(manuals / "valve.pdf", manual_pages("valve", 3))
+    backend.manual_index._ensure_model()
+    backend.manual_index.load_or_build(manuals)
+    backend.manual_index._unload()
+    backend.manual_index = backend.ManualIndex()
+
+    (manuals / "valve.pdf").write_bytes(b"%PDF-1.4\ntruncated")
+    with TestClient(backend.app) as client:
+        body = _wait_settled(client)
+        assert body["state"] == "ready" and "valve.pdf" in body["degraded"]
+        assert set(backend.manual_index.manuals) == {"pump.pdf", "valve.pdf"}
+        assert backend.manual_index.search("valve replace gasket", top_k=1)[0].manual_name == "valve.pdf"
+
+
+@pytest.mark.filterwarnings("error::pytest.PytestUnhandledThreadExceptionWarning")
+def test_failed_startup_recovers_via_admin_reload(rag_env, monkeypatch):
+    make_pdf(rag_env / "manuals" / "pump.pdf", manual_pages("pump", 2))
+    real_build = backend._build_next_index
+    calls = []
+
+    def flaky_build():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("disk full")
+        return real_build()
+
+    monkeypatch.setattr(backend, "_build_next_index", flaky_build)
+    with TestClient(backend.app) as client:
+        body = _wait_settled(client)
+        assert body["state"] == "failed"
+        assert client.get("/readyz").status_code == 503
+        assert client.post("/admin/reload_index").status_code == 202
+        body = _wait_settled(client)
+        assert body["state"] == "ready" and body["degraded"] is None
+        assert len(backend.manual_index) > 0
+
+
+def test_analyze_not_ready_rejects_before_vision(rag_env, monkeypatch):
+    calls = []
+    monkeypatch.setattr(backend.vision_batcher, "submit", lambda img, q: calls.append(1))
+    backend.service_state.set("loading_model")
+    Image.new("RGB", (64, 48), "gray").save(rag_env / "part.png")
+    with open(rag_env / "part.png", "rb") as f, pytest.raises(HTTPException) as exc:
+        backend.analyze_image(f)
+    assert exc.value.status_code == 503 and not calls
@@ -0,0 +1,57 @@
+import json
+
+import numpy as np
+import pytest
+
+import maintenance_agent_backend as backend
+from conftest import make_pdf, manual_pages
+
+
+def _index_of(rag_env, topics, quant="none"):
+    for topic, n in topics:
+        make_pdf(rag_env / "manuals" / f"{topic}.pdf", manual_pages(topic, n))
+    index = backend.manual_index
+    index.quant = quant
+    index._ensure_model()
+    index.load_or_build(rag_env / "manuals")
+    return index
+
+
+@pytest.mark.parametrize("quant", ["none", "int8"])
+def test_shard_scan_uses_views_and_matches_masked_exact(rag_env, monkeypatch, quant):
+    index = _index_of(rag_env, [("pump", 5), ("valve", 4), ("press", 6)], quant)
+    ranges = index._ranges_for(index._shard_key(["press.pdf", "pump.pdf"]))
+    assert all(isinstance(r, slice) for r in ranges)
+    assert index._scan.dtype == (np.int8 if quant == "int8" else np.float32)
+
+    scanned = []
+    real_scores = index._scores
+    monkeypatch.setattr(index, "_scores", lambda q, rows=None: scanned.append(rows) or real_scores(q, rows))
+    q = index._encode_queries(["inspect bearing gasket"])
+    scores, rows = index._top_k(q, 4, ranges)[0]
+    assert scanned == ranges
+
+    allowed = np.concatenate([np.arange(r.start, r.stop) for r in ranges])
+    full = index.embeddings[:] @ q[0]
+    np.testing.assert_allclose(scores, np.sort(full[allowed])[::-1][:4], rtol=1e-5)   # ลำดับของคะแนนเท่ากันอาจต่างกัน
+    np.testing.assert_allclose(full[rows], scores, rtol=1e-5)
+    assert {index.chunk_meta(int(r))["manual_name"] for r in rows} <= {"press.pdf", "pump.pdf"}
+
+
+def test_unknown_machine_tag_warns_once(rag_env, capsys):
+    index = _index_of(rag_env, [("pump", 3)])
+    backend.MACHINE_TAGS_PATH.write_text(json.dumps({"machines": {"press-200": ["press200_*.pdf"]}}))
+    for _ in range(3):
+        assert backend.manuals_for_machine(index, "press-200") is None
+        assert backend.manuals_for_machine(index, "lathe-9") is None
+    out = capsys.readouterr().out
+    assert out.count("'press-200' matches no manual") == 1
+    assert out.count("'lathe-9' is not defined") == 1
+
+
+@pytest.mark.parametrize("blank", ["", "   ", "\t\n"])
+def test_search_many_rejects_blank_queries(rag_env, blank):
+    req = backend.RAGSearchManyRequest(queries=["oil leak", blank], top_k=3)
+    with pytest.raises(backend.HTTPException) as exc:
+        backend.rag_search_many(req)
+    assert exc.value.status_code == 400 and "[1]" in exc.value.detail
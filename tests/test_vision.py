@@ -0,0 +1,236 @@
+import io
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from PIL import Image, ImageFile
+
+import maintenance_agent_backend as backend
+from conftest import make_pdf, manual_pages
+
+# ---------- VisionBatcher ----------
+
+
+def _recording_batch_fn(calls):
+    def batch_fn(images, questions):
+        calls.append(list(images))
+        return [{"image": img, "question": q} for img, q in zip(images, questions)]
+    return batch_fn
+
+
+def _submit_all(batcher, items):
+    results = [None] * len(items)
+
+    def run(i):
+        results[i] = batcher.submit(items[i], f"q{i}")
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(items))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    return results
+
+
+def test_batcher_flushes_when_batch_is_full():
+    calls = []
+    batcher = backend.VisionBatcher(_recording_batch_fn(calls), max_batch=4, max_wait_ms=10_000)
+    t0 = time.perf_counter()
+    results = _submit_all(batcher, list(range(8)))
+    assert time.perf_counter() - t0 < 5   # ไม่ต้องรอ max_wait เมื่อ batch เต็ม
+    assert sorted(len(c) for c in calls) == [4, 4]
+    assert results == [{"image": i, "question": f"q{i}"} for i in range(8)]   # ผลกลับถึง request ที่ถูกต้อง
+    assert batcher.stats()["batch_size"]["buckets"]["le_4"] == 2
+
+
+def test_batcher_flushes_partial_batch_after_wait():
+    calls = []
+    batcher = backend.VisionBatcher(_recording_batch_fn(calls), max_batch=8, max_wait_ms=50)
+    t0 = time.perf_counter()
+    assert batcher.submit("only") == {"image": "only", "question": None}
+    assert 0.04 <= time.perf_counter() - t0 < 2
+    assert calls == [["only"]]
+
+
+def test_batcher_propagates_backend_errors_to_every_caller():
+    def failing(images, questions):
+        raise backend.VisionBackendError("model crashed")
+
+    batcher = backend.VisionBatcher(failing, max_batch=2, max_wait_ms=10_000)
+    errors = []
+
+    def run():
+        try:
+            batcher.submit("img")
+        except backend.VisionBackendError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert errors == ["model crashed", "model crashed"]
+
+
+# ---------- VisionResultCache ----------
+
+RESULT = {"defect_type": "oil_leak", "status": "NG", "confidence": 0.9, "note": ""}
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(backend.time, "time", clock)
+    return clock
+
+
+def test_cache_matches_within_hamming_distance(clock):
+    cache = backend.VisionResultCache(size=8, ttl=60, max_distance=3)
+    phash = 0xF0F0_1234_5678_9ABC
+    cache.put(phash, "Is it leaking?", RESULT)
+
+    assert cache.get(phash ^ 0b111, "is it   LEAKING?") == RESULT        # 3 bit, คำถาม normalize แล้วตรงกัน
+    assert cache.get(phash ^ 0b1111, "Is it leaking?") is None           # 4 bit > max_distance
+    assert cache.get(phash, "Is the bolt loose?") is None                 # คำถามต่างกัน
+    assert cache.get(phash ^ (1 << 63), None) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+
+
+def test_cache_entries_expire_after_ttl(clock):
+    cache = backend.VisionResultCache(size=4, ttl=60, max_distance=0)
+    cache.put(42, None, RESULT)
+    clock.now += 59
+    assert cache.get(42, None) == RESULT
+    clock.now += 2
+    assert cache.get(42, None) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = backend.VisionResultCache(size=2, ttl=600, max_distance=0)
+    cache.put(1, None, {"id": 1})
+    clock.now += 1
+    cache.put(2, None, {"id": 2})
+    clock.now += 1
+    assert cache.get(1, None) == {"id": 1}   # 1 ถูกใช้ล่าสุด -> 2 เป็น LRU
+    clock.now += 1
+    cache.put(3, None, {"id": 3})
+    assert cache.get(2, None) is None
+    assert cache.get(1, None) == {"id": 1} and cache.get(3, None) == {"id": 3}
+
+
+def test_cache_disabled_never_stores(clock):
+    cache = backend.VisionResultCache(size=0)
+    cache.put(1, None, RESULT)
+    assert cache.get(1, None) is None and cache.stats()["misses"] == 0
+
+
+def test_invalid_upload_does_not_leak_file_repr(rag_env):
+    with TestClient(backend.app) as client:
+        resp = client.post("/analyze/upload", content=b"definitely not an image",
+                           headers={"Content-Type": "image/jpeg"})
+    assert resp.status_code == 400
+    assert resp.json()["detail"] == "Invalid image"
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+def test_truncated_upload_is_rejected_as_invalid(rag_env, fmt):
+    buf = io.BytesIO()
+    Image.effect_noise((640, 480), 64).convert("RGB").save(buf, fmt)
+    truncated = buf.getvalue()[: len(buf.getvalue()) // 2]   # header ครบ ข้อมูล pixel ขาด
+    make_pdf(rag_env / "manuals" / "pump.pdf", manual_pages("pump", 3))
+    with TestClient(backend.app) as client:
+        # PNG ผ่าน validate_image (header อย่างเดียว) -> ต้อง ready ก่อนถึงจุดที่ decode จริง ไม่งั้นได้ 503
+        deadline = time.time() + 30
+        while not backend.service_state.ready and time.time() < deadline:
+            time.sleep(0.05)
+        resp = client.post("/analyze/upload", content=truncated, headers={"Content-Type": f"image/{fmt.lower()}"})
+    assert resp.status_code == 400
+    assert resp.json()["detail"] == "Invalid image"
+
+
+def test_bad_image_fails_only_its_own_request_in_a_batch(rag_env, monkeypatch):
+    pytest.importorskip("requests")
+    make_pdf(rag_env / "manuals" / "pump.pdf", manual_pages("pump", 3))
+    http = backend.HttpVisionBackend(url="http://127.0.0.1:9")
+    monkeypatch.setattr(http, "_post", lambda payload: {"results": [RESULT] * len(payload["requests"])})
+    monkeypatch.setattr(backend, "vision_backend", http)
+    monkeypatch.setattr(backend, "vision_batcher", backend.VisionBatcher(http.analyze_batch, max_batch=2, max_wait_ms=300))
+    monkeypatch.setattr(backend, "vision_cache", backend.VisionResultCache(size=0))   # ไม่มี dHash -> decode ครั้งแรกตอน vision
+
+    good, bad = io.BytesIO(), io.BytesIO()
+    Image.effect_noise((640, 480), 64).convert("RGB").save(good, "JPEG")
+    Image.effect_noise((640, 480), 64).convert("RGB").save(bad, "JPEG")
+    uploads = {"good": good.getvalue(), "bad": bad.getvalue()[: len(bad.getvalue()) // 2]}
+    outcome = {}
+
+    def run(name):
+        try:
+            outcome[name] = backend.analyze_image(io.BytesIO(uploads[name])).status
+        except HTTPException as e:
+            outcome[name] = e.status_code
+
+    with TestClient(backend.app):
+        deadline = time.time() + 30
+        while not backend.service_state.ready and time.time() < deadline:
+            time.sleep(0.05)
+        threads = [threading.Thread(target=run, args=(name,)) for name in uploads]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+    assert outcome == {"good": "NG", "bad": 400}
+
+
+@pytest.mark.parametrize("body", [["not", "an", "object"], {"results": ["x"]}, "ok"])
+def test_http_backend_rejects_malformed_json_with_503(monkeypatch, body):
+    pytest.importorskip("requests")
+    http = backend.HttpVisionBackend(url="http://127.0.0.1:9")
+    monkeypatch.setattr(http, "_post", lambda payload: body)
+    monkeypatch.setattr(http, "_payload", lambda images, questions: {"requests": [{}]})
+    with pytest.raises(HTTPException) as exc:
+        http.analyze_batch(["img"], [None])
+    assert exc.value.status_code == 503 and http.counters["failures"] == 1
+
+
+def test_retry_budget_credit_is_per_request():
+    budget = backend._RetryBudget(ratio=0.1, burst=10.0)
+    budget.balance = 0.0
+    budget.deposit(8)   # batch 8 รูป = 8 request
+    assert budget.balance == pytest.approx(0.8)
+
+
+def _png(exif=None):
+    buf = io.BytesIO()
+    Image.effect_noise((400, 300), 64).convert("RGB").save(buf, "PNG", **({"exif": exif} if exif else {}))
+    buf.seek(0)
+    return buf
+
+
+def test_validate_png_reads_header_only(monkeypatch):
+    exif = Image.Exif()
+    exif[backend.ExifTags.Base.Orientation] = 6
+    plain_png, rotated_png = _png(), _png(exif)
+    loads = []
+    real_load = ImageFile.ImageFile.load
+    monkeypatch.setattr(ImageFile.ImageFile, "load", lambda self: loads.append(1) or real_load(self))
+
+    plain = backend.validate_image(plain_png)
+    rotated = backend.validate_image(rotated_png)
+    assert not loads   # header อย่างเดียว ไม่ decode pixel
+    assert plain.orientation is None and rotated.orientation == 6
+
+    assert backend.preprocess_image(plain).oriented.size == (400, 300)
+    assert plain.orientation == 1
+    assert backend.preprocess_image(rotated).oriented.size == (300, 400)
@@ -0,0 +1,217 @@
+"""
+vision_standin_server.py
+=====================================================
+VLM server จำลองที่ใช้ protocol เดียวกับ HttpVisionBackend (VISION_BACKEND=http)
+สำหรับทดสอบ / benchmark throughput และ tail latency บน laptop โดยไม่ต้องมี network หรือ GPU
+
+Protocol:
+    POST /v1/analyze
+        {"requests": [{"prompt": str, "image_jpeg_base64": str, "tiles": [{"box": [x0, y0, x1, y1], "image_jpeg_base64": str}]}]}
+    -> {"results": [{"defect_type": str, "status": "OK" | "NG", "confidence": float, "note": str}]}
+    GET /healthz
+
+ผลเป็น deterministic: label และ confidence มาจาก hash ของรูป (รูปเดิม -> ผลเดิมทุกครั้ง)
+เวลา "model" จำลองด้วย --batch-ms + --item-ms ต่อรูป และประมวลผลได้พร้อมกันไม่เกิน --slots batch
+
+Run with:
+    python vision_standin_server.py serve --port 8100 --batch-ms 40 --item-ms 5
+    VISION_BACKEND=http VISION_URL=http://127.0.0.1:8100 uvicorn maintenance_agent_backend:app --port 8000
+    python vision_standin_server.py bench --url http://127.0.0.1:8000 --requests 500 --concurrency 32
+
+bench ส่งรูปที่ต่างกันทุก request (ลาย block สุ่มทับบนรูปฐาน -> dHash ต่างกัน) เพื่อไม่ให้ vision cache
+ของ backend (VISION_CACHE_SIZE) ตอบแทน vision backend; --same-image = ส่งรูปเดิมทุกครั้ง (วัด path ที่ hit cache)
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+# ต้องตรงกับ DEFECT_TYPES ของ backend (ไม่ import backend เพื่อให้ server นี้รันแยกได้)
+DEFECT_TYPES = ["normal", "rust_on_pipe", "oil_leak", "loose_bolt"]
+
+
+def classify(image_b64: str) -> Dict[str, Any]:
+    digest = hashlib.blake2b(base64.b64decode(image_b64), digest_size=8).digest()
+    defect = DEFECT_TYPES[digest[0] % len(DEFECT_TYPES)]
+    if defect == "normal":
+        return {"defect_type": defect, "status": "OK", "confidence": 0.9, "note": "stand-in server"}
+    confidence = 0.7 + 0.25 * int.from_bytes(digest[1:3], "big") / 0xFFFF
+    return {"defect_type": defect, "status": "NG", "confidence": round(confidence, 4), "note": "stand-in server"}
+
+
+def create_app(batch_ms: float, item_ms: float, slots: int, fail_every: int):
+    from fastapi import FastAPI, HTTPException
+    from pydantic import BaseModel
+
+    class Tile(BaseModel):
+        box: List[int]
+        image_jpeg_base64: str
+
+    class VisionRequest(BaseModel):
+        prompt: str = ""
+        image_jpeg_base64: str
+        tiles: List[Tile] = []
+
+    class VisionBatch(BaseModel):
+        requests: List[VisionRequest]
+
+    app = FastAPI(title="Vision stand-in server")
+    state = {"calls": 0, "batches": 0, "images": 0}
+    compute = asyncio.Semaphore(slots)
+
+    @app.get("/healthz")
+    def healthz():
+        return {"status": "ok", **state}
+
+    @app.post("/v1/analyze")
+    async def analyze(batch: VisionBatch):
+        state["calls"] += 1
+        # error ชั่วคราวแบบ deterministic ไว้ทดสอบ retry ของ client
+        if fail_every and state["calls"] % fail_every == 0:
+            raise HTTPException(status_code=503, detail="simulated overload")
+        async with compute:
+            await asyncio.sleep((batch_ms + item_ms * len(batch.requests)) / 1000)
+        state["batches"] += 1
+        state["images"] += len(batch.requests)
+        return {"results": [classify(r.image_jpeg_base64) for r in batch.requests]}
+
+    return app
+
+
+def serve(args) -> int:
+    import uvicorn
+
+    app = create_app(args.batch_ms, args.item_ms, args.slots, args.fail_every)
+    print(
+        f"[Standin] http://{args.host}:{args.port}/v1/analyze "
+        f"(batch {args.batch_ms} ms + {args.item_ms} ms/image, {args.slots} slots, fail_every={args.fail_every})"
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+def _bench_image(path: Path):
+    from PIL import Image
+
+    if path:
+        with Image.open(path) as img:
+            return img.convert("RGB")
+    return Image.effect_noise((1280, 960), 64).convert("RGB")
+
+
+def _encode_jpeg(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _bench_variant(base, seed: int) -> bytes:
+    """
+    base ผสมกับลาย block 9x8 สุ่ม (50%) -> gradient ที่ dHash ใช้ต่างกันทุก seed
+    (noise ทีละ pixel ไม่พอ: dHash ถูกออกแบบให้ทนต่อ noise และ re-encode)
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    pattern = Image.fromarray(rng.integers(0, 256, (8, 9), dtype=np.uint8))
+    pattern = pattern.resize(base.size, Image.Resampling.NEAREST).convert("RGB")
+    return _encode_jpeg(Image.blend(base, pattern, 0.5))
+
+
+def bench(args) -> int:
+    """
+    ยิง /analyze/upload ของ backend พร้อมกัน --concurrency connection แล้วสรุป throughput + latency percentiles
+    รูปของแต่ละ request สร้างใน thread ของ client ก่อนเริ่มจับเวลา request นั้น
+    """
+    import numpy as np
+    import requests
+
+    base = _bench_image(args.image)
+    same = (args.image.read_bytes() if args.image else _encode_jpeg(base)) if args.same_image else None
+    url = args.url.rstrip("/")
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def one(i: int):
+        image = same if same is not None else _bench_variant(base, seed=i + 1)
+        t0 = time.perf_counter()
+        try:
+            r = session.post(
+                f"{url}/analyze/upload",
+                params={"client_id": f"bench-{i % args.concurrency}"},
+                data=image,
+                headers={"Content-Type": "image/jpeg"},
+                timeout=60,
+            )
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return (time.perf_counter() - t0) * 1000, ok
+
+    one(-1)   # warm-up (connection + lazy init ของ backend)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - t0
+
+    latencies = np.array([ms for ms, ok in results if ok])
+    errors = sum(1 for _, ok in results if not ok)
+    mode = "same image every request" if same is not None else "distinct image per request"
+    print(f"[Bench] {args.requests} requests, concurrency {args.concurrency}, {base.width}x{base.height} ({mode})")
+    print(f"[Bench] throughput {args.requests / elapsed:.1f} req/s, errors {errors}")
+    if len(latencies):
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"[Bench] latency ms: p50 {p50:.1f}  p90 {p90:.1f}  p99 {p99:.1f}  max {latencies.max():.1f}")
+    try:
+        stats = session.get(f"{url}/admin/vision", timeout=5).json()
+        print(f"[Bench] mean batch size {stats['batch_size']['mean']:.2f}, backend {stats['backend']}")
+        print(f"[Bench] vision cache hit rate {stats['cache']['hit_rate']:.2f} ({stats['cache']['hits']} hits)")
+    except (requests.RequestException, KeyError, ValueError):
+        pass
+    return 1 if errors else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Deterministic stand-in vision server + load generator")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_serve = sub.add_parser("serve", help="รัน VLM server จำลอง")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8100)
+    p_serve.add_argument("--batch-ms", type=float, default=40.0, help="เวลาคงที่ต่อ batch")
+    p_serve.add_argument("--item-ms", type=float, default=5.0, help="เวลาเพิ่มต่อรูปใน batch")
+    p_serve.add_argument("--slots", type=int, default=2, help="จำนวน batch ที่ประมวลผลพร้อมกันได้")
+    p_serve.add_argument("--fail-every", type=int, default=0, help="ตอบ 503 ทุก ๆ N request (0 = ไม่ fail)")
+
+    p_bench = sub.add_parser(
+        "bench",
+        help="benchmark backend /analyze/upload (รูปต่างกันทุก request จึงไม่โดน vision cache ของ backend)",
+        description="ส่งรูปที่ต่างกันทุก request (ลาย block สุ่มทับรูปฐาน) เพื่อไม่ให้ VISION_CACHE ตอบแทน "
+                    "vision backend; ใช้ --same-image เพื่อวัด path ที่ hit cache",
+    )
+    p_bench.add_argument("--url", default="http://127.0.0.1:8000", help="base URL ของ maintenance backend")
+    p_bench.add_argument("--image", type=Path, help="รูปฐานที่ใช้ยิง (default: สร้าง noise 1280x960)")
+    p_bench.add_argument(
+        "--same-image", action="store_true",
+        help="ส่งรูปเดียวกันทุก request (หลัง request แรก backend ตอบจาก vision cache ถ้า VISION_CACHE_SIZE > 0)",
+    )
+    p_bench.add_argument("--requests", type=int, default=200)
+    p_bench.add_argument("--concurrency", type=int, default=16)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    return serve(args) if args.command == "serve" else bench(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())